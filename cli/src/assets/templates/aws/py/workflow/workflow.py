@@ -1,10 +1,25 @@
 import json
-from switchboard import InitWorkflow, Call, ParallelCall, Done, DB, Cloud, GetCache
+from switchboard import InitWorkflow, Call, ParallelCall, Done, DB, Cloud, GetCache, process_batch
 
 # This is the entry point for your workflow orchestration.
 # The `workflow_handler` is invoked by the cloud provider (e.g., AWS Lambda)
-# with the context from the invocation queue.
+# with a batch of contexts from the invocation queue.
 def workflow_handler(event, context):
+    """
+    Runs the workflow for every record in the batch.
+
+    Records for the same workflow run are applied together, so the workflow
+    runs and writes its state once per run. Records of runs that fail are
+    returned as batch item failures so only they are retried.
+    """
+    # For AWS SQS, the contexts are the bodies of event['Records'].
+    # You may need to adjust this depending on your trigger source.
+    return process_batch(event['Records'], run_workflow)
+
+
+# Optionally decorate this function with `switchboard.compiled_workflow` to run it from a plan of its steps,
+# each invocation then jumps straight to the current step instead of replaying every completed one.
+def run_workflow(sb_context: str):
     """
     Orchestrates the workflow by defining a series of steps.
 
@@ -16,12 +31,6 @@ def workflow_handler(event, context):
     The final step in the handler should always be `Done()` to mark the
     workflow's completion.
     """
-    # The event from the invocation queue (e.g., SQS) contains the
-    # Switchboard context in the message body.
-    # For AWS SQS, the context is in event['Records'][0]['body']
-    # You may need to adjust this depending on your trigger source.
-    sb_context = event['Records'][0]['body']
-
     # Initialize the database connection for the appropriate cloud.
     db = DB(Cloud.AWS)
 
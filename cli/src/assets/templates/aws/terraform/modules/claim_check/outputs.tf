@@ -0,0 +1,4 @@
+output "claim_check_bucket" {
+  description = "The name of the claim check bucket, null when none was created."
+  value       = one(aws_s3_bucket.claim_check[*].bucket)
+}
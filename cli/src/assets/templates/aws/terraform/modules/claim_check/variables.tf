@@ -0,0 +1,14 @@
+variable "claim_check_bucket" {
+  description = "The name of the claim check bucket, leave empty to not create one."
+  type        = string
+}
+
+variable "claim_check_prefix" {
+  description = "The key prefix of offloaded payloads, the S3BlobStore prefix."
+  type        = string
+}
+
+variable "claim_check_expiration_days" {
+  description = "The number of days offloaded payloads are kept."
+  type        = number
+}
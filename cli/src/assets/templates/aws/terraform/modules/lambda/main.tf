@@ -34,13 +34,17 @@ resource "aws_lambda_function" "executor_lambda" {
 }
 
 resource "aws_lambda_event_source_mapping" "invocation_queue_mapping" {
-  event_source_arn = var.invocation_queue_arn
-  function_name    = aws_lambda_function.workflow_lambda.arn
+  event_source_arn                   = var.invocation_queue_arn
+  function_name                      = aws_lambda_function.workflow_lambda.arn
+  batch_size                         = 10
+  maximum_batching_window_in_seconds = 1
+  function_response_types            = ["ReportBatchItemFailures"]
 }
 
 resource "aws_lambda_event_source_mapping" "executor_queue_mapping" {
-  event_source_arn = var.executor_queue_arn
-  function_name    = aws_lambda_function.executor_lambda.arn
-  batch_size       = 1
-  enabled          = true
+  event_source_arn        = var.executor_queue_arn
+  function_name           = aws_lambda_function.executor_lambda.arn
+  batch_size              = 10
+  function_response_types = ["ReportBatchItemFailures"]
+  enabled                 = true
 }
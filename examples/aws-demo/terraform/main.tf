@@ -31,6 +31,14 @@ module "sqs" {
   environment  = var.environment
 }
 
+module "claim_check" {
+  source = "./modules/claim_check"
+
+  claim_check_bucket          = var.claim_check_bucket
+  claim_check_prefix          = var.claim_check_prefix
+  claim_check_expiration_days = var.claim_check_expiration_days
+}
+
 module "lambda" {
   source = "./modules/lambda"
 
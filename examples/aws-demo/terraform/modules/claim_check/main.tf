@@ -0,0 +1,24 @@
+# Bucket for cache values offloaded by the claim check (InitClaimCheck(S3BlobStore(...))), only created when claim_check_bucket is set
+resource "aws_s3_bucket" "claim_check" {
+  count  = var.claim_check_bucket == "" ? 0 : 1
+  bucket = var.claim_check_bucket
+}
+
+# Offloaded payloads are only read by the runs they were sent to, expire them once the longest run is over
+resource "aws_s3_bucket_lifecycle_configuration" "claim_check" {
+  count  = var.claim_check_bucket == "" ? 0 : 1
+  bucket = aws_s3_bucket.claim_check[0].id
+
+  rule {
+    id     = "expire-switchboard-claims"
+    status = "Enabled"
+
+    filter {
+      prefix = var.claim_check_prefix
+    }
+
+    expiration {
+      days = var.claim_check_expiration_days
+    }
+  }
+}
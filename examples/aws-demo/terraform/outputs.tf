@@ -32,3 +32,8 @@ output "resources_table_name" {
   description = "The name of the DynamoDB resources table."
   value       = module.dynamodb.resources_table_name
 }
+
+output "claim_check_bucket" {
+  description = "The name of the claim check S3 bucket, null when none was created."
+  value       = module.claim_check.claim_check_bucket
+}
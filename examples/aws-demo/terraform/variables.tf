@@ -26,3 +26,21 @@ variable "workflow_name" {
   type = string
   default = "myworkflow"
 }
+
+variable "claim_check_bucket" {
+  description = "The name of an S3 bucket to create for offloaded cache values (see InitClaimCheck), the Lambda IAM policy in docs/admin.md expects a name starting with switchboard-. Leave empty to not create one."
+  type        = string
+  default     = ""
+}
+
+variable "claim_check_prefix" {
+  description = "The key prefix of offloaded cache values, the S3BlobStore prefix."
+  type        = string
+  default     = "switchboard/claims/"
+}
+
+variable "claim_check_expiration_days" {
+  description = "The number of days offloaded cache values are kept, at least as long as your longest running workflow."
+  type        = number
+  default     = 7
+}
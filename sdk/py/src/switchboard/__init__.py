@@ -1,7 +1,10 @@
-from .workflow import InitWorkflow, Call, ParallelCall, GetCache, Done, SetCustomExecutorQueue
-from .executor import switchboard_execute
-from .db import DB, DBInterface
+from .workflow import InitWorkflow, InitWorkflowAsync, Call, ParallelCall, GetCache, Done, DoneAsync, SetCustomExecutorQueue, SetCustomInvocationQueue, process_batch, WorkflowRun
+from .plan import compiled_workflow, PlanError
+from .executor import switchboard_execute, switchboard_execute_batch, switchboard_execute_async, switchboard_execute_batch_async, InitExecutor
+from .db import DB, DBInterface, EndpointCache, EndpointNotFound, ENDPOINT_CACHE, RunIdBlocks, RUN_ID_BLOCKS, WriteConflict
 from .response import Response, Trigger
+from .invocation import EnqueueFailed
+from .claim_check import InitClaimCheck, BlobStore, S3BlobStore, LocalBlobStore, ClaimNotFound
 from .enums import Cloud
 from .schemas import Task, Context, State, NewState, Resource
 
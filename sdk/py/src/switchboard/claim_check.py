@@ -0,0 +1,320 @@
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Mapping
+from botocore.utils import ClientError
+
+from switchboard.logging_config import log
+
+from .cloud import AWS_s3_client
+from .schemas import Context, LazyCache
+
+
+
+
+# Cache values whose JSON encoding is at least this many bytes are offloaded to the blob store, SQS bills every 64 KB of a message
+CLAIM_CHECK_THRESHOLD = 16 * 1024
+
+# An offloaded value is sent as `{CLAIM_KEY: "<sha256 of the value's JSON>", "bytes": <size>}`
+CLAIM_KEY = "__switchboard_claim__"
+
+# Payloads fetched from the blob store are kept in memory, the tasks of a ParallelCall in one executor batch usually share them
+CLAIM_FETCH_CACHE_SIZE = 32
+
+# Digests known to be stored are remembered up to this many, then forgotten all at once
+CLAIM_STORED_DIGESTS = 10000
+
+# Process-wide claim check counters
+#   offloaded - cache values replaced by a reference in an outgoing message
+#   stored - payloads written to the blob store, payloads that were already stored aren't written again
+#   fetched - payloads read from the blob store
+CLAIM_CHECK_STATS = {"offloaded": 0, "stored": 0, "fetched": 0}
+
+
+
+class ClaimNotFound(Exception):
+    def __init__(self, digest: str, store: "BlobStore | None"):
+        if store is None:
+            self.message = f"Received a reference to the offloaded cache value {digest} but no claim check is configured, see InitClaimCheck()"
+        else:
+            self.message = f"Offloaded cache value {digest} not found in {store!r}"
+        super().__init__(self.message)
+        self.digest = digest
+        self.store = store
+
+    def __str__(self):
+        return f"ClaimNotFound Error: {self.message}"
+
+
+
+class BlobStore(ABC):
+    '''
+    Storage for cache values offloaded from queue messages, payloads are addressed by the sha256 of their content.
+
+        - put(digest, data): Store the payload.
+        - get(digest): Return the payload, raising ClaimNotFound when it isn't stored.
+        - exists(digest): Whether the payload is stored.
+    '''
+    @abstractmethod
+    def put(self, digest: str, data: bytes):
+        pass
+
+    @abstractmethod
+    def get(self, digest: str) -> bytes:
+        pass
+
+    @abstractmethod
+    def exists(self, digest: str) -> bool:
+        pass
+
+
+
+class S3BlobStore(BlobStore):
+    '''
+    Stores payloads as `<prefix><digest>` objects in an S3 bucket. A lifecycle rule expiring the prefix after your longest run keeps the bucket from growing,
+    a payload is only read by the runs it was sent to.
+
+    The Lambda role needs `s3:PutObject` and `s3:GetObject` on the prefix and `s3:ListBucket` on the bucket, see docs/admin.md.
+    '''
+    def __init__(self, bucket: str, prefix: str = "switchboard/claims/", client=None) -> None:
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or AWS_s3_client()
+
+    def put(self, digest: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + digest, Body=data, ContentType="application/json")
+
+    def get(self, digest: str) -> bytes:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + digest)["Body"].read()
+        except ClientError as err:
+            if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                raise ClaimNotFound(digest, self)
+            raise
+
+    def exists(self, digest: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + digest)
+        except ClientError as err:
+            if err.response["Error"]["Code"] in ("NoSuchKey", "404", "NotFound"):
+                return False
+            # without s3:ListBucket S3 answers 403 for a missing object, payloads are content addressed so writing one again is harmless
+            if err.response["Error"]["Code"] in ("403", "Forbidden", "AccessDenied"):
+                log.bind(
+                    component="claim_check",
+                    store=repr(self),
+                    digest=digest
+                ).warning("-- head_object was denied, grant s3:ListBucket on the claim check bucket to skip rewriting stored payloads. --")
+                return False
+            raise
+        return True
+
+    def __repr__(self) -> str:
+        return f"S3BlobStore(s3://{self.bucket}/{self.prefix})"
+
+
+
+class LocalBlobStore(BlobStore):
+    '''
+    Stores payloads as files under `root`, a stand-in for S3BlobStore in tests and local runs.
+    '''
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, digest: str, data: bytes):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file first so a concurrent reader never sees a partial payload
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get(self, digest: str) -> bytes:
+        try:
+            with open(self._path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise ClaimNotFound(digest, self)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self._path(digest))
+
+    def __repr__(self) -> str:
+        return f"LocalBlobStore({self.root})"
+
+
+
+class ClaimCheck():
+    '''
+    Offloads large cache values of outgoing queue messages to a BlobStore and fetches them back for received messages.
+    Payloads are content addressed, a payload that was already stored (by this container or any other) isn't written again.
+    '''
+    def __init__(self, store: BlobStore, threshold: int = CLAIM_CHECK_THRESHOLD) -> None:
+        self.store = store
+        self.threshold = threshold
+        self._stored: set[str] = set()
+        self._fetched: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, value):
+        '''
+        The value, or a reference to it when its JSON encoding is at least `threshold` bytes.
+        '''
+        data = json.dumps(value, separators=(",", ":"), sort_keys=True).encode()
+        if len(data) < self.threshold:
+            return value
+        digest = hashlib.sha256(data).hexdigest()
+        self._put(digest, data)
+        CLAIM_CHECK_STATS["offloaded"] += 1
+        return {CLAIM_KEY: digest, "bytes": len(data)}
+
+    def _put(self, digest: str, data: bytes):
+        with self._lock:
+            if digest in self._stored:
+                return
+        if not self.store.exists(digest):
+            self.store.put(digest, data)
+            CLAIM_CHECK_STATS["stored"] += 1
+            log.bind(
+                component="claim_check",
+                digest=digest,
+                size=len(data)
+            ).info("-- Cache value offloaded to the blob store. --")
+        with self._lock:
+            if len(self._stored) >= CLAIM_STORED_DIGESTS:
+                self._stored.clear()
+            self._stored.add(digest)
+
+    def fetch(self, digest: str):
+        with self._lock:
+            data = self._fetched.get(digest)
+            if data is not None:
+                self._fetched.move_to_end(digest)
+        if data is None:
+            data = self.store.get(digest)
+            CLAIM_CHECK_STATS["fetched"] += 1
+            with self._lock:
+                self._fetched[digest] = data
+                if len(self._fetched) > CLAIM_FETCH_CACHE_SIZE:
+                    self._fetched.popitem(last=False)
+        # decoded for every read, so one task's changes to a value aren't seen by another
+        return json.loads(data)
+
+
+# Set by InitClaimCheck(), messages are sent with their whole cache while it's None
+CLAIM_CHECK: ClaimCheck | None = None
+
+
+def InitClaimCheck(store: BlobStore | None, threshold: int = CLAIM_CHECK_THRESHOLD) -> ClaimCheck | None:
+    '''
+    Offload cache values of at least `threshold` bytes (JSON encoded) from the queue messages this process sends to `store`, e.g.
+    `InitClaimCheck(S3BlobStore("my-bucket"))`. Messages carry a reference instead, which is fetched the first time the value is read
+    by the workflow or task receiving the message. Every workflow and executor of the run has to be able to read the store.
+    Call this once outside of your handler, passing None turns offloading off.
+    '''
+    global CLAIM_CHECK
+    CLAIM_CHECK = ClaimCheck(store, threshold) if store is not None else None
+    log.bind(
+        component="claim_check",
+        store=repr(store),
+        threshold=threshold
+    ).info("-- Claim check configured. --")
+    return CLAIM_CHECK
+
+
+
+class ClaimedCache(LazyCache):
+    '''
+    The cache of a received message, offloaded values are fetched from the blob store the first time they're read.
+    '''
+    __slots__ = ("_refs",)
+
+    def __init__(self, values: dict, refs: dict[str, dict], claim_check: ClaimCheck | None):
+        super().__init__(values, list(refs), functools.partial(_fetch_claims, refs, claim_check))
+        self._refs = refs
+
+    def reference(self, key: str) -> dict | None:
+        '''
+        The reference of a value that wasn't fetched, so it's sent on without fetching it.
+        '''
+        if key in self and key not in self.loaded():
+            return self._refs[key]
+        return None
+
+
+def _fetch_claims(refs: dict[str, dict], claim_check: ClaimCheck | None, keys: list[str]) -> dict:
+    if claim_check is None:
+        raise ClaimNotFound(refs[keys[0]][CLAIM_KEY], None)
+    return {k: claim_check.fetch(refs[k][CLAIM_KEY]) for k in keys}
+
+
+def _is_claim(value) -> bool:
+    return isinstance(value, dict) and CLAIM_KEY in value
+
+
+def _resolve_stored(value):
+    if not _is_claim(value):
+        return value
+    claim_check = CLAIM_CHECK
+    if claim_check is None:
+        raise ClaimNotFound(value[CLAIM_KEY], None)
+    return claim_check.fetch(value[CLAIM_KEY])
+
+
+# a run's cache keeps the references it received, a value is only fetched when the workflow reads its key
+LazyCache.resolve_stored = staticmethod(_resolve_stored)
+
+
+def unresolved(cache: Mapping) -> dict:
+    '''
+    The cache's values with values that weren't fetched left as their references, for copying a received cache into a run's cache without fetching.
+    '''
+    if not isinstance(cache, ClaimedCache):
+        return dict(cache.items())
+    return {k: ref if (ref := cache.reference(k)) is not None else cache[k] for k in cache}
+
+
+def offload_cache(cache: Mapping) -> dict:
+    '''
+    The cache to send in a queue message, see InitClaimCheck().
+    '''
+    claim_check = CLAIM_CHECK
+    if claim_check is None and not isinstance(cache, LazyCache):
+        return cache
+    offloaded = {}
+    for k in cache:
+        if isinstance(cache, ClaimedCache) and (ref := cache.reference(k)) is not None:
+            offloaded[k] = ref
+            continue
+        offloaded[k] = claim_check.claim(cache[k]) if claim_check else cache[k]
+    return offloaded
+
+
+def offload(body: dict) -> dict:
+    '''
+    The message body with its cache offloaded, see offload_cache().
+    '''
+    return body | {"cache": offload_cache(body["cache"])}
+
+
+def resolve(context: Context) -> Context:
+    '''
+    Replace the references in a received context's cache with a ClaimedCache that fetches their values when they're read.
+    '''
+    refs = {k: v for k, v in context.cache.items() if _is_claim(v)}
+    if refs:
+        context.cache = ClaimedCache({k: v for k, v in context.cache.items() if k not in refs}, refs, CLAIM_CHECK)
+    return context
@@ -1,4 +1,10 @@
+import copy
+import os
+import threading
+import time
+
 import boto3
+from botocore.config import Config
 
 from switchboard.logging_config import log
 
@@ -27,9 +33,98 @@ def AZURE_db_connect():
     pass
 
 
+# Message queue clients
+# Clients are expensive to build (credential resolution, endpoint resolution, a fresh TLS connection),
+# so they are created once per (region, endpoint_url, config) and reused for the life of the container.
+AWS_SQS_CONFIG = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=30,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+
+_SQS_CLIENTS: dict[tuple, object] = {}
+_CLIENTS_LOCK = threading.Lock()
+CLIENT_STATS = {"sqs_clients_created": 0}
+
+
+def _config_key(config: Config) -> str:
+    # every option botocore accepts is a public attribute of the Config, options that weren't provided are their default
+    return repr([(option, getattr(config, option, None)) for option in Config.OPTION_DEFAULTS])
+
+
+def AWS_sqs_client(region_name: str | None = None, endpoint_url: str | None = None, config: Config | None = None):
+    '''
+    Returns a pooled SQS client - https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html
+
+    Clients are cached per (region, endpoint_url, config) so every push inside a container shares the same
+    keep-alive connection pool. boto3 clients are thread safe, only their construction is guarded.
+    '''
+    region_name = region_name or os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION")
+    config = config or AWS_SQS_CONFIG
+    key = (region_name, endpoint_url, _config_key(config))
+
+    client = _SQS_CLIENTS.get(key)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _SQS_CLIENTS.get(key)
+            if client is None:
+                # botocore normalizes the retries options in place, copy so the cache key stays stable
+                client = boto3.client("sqs", region_name=region_name, endpoint_url=endpoint_url, config=copy.deepcopy(config))
+                _SQS_CLIENTS[key] = client
+                CLIENT_STATS["sqs_clients_created"] += 1
+                log.bind(
+                    component="cloud_service",
+                    region=region_name,
+                    endpoint_url=endpoint_url
+                ).info("-- SQS client created. --")
+    return client
+
+
+_S3_CLIENTS: dict[tuple, object] = {}
+CLIENT_STATS["s3_clients_created"] = 0
+
+
+def AWS_s3_client(region_name: str | None = None, endpoint_url: str | None = None):
+    '''
+    Returns a pooled S3 client - https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html
+
+    Cached per (region, endpoint_url) like AWS_sqs_client, used by the claim check's S3BlobStore.
+    '''
+    region_name = region_name or os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION")
+    key = (region_name, endpoint_url)
+
+    client = _S3_CLIENTS.get(key)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _S3_CLIENTS.get(key)
+            if client is None:
+                client = boto3.client("s3", region_name=region_name, endpoint_url=endpoint_url)
+                _S3_CLIENTS[key] = client
+                CLIENT_STATS["s3_clients_created"] += 1
+                log.bind(
+                    component="cloud_service",
+                    region=region_name,
+                    endpoint_url=endpoint_url
+                ).info("-- S3 client created. --")
+    return client
+
+
+def reset_clients():
+    '''
+    Drop every cached client. Useful in tests or after rotating credentials.
+    '''
+    with _CLIENTS_LOCK:
+        _SQS_CLIENTS.clear()
+        _S3_CLIENTS.clear()
+        CLIENT_STATS["sqs_clients_created"] = 0
+        CLIENT_STATS["s3_clients_created"] = 0
+
+
 # Message queue publishers
 def AWS_message_push(endpoint: str, msg: str) -> dict:
-    sqs = boto3.client("sqs")
+    sqs = AWS_sqs_client()
     response = {}
     try:
         response = sqs.send_message(
@@ -46,12 +141,98 @@ def AWS_message_push(endpoint: str, msg: str) -> dict:
     finally:
         return response
 
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_BYTES = 262144
+
+
+def _sqs_batches(msgs: list[str]) -> list[list[tuple[str, str]]]:
+    '''
+    Split messages into SendMessageBatch sized groups (max 10 entries and 256 KiB of payload per call).
+    Entry ids are the message's index in `msgs` so failures can be mapped back by the caller.
+    '''
+    batches = []
+    batch = []
+    size = 0
+    for i, msg in enumerate(msgs):
+        msg_size = len(msg.encode("utf-8"))
+        if batch and (len(batch) == SQS_MAX_BATCH_ENTRIES or size + msg_size > SQS_MAX_BATCH_BYTES):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append((str(i), msg))
+        size += msg_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def AWS_message_push_batch(endpoint: str, msgs: list[str], max_attempts: int = 3) -> dict:
+    '''
+    Push many messages using SendMessageBatch - https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/send_message_batch.html
+
+    Only the entries SQS reports as failed are retried, entries failing due to a sender fault are not retried.
+    Returns {"Successful": [...], "Failed": [...]} aggregated over every batch sent.
+    '''
+    sqs = AWS_sqs_client()
+    successful = []
+    failed = []
+    for batch in _sqs_batches(msgs):
+        pending = dict(batch)
+        attempt = 0
+        while pending:
+            attempt += 1
+            try:
+                response = sqs.send_message_batch(
+                    QueueUrl=endpoint,
+                    Entries=[{"Id": id, "MessageBody": msg} for id, msg in pending.items()]
+                )
+            except Exception as e:
+                log.bind(
+                    component="db_service",
+                    endpoint=endpoint,
+                    entries=list(pending)
+                ).error(e)
+                failed.extend({"Id": id, "SenderFault": False, "Code": type(e).__name__, "Message": str(e)} for id in pending)
+                break
+
+            successful.extend(response.get("Successful", []))
+            retry = {}
+            for entry in response.get("Failed", []):
+                if entry.get("SenderFault") or attempt >= max_attempts:
+                    failed.append(entry)
+                else:
+                    retry[entry["Id"]] = pending[entry["Id"]]
+            pending = retry
+            if pending:
+                log.bind(
+                    component="db_service",
+                    endpoint=endpoint,
+                    entries=list(pending),
+                    attempt=attempt
+                ).warning("-- Retrying failed batch entries. --")
+                time.sleep(0.05 * 2 ** attempt)
+
+    if failed:
+        log.bind(
+            component="db_service",
+            endpoint=endpoint,
+            failed=failed
+        ).error(f"-- {len(failed)} of {len(msgs)} messages could not be pushed. --")
+    return {"Successful": successful, "Failed": failed}
+
+
 def GCP_message_push(msg: str) -> dict:
     return {}
 
 def AZURE_message_push(msg: str) -> dict:
     return {}
 
+def GCP_message_push_batch(msgs: list[str]) -> dict:
+    return {}
+
+def AZURE_message_push_batch(msgs: list[str]) -> dict:
+    return {}
+
 
 
 
@@ -1,10 +1,15 @@
+import functools
+import hashlib
+import threading
+import time
+from decimal import Decimal
 from botocore.utils import ClientError
 from abc import ABC, abstractmethod
 from boto3.dynamodb.conditions import Key
 
 from switchboard.logging_config import log
 
-from .schemas import NewState, Resource, State
+from .schemas import LazyCache, LazySteps, NewState, ParallelStep, Resource, State, Step
 from .enums import SwitchboardComponent, TableName, Cloud
 from .cloud import (
         AWS_db_connect,
@@ -16,6 +21,237 @@ from .cloud import (
 
 
 
+# Key suffix of the per-workflow run_id counter item in the SwitchboardState table
+RUN_COUNTER_SUFFIX = "#run_counter"
+
+# Delta writes with a longer update expression fall back to a full write (DynamoDB's limit is 4 KB)
+MAX_DELTA_EXPRESSION_LENGTH = 4000
+
+# ParallelSteps with at least this many tasks are stored with one item per task, see AWS_DataInterface
+SHARD_TASK_THRESHOLD = 100
+
+# The sort key of a sharded task item is step_id * TASK_KEY_STRIDE + task_id, so a ParallelStep can have up to this many tasks
+TASK_KEY_STRIDE = 1_000_000
+
+# Key suffix of the partition holding a run's cache values, one item per cache key
+CACHE_SUFFIX = "#cache"
+
+# BatchGetItem reads at most this many items per request
+MAX_BATCH_GET = 100
+
+# DynamoDB transactions are limited to 100 items and 4 MB, cache items past these limits are written outside of the state's transaction
+MAX_TRANSACT_ITEMS = 100
+MAX_TRANSACT_BYTES = 3_500_000
+
+# task flag -> ParallelStep counter
+_TASK_COUNTERS = (("executed", "executed_count"), ("completed", "completed_count"), ("success", "succeeded_count"))
+
+
+def _dynamodb_size(value) -> int:
+    '''
+    Estimate the size in bytes DynamoDB bills for a value - https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/CapacityUnitCalculations.html
+    '''
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (int, float, Decimal)):
+        return len(str(value).lstrip("-").replace(".", "")) // 2 + 2
+    if isinstance(value, dict):
+        return 3 + sum(len(str(k).encode("utf-8")) + _dynamodb_size(v) + 1 for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return 3 + sum(_dynamodb_size(v) + 1 for v in value)
+    return len(str(value))
+
+
+
+# Endpoint cache
+class EndpointCache():
+    '''
+    Process-wide TTL cache for queue endpoints stored in the SwitchboardResources table.
+    Endpoints almost never change, so caching them removes a database round trip from every task dispatch and every response.
+
+    Parameters:
+        ttl: Seconds a discovered endpoint is kept.
+        negative_ttl: Seconds a missing endpoint (EndpointNotFound) is remembered before the database is asked again.
+
+    Counters are available via `stats()`. Use `invalidate()` after changing a workflow's resources.
+    '''
+    def __init__(self, ttl: float = 300, negative_ttl: float = 30) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self._entries: dict[tuple[str, str], tuple[float, str | None]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str, component: SwitchboardComponent, fetch) -> str:
+        key = (name, component.value)
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            url = entry[1]
+            with self._lock:
+                if url is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+            if url is None:
+                raise EndpointNotFound(name, component)
+            return url
+
+        with self._lock:
+            self.misses += 1
+        try:
+            url = fetch()
+        except EndpointNotFound:
+            self.put(name, component, None)
+            raise
+        self.put(name, component, url)
+        return url
+
+    def get_many(self, name: str, fetch) -> dict[SwitchboardComponent, str]:
+        '''
+        Return every component endpoint for a workflow. Served from the cache when all components are fresh, 
+        otherwise `fetch` is called once and its results (including components it did not return) are cached.
+        '''
+        now = time.monotonic()
+        entries = [(c, self._entries.get((name, c.value))) for c in SwitchboardComponent]
+        if all(entry and entry[0] > now for _, entry in entries):
+            with self._lock:
+                self.hits += len(entries)
+            return {c: entry[1] for c, entry in entries if entry and entry[1] is not None}
+
+        with self._lock:
+            self.misses += 1
+        endpoints = fetch()
+        for c in SwitchboardComponent:
+            self.put(name, c, endpoints.get(c))
+        return endpoints
+
+    def put(self, name: str, component: SwitchboardComponent, url: str | None):
+        ttl = self.ttl if url is not None else self.negative_ttl
+        with self._lock:
+            self._entries[(name, component.value)] = (time.monotonic() + ttl, url)
+
+    def invalidate(self, name: str | None = None, component: SwitchboardComponent | None = None):
+        '''
+        Drop cached endpoints. With no arguments the whole cache is cleared.
+        '''
+        with self._lock:
+            for key in list(self._entries):
+                if (name is None or key[0] == name) and (component is None or key[1] == component.value):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.negative_hits = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "negative_hits": self.negative_hits, "size": len(self._entries)}
+
+
+ENDPOINT_CACHE = EndpointCache()
+
+
+def _cached_get_endpoint(get_endpoint):
+    @functools.wraps(get_endpoint)
+    def wrapper(self, name: str, component: SwitchboardComponent) -> str:
+        cache = getattr(self, "endpoint_cache", None)
+        if cache is None:
+            return get_endpoint(self, name, component)
+        return cache.get(name, component, lambda: get_endpoint(self, name, component))
+    return wrapper
+
+
+def _cached_get_endpoints(get_endpoints):
+    @functools.wraps(get_endpoints)
+    def wrapper(self, name: str) -> dict[SwitchboardComponent, str]:
+        cache = getattr(self, "endpoint_cache", None)
+        if cache is None:
+            return get_endpoints(self, name)
+        return cache.get_many(name, lambda: get_endpoints(self, name))
+    return wrapper
+
+
+
+# run_id block reservation
+class RunIdBlocks():
+    '''
+    Hands out run_ids from blocks reserved with a single atomic counter increment, so a warm container only writes the
+    counter item once per block instead of once per trigger.
+
+    Parameters:
+        min_block: Smallest block reserved, also the size of the first block for each workflow.
+        max_block: Largest block reserved.
+        target_seconds: How long a block should roughly last. A block used up faster than this doubles the next block,
+            one that lasts more than four times as long halves it.
+
+    run_ids stay unique but are no longer strictly increasing across containers, and ids left in a block when a container
+    is recycled are never used.
+    '''
+    def __init__(self, min_block: int = 1, max_block: int = 1000, target_seconds: float = 10) -> None:
+        assert 1 <= min_block <= max_block, "block sizes must satisfy 1 <= min_block <= max_block"
+        self.min_block = min_block
+        self.max_block = max_block
+        self.target_seconds = target_seconds
+        self.reservations = 0
+        self.allocated = 0
+        self._blocks: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def next(self, name: str, reserve) -> int:
+        '''
+        Return the next run_id for `name`. `reserve(n)` must atomically add n to the counter and return its new value.
+        '''
+        with self._lock:
+            block = self._blocks.get(name)
+            if block is None or block["next"] > block["end"]:
+                size = self._next_size(block)
+                end = reserve(size)
+                block = {"next": end - size + 1, "end": end, "size": size, "reserved_at": time.monotonic()}
+                self._blocks[name] = block
+                self.reservations += 1
+                log.bind(
+                    component="db_service",
+                    workflow_name=name,
+                    start=block["next"],
+                    end=end
+                ).info(f"-- Reserved block of {size} run_ids. --")
+            run_id = block["next"]
+            block["next"] += 1
+            self.allocated += 1
+            return run_id
+
+    def _next_size(self, block: dict | None) -> int:
+        if block is None:
+            return self.min_block
+        elapsed = time.monotonic() - block["reserved_at"]
+        if elapsed < self.target_seconds:
+            return min(block["size"] * 2, self.max_block)
+        if elapsed > self.target_seconds * 4:
+            return max(block["size"] // 2, self.min_block)
+        return block["size"]
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.reservations = 0
+            self.allocated = 0
+
+    def stats(self) -> dict:
+        return {"reservations": self.reservations, "allocated": self.allocated}
+
+
+RUN_ID_BLOCKS = RunIdBlocks()
+
+
+
 # Database Interface
 class DBInterface(ABC):
     '''
@@ -30,8 +266,28 @@ class DBInterface(ABC):
     Subclasses must implement the following methods:
         - read(name, id): Retrieves the state associated with the given `name` and `run id`.
         - write(state): Stores or updates the `State` associated with the workflow `name` and `run_id`.
+            Implementations should only write when the stored version equals `state.version`, raise `WriteConflict` otherwise,
+            and increment `state.version` after a successful write. Interfaces that skip the check fall back to last-writer-wins.
         - increment_id(name): Atomically increment a counter to generate the `run_id` for a given workflow identified by `name`.
+            Implementations must guarantee that a run_id is never handed out twice for the same `name`, even when called concurrently from many processes.
+            Gaps in the sequence are allowed.
         - get_endpoint(name, component): Retrieve a queue's endpoint url from the SwitchboardResources table in the database.
+            Raise `EndpointNotFound` when no entry exists.
+
+    Subclasses may override:
+        - read_latest(name, id, step_idx): Read the state with only the step at `step_idx` (the latest step, whose id the invocation's context carries) decoded,
+            older steps are loaded on first access (see LazySteps). Fall back to a full read when the stored state's latest step isn't `step_idx`.
+            The default implementation calls `read`.
+        - write_delta(state): Write only what changed since the state was read (see `State.delta()`). The default implementation calls `write`.
+        - write_task(state, step_idx, task_idx): Atomically record a ParallelStep task's response and any cache keys it changed, incrementing the step's 
+            counters in the store rather than overwriting them, and refresh the step's counters from the stored values so the caller sees every concurrent response.
+            Return True once written, the default implementation returns False and the change is written with the rest of the state instead.
+        - get_endpoints(name): Retrieve every component's endpoint for a workflow in as few round trips as possible. 
+            The default implementation calls `get_endpoint` once per component.
+
+    Endpoint caching:
+        Any implementation of `get_endpoint` is transparently fronted by `self.endpoint_cache` when one is set (see EndpointCache).
+        Pass `endpoint_cache=ENDPOINT_CACHE` to share the process-wide cache, it is enabled by default for AWS_DataInterface.
 
     Example:
         ```python 
@@ -57,9 +313,17 @@ class DBInterface(ABC):
 
         Note that the user will need to implement the necessary terraform scripts for this custom database implementation themselves.
     '''
-    def __init__(self, conn) -> None:
+    def __init__(self, conn, endpoint_cache: EndpointCache | None = None) -> None:
         super().__init__()
         self.conn = conn
+        self.endpoint_cache = endpoint_cache
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "get_endpoint" in cls.__dict__:
+            cls.get_endpoint = _cached_get_endpoint(cls.__dict__["get_endpoint"])
+        if "get_endpoints" in cls.__dict__:
+            cls.get_endpoints = _cached_get_endpoints(cls.__dict__["get_endpoints"])
 
     @abstractmethod
     def read(self, name: str, id: int) -> State | None:
@@ -72,10 +336,28 @@ class DBInterface(ABC):
     @abstractmethod
     def increment_id(self, name: str) -> int:
         pass
+
+    def read_latest(self, name: str, id: int, step_idx: int) -> State | None:
+        return self.read(name, id)
+
+    def write_delta(self, state: State):
+        self.write(state)
+
+    def write_task(self, state: State, step_idx: int, task_idx: int) -> bool:
+        return False
     
     @abstractmethod
     def get_endpoint(self, name: str, component: SwitchboardComponent) -> str:
         pass
+
+    def get_endpoints(self, name: str) -> dict[SwitchboardComponent, str]:
+        endpoints = {}
+        for component in SwitchboardComponent:
+            try:
+                endpoints[component] = self.get_endpoint(name, component)
+            except EndpointNotFound:
+                continue
+        return endpoints
     
 
 
@@ -91,10 +373,46 @@ class AWS_DataInterface(DBInterface):
             "name":        "string",   // Partition key — represents the workflow name
             "run_id":      "number",   // Sort key — monotonically increasing run ID within each name
             "steps":       "list",     // List of steps or tasks executed during the run and the status of each
-            "cache":       "map",       // Dictionary-like structure storing any cached data or intermediate results
-            "status":       "string"    // String representation of Status enum
+            "step_names":  "list",     // The step_name of each step, so a partial read (read_latest) can index the steps it didn't load
+            "cache_keys":  "string set", // The keys of the run's cache, each value is its own item (see below). Absent while the cache is empty
+            "status":       "string",   // String representation of Status enum
+            "version":      "number"    // Incremented on every write, writes are conditional on the version that was read
         }
 
+        // run_id counter, one item per workflow in the SwitchboardState table
+        SwitchboardState: {
+            "name":         "string",   // Partition key - "<workflow name>#run_counter"
+            "run_id":       "number",   // Sort key - always 0
+            "next_run_id":  "number"    // Last run_id handed out, incremented atomically with ADD
+        }
+
+        // task of a sharded ParallelStep, one item per task in the SwitchboardState table
+        SwitchboardState: {
+            "name":         "string",   // Partition key - "<workflow name>#<run_id>"
+            "run_id":       "number",   // Sort key - step_id * TASK_KEY_STRIDE + task_id
+            ...                         // task_key, executed, completed, success and retries (see ParallelStep.task_record())
+        }
+
+        // cache value, one item per cache key in the SwitchboardState table
+        SwitchboardState: {
+            "name":         "string",   // Partition key - "<workflow name>#<run_id>#cache"
+            "run_id":       "number",   // Sort key - 64 bit hash of the cache key
+            "cache_key":    "string",   // The cache key
+            "value":        "any"       // The cached value
+        }
+        ```
+
+    ParallelSteps with `shard_threshold` or more tasks are sharded when they are first written: the state item only holds the step's header 
+    (flags, counters and `task_count`, see ParallelStep.header()) and each task is its own item, so a fan-out's size isn't bound by DynamoDB's 400 KB item limit 
+    and a task response only rewrites its task item and the small header. read() loads the tasks back into the step, writes route task changes to the task items.
+    Steps keep the layout they were first written with. Pass `shard_threshold=None` to always store tasks inline.
+
+    The cache is read as its key set (a LazyCache), a value is only fetched the first time its key is read and only the values that changed are written, 
+    so an invocation that doesn't use the cache never reads or writes a cached payload. States stored before cache items existed keep their values in 
+    a `cache` map, which is moved to cache items by their next write.
+
+        ```js
+
         SwitchboardResources: {
             "component":        "string",   // Partition key - The type of component (see enums.SwitchboardComponent)
             "name":             "string",   // Sort key — represents the workflow name
@@ -105,7 +423,20 @@ class AWS_DataInterface(DBInterface):
         }
         ```
 
+    Endpoint lookups go through the shared ENDPOINT_CACHE unless another cache (or None) is passed in.
+    Pass `run_id_blocks` (e.g. the process-wide RUN_ID_BLOCKS) to reserve run_ids in blocks instead of one counter write per run, see RunIdBlocks.
     '''
+    def __init__(
+            self, 
+            conn, 
+            endpoint_cache: EndpointCache | None = ENDPOINT_CACHE, 
+            run_id_blocks: RunIdBlocks | None = None, 
+            shard_threshold: int | None = SHARD_TASK_THRESHOLD
+    ) -> None:
+        super().__init__(conn, endpoint_cache)
+        self.run_id_blocks = run_id_blocks
+        self.shard_threshold = shard_threshold
+
     def read(self, name: str, id: int) -> State | None:
         tbl = self.get_table()
         state = None
@@ -124,7 +455,12 @@ class AWS_DataInterface(DBInterface):
             ).error(f"""Error in {name} - Couldn't get state for run_id {id} from table {tbl.table_name} - {err.response["Error"]["Code"]}: {err.response["Error"]["Message"]}""")
             raise 
         if "Item" in response:
-            state = NewState(response["Item"])
+            item = response["Item"]
+            if any(step.get("sharded") for step in item["steps"]):
+                self._load_tasks(tbl, item)
+            legacy = self._lazy_cache(item)
+            state = NewState(item)
+            state.cache.mark_keys_dirty(legacy)
             log.bind(
                 component="db_service",
                 workflow_name=name,
@@ -133,62 +469,721 @@ class AWS_DataInterface(DBInterface):
             ).info(f"Read NewState...")
         return state
 
-    def write(self, state: State):
+    def read_latest(self, name: str, id: int, step_idx: int) -> State | None:
+        '''
+        Reads the item projected to the step at step_idx, the step name index, the cache keys and the run's attributes. Older steps are 
+        fetched with one more read when they're first accessed, which a workflow invocation usually never does.
+
+        The read's RCUs are still computed from the whole item (DynamoDB bills a projection like the full read), 
+        what's saved is the size of the response and decoding every step.
+        '''
+        if step_idx < 0:
+            return self.read(name, id)
+        tbl = self.get_table()
+        try:
+            response = tbl.get_item(
+                Key={"name": name, "run_id": id},
+                ProjectionExpression=f"#n, run_id, step_names, steps[{int(step_idx)}], cache_keys, cache, #stat, version",
+                ExpressionAttributeNames={"#n": "name", "#stat": "status"},
+            )
+        except ClientError as err:
+            log.bind(
+                component="db_service",
+                workflow_name=name,
+                run_id=id
+            ).error(f"""Error in {name} - Couldn't get state for run_id {id} from table {tbl.table_name} - {err.response["Error"]["Code"]}: {err.response["Error"]["Message"]}""")
+            raise
+        if "Item" not in response:
+            return None
+        item = response["Item"]
+        names = item.get("step_names")
+        if names is None or len(names) != step_idx + 1 or len(item.get("steps", [])) != 1:
+            log.bind(
+                component="db_service",
+                workflow_name=name,
+                run_id=id,
+                step_idx=step_idx
+            ).info("-- The stored latest step isn't the requested step, reading the full state. --")
+            return self.read(name, id)
+        if item["steps"][0].get("sharded"):
+            self._load_tasks(tbl, item)
+        item["steps"] = LazySteps(names, {step_idx: item["steps"][0]}, functools.partial(self._read_steps, tbl, name, id))
+        legacy = self._lazy_cache(item)
+        state = NewState(item)
+        state.cache.mark_keys_dirty(legacy)
+        log.bind(
+            component="db_service",
+            workflow_name=name,
+            run_id=id,
+            state=state
+        ).info("Read NewState (latest step)...")
+        return state
+
+
+    def _read_steps(self, tbl, name: str, id: int) -> list[dict]:
+        '''
+        Load every step of a state that was read with read_latest().
+        '''
+        item = tbl.get_item(Key={"name": name, "run_id": id}, ProjectionExpression="#n, run_id, steps", ExpressionAttributeNames={"#n": "name"})["Item"]
+        if any(step.get("sharded") for step in item["steps"]):
+            self._load_tasks(tbl, item)
+        log.bind(
+            component="db_service",
+            workflow_name=name,
+            run_id=id,
+            steps=len(item["steps"])
+        ).info("-- Older steps loaded. --")
+        return item["steps"]
+
+
+    def _lazy_cache(self, item: dict) -> dict:
+        '''
+        Replace the item's cache with a LazyCache of its cache keys. Returns the values of a cache stored as a map, which are 
+        marked as not stored by the caller so the next write moves them to cache items.
+        '''
+        keys = sorted(item.pop("cache_keys", ()))
+        # a key in both was written by write_task() after it was read, its cache item is newer
+        legacy = {k: v for k, v in item.pop("cache", {}).items() if k not in keys}
+        item["cache"] = LazyCache(legacy, keys, functools.partial(self._read_cache, item["name"], int(item["run_id"])))
+        return legacy
+
+
+    def _read_cache(self, name: str, id: int, keys: list[str]) -> dict:
+        '''
+        Fetch the values of the cache keys, keys without a cache item are left out.
+        '''
         tbl = self.get_table()
-        state_dict = state.to_dict()
+        values = {}
+        requested = [self._cache_item_key(name, id, k) for k in keys]
+        for start in range(0, len(requested), MAX_BATCH_GET):
+            request = {tbl.table_name: {"Keys": requested[start:start + MAX_BATCH_GET], "ConsistentRead": True}}
+            while request:
+                try:
+                    response = self.conn.batch_get_item(RequestItems=request)
+                except ClientError as err:
+                    log.bind(
+                        component="db_service",
+                        workflow_name=name,
+                        run_id=id
+                    ).error(f"""Error in {name} - Couldn't get cache values for run_id {id} from table {tbl.table_name} - {err.response["Error"]["Code"]}: {err.response["Error"]["Message"]}""")
+                    raise
+                for cached in response["Responses"].get(tbl.table_name, []):
+                    values[cached["cache_key"]] = cached.get("value")
+                request = response.get("UnprocessedKeys")
+        log.bind(
+            component="db_service",
+            workflow_name=name,
+            run_id=id,
+            keys=len(keys),
+            found=len(values)
+        ).info("-- Cache values fetched. --")
+        return values
+
+
+    def write(self, state: State):
+        '''
+        Conditionally writes the full state, the write only succeeds if the stored version still matches the version that was read.
+        Raises WriteConflict when another invocation wrote the state first.
+        '''
+        self._shard_new_steps(state)
+        steps = []
+        for i, step in enumerate(state.steps):
+            if isinstance(step, ParallelStep) and step.sharded:
+                # task items are written first so a stored header always has its tasks
+                if self._is_new_step(state, i) or "tasks" in step.dirty_fields():
+                    self._put_tasks(state, step)
+                else:
+                    for j, _ in step.dirty_tasks():
+                        self._update_task_item(state, step, step.task(j))
+                steps.append(step.header())
+            else:
+                steps.append(step.to_dict())
+        state_dict = {"name": state.name, "run_id": state.run_id, "steps": steps, "step_names": [step.step_name for step in state.steps], "cache_keys": list(state.cache), "status": state.status.value}
         log.bind(
             component="db_service",
             workflow_name=state.name,
             run_id=state.run_id,
             state=state_dict
         ).info(f"Writing to db...")
+        set_clauses, remove_clauses, values = self._cache_keys_update(state, force=True)
+        self._update_state(
+            state,
+            set_clauses=["steps=:steps", "step_names=:step_names", "#stat=:status"] + set_clauses,
+            remove_clauses=remove_clauses,
+            names={"#stat": "status"},
+            values={":steps": state_dict["steps"], ":step_names": state_dict["step_names"], ":status": state_dict["status"]} | values,
+            write_size=_dynamodb_size(state_dict),
+            cache_puts=state.changed_cache_keys(),
+            cache_deletes=state.cache.removed_keys(),
+        )
+
+
+    def write_delta(self, state: State):
+        '''
+        Writes only the steps fields, appended steps and status that changed since the state was read, 
+        using indexed update expressions such as `SET steps[3].completed = :v0, steps[4] = :v1`.
+        Changed cache values are written to their cache items, the state item is only updated for them when the cache's key set changed.
+        Falls back to a full write for new states or when the delta can't be expressed compactly.
+        '''
+        self._shard_new_steps(state)
+        delta = state.delta()
+        if delta is None:
+            return self.write(state)
+
+        set_clauses = []
+        remove_clauses = []
+        names = {}
+        values = {}
+
+        def name(attr: str) -> str:
+            placeholder = f"#f_{attr}"
+            names[placeholder] = attr
+            return placeholder
+
+        def value(v) -> str:
+            placeholder = f":v{len(values)}"
+            values[placeholder] = v
+            return placeholder
+
+        # tasks of sharded steps are written to their own items
+        sharded_tasks = []
+        for path, v in delta["fields"]:
+            step = state.steps[path[0]]
+            if len(path) == 4 and isinstance(step, ParallelStep) and step.sharded:
+                task = step.task(path[2])
+                if not any(t is task for _, t in sharded_tasks):
+                    sharded_tasks.append((step, task))
+                continue
+            if len(path) == 4:
+                # a task field is one element of the step's per task list, i.e. steps[3].task_completed[7]
+                expr = f"steps[{path[0]}].{name('task_' + path[3])}[{path[2]}]"
+                v = int(v)
+            else:
+                expr = f"steps[{path[0]}].{name(path[1])}"
+            set_clauses.append(f"{expr} = {value(v)}")
+        for path, n in delta["increments"]:
+            expr = f"steps[{path[0]}].{name(path[1])}"
+            set_clauses.append(f"{expr} = if_not_exists({expr}, {value(0)}) + {value(n)}")
+        # assigning past the end of a list appends, list_append would overlap with the indexed paths above
+        appended_at = len(state.steps) - len(delta["append"])
+        sharded_steps = []
+        for i, step in enumerate(delta["append"]):
+            appended = state.steps[appended_at + i]
+            if isinstance(appended, ParallelStep) and appended.sharded:
+                sharded_steps.append(appended)
+                step = appended.header()
+            set_clauses.append(f"steps[{appended_at + i}] = {value(step)}")
+        if delta["append"]:
+            # states written before step_names existed get a partial list, which read_latest() detects and falls back to a full read
+            set_clauses.append(f"step_names = list_append(if_not_exists(step_names, {value([])}), {value([step['step_name'] for step in delta['append']])})")
+        cache_set, cache_remove, cache_values = self._cache_keys_update(state)
+        set_clauses += cache_set
+        remove_clauses += cache_remove
+        values |= cache_values
+        if delta["status"] is not None:
+            names["#stat"] = "status"
+            set_clauses.append(f"#stat = {value(delta['status'])}")
+
+        if sum(len(c) + 2 for c in set_clauses + remove_clauses) > MAX_DELTA_EXPRESSION_LENGTH:
+            log.bind(
+                component="db_service",
+                workflow_name=state.name,
+                run_id=state.run_id
+            ).info("-- Delta too large for one update expression, falling back to a full write. --")
+            return self.write(state)
+
+        for step in sharded_steps:
+            self._put_tasks(state, step)
+        for step, task in sharded_tasks:
+            self._update_task_item(state, step, task)
+
+        if not set_clauses and not remove_clauses:
+            # the key set didn't change, the cache items are written without the state item, last writer wins as in a merge (see WorkflowRun._merge)
+            self._put_cache(state, list(delta["cache"]))
+            state.mark_cache_keys_clean(list(delta["cache"]))
+            log.bind(
+                component="db_service",
+                workflow_name=state.name,
+                run_id=state.run_id,
+                task_items=len(sharded_tasks),
+                cache_items=len(delta["cache"])
+            ).info("-- Nothing changed in the state item, delta write skipped. --")
+            return
+
+        log.bind(
+            component="db_service",
+            workflow_name=state.name,
+            run_id=state.run_id,
+            delta=delta
+        ).info(f"Writing delta to db...")
+        self._update_state(
+            state, set_clauses, remove_clauses, names, values, 
+            write_size=_dynamodb_size(values), cache_puts=list(delta["cache"]), cache_deletes=delta["cache_removed"]
+        )
+
+
+    def write_task(self, state: State, step_idx: int, task_idx: int) -> bool:
+        '''
+        Records a ParallelStep task's response without the version condition, which is safe because task flags only move from False to True and 
+        the step's counters are incremented in place (`SET steps[i].completed_count = steps[i].completed_count + :n`, ADD only works on top level attributes).
+        The counters the update returns include every concurrent task response, so exactly one response observes the join completing.
+        Each counter is only incremented on the condition that the task's flag is still clear in the stored state, a concurrent duplicate 
+        of the response that recorded it first makes the update fail with WriteConflict and the caller re-reads the state.
+
+        The task of a sharded step is updated in its own item first, the counters are only incremented for the flags that update flipped, 
+        which also makes redelivered responses idempotent. Cache values are written to their cache items, new keys are added to the 
+        state item's key set with `ADD cache_keys :keys`.
+        '''
+        step = state.steps[step_idx]
+        if not state.has_baseline() or step_idx >= state._loaded_steps or "tasks" in step.dirty_fields():
+            return False
+        task = step.task(task_idx)
+
+        set_clauses = []
+        conditions = []
+        names = {"#ver": "version"}
+        values = {":zero": 0, ":one": 1}
+        if step.sharded:
+            flipped = self._update_task_item(state, step, task)
+            increments = {counter: int(flag in flipped) for flag, counter in _TASK_COUNTERS}
+        else:
+            increments = {counter: getattr(step, counter) - (step.clean_value(counter) or 0) for counter in ParallelStep._counters}
+            for field in task.dirty_fields():
+                names[f"#f_{field}"] = f"task_{field}"
+                values[f":t_{field}"] = int(getattr(task, field))
+                set_clauses.append(f"steps[{step_idx}].#f_{field}[{task_idx}] = :t_{field}")
+            for flag, counter in _TASK_COUNTERS:
+                if increments[counter]:
+                    names[f"#f_{flag}"] = f"task_{flag}"
+                    conditions.append(f"steps[{step_idx}].#f_{flag}[{task_idx}] = :zero")
+        for counter in ParallelStep._counters:
+            n = increments[counter]
+            if n:
+                names[f"#f_{counter}"] = counter
+                values[f":n_{counter}"] = n
+                expr = f"steps[{step_idx}].#f_{counter}"
+                set_clauses.append(f"{expr} = if_not_exists({expr}, :zero) + :n_{counter}")
+        # cache keys are last-writer-wins, the same as when concurrent writes are merged
+        cache_keys = state.changed_cache_keys()
+        stored_keys = set(state.cache.stored_keys())
+        new_keys = {k for k in cache_keys if k not in stored_keys}
+        self._put_cache(state, cache_keys)
+        state.mark_cache_keys_clean(cache_keys)
+        add_clauses = ["#ver :one"]
+        if new_keys:
+            values[":cache_keys"] = new_keys
+            add_clauses.append("cache_keys :cache_keys")
+        if not set_clauses and not new_keys:
+            if step.sharded:
+                # the response was already recorded, the local counts it added are dropped
+                for counter in ParallelStep._counters:
+                    setattr(step, counter, step.clean_value(counter))
+                step.refresh_flags()
+            return True
+
+        tbl = self.get_table()
+        update_expression = ("SET " + ", ".join(set_clauses) + " " if set_clauses else "") + "ADD " + ", ".join(add_clauses)
+        condition = {"ConditionExpression": " AND ".join(conditions)} if conditions else {}
         try:
             response = tbl.update_item(
-                Key={"name": state_dict["name"], "run_id": state_dict["run_id"]},
-                UpdateExpression="set steps=:steps, cache=:cache, #stat=:status",
-                ExpressionAttributeNames={"#stat": "status"},
-                ExpressionAttributeValues={":steps": state_dict["steps"], ":cache": state_dict["cache"], ":status": state_dict["status"]},
+                Key={"name": state.name, "run_id": state.run_id},
+                UpdateExpression=update_expression,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues="UPDATED_NEW",
+                ReturnConsumedCapacity="TOTAL",
+                **condition,
             )
         except ClientError as err:
+            if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                log.bind(
+                    component="db_service",
+                    workflow_name=state.name,
+                    run_id=state.run_id,
+                    step_idx=step_idx,
+                    task_idx=task_idx
+                ).info("-- Task response already recorded by a concurrent write. --")
+                raise WriteConflict(state.name, state.run_id, state.version)
             log.bind(
                 component="db_service",
                 workflow_name=state.name,
                 run_id=state.run_id,
-                state=state_dict
+                update_expression=update_expression
+            ).error(f"""Error in {state.name} - Couldn't record task {task_idx} of step {step_idx} for run_id {state.run_id} to table {tbl.table_name}. {err.response["Error"]["Code"]}: {err.response["Error"]["Message"]}""")
+            raise
+
+        attributes = response["Attributes"]
+        # DynamoDB returns only the updated list elements, some emulators return the whole list
+        if returned := attributes.get("steps"):
+            stored = returned[step_idx] if len(returned) > step_idx else returned[-1]
+            for counter in ParallelStep._counters:
+                if counter in stored:
+                    setattr(step, counter, int(stored[counter]))
+        step.refresh_flags()
+        # nobody else wrote between our read and this update, the local state still matches the stored state
+        version = int(attributes["version"])
+        if version == state.version + 1:
+            state.version = version
+        task.mark_clean()
+        # the step flags are left dirty, they are written with the rest of the state when they change
+        step.mark_fields_clean(*ParallelStep._counters)
+        log.bind(
+            component="db_service",
+            workflow_name=state.name,
+            run_id=state.run_id,
+            update_expression=update_expression,
+            executed_count=step.executed_count,
+            completed_count=step.completed_count,
+            succeeded_count=step.succeeded_count,
+            consumed_wcu=response.get("ConsumedCapacity", {}).get("CapacityUnits")
+        ).info("-- Task response recorded. --")
+        return True
+
+
+    def _task_key(self, state: State, step: ParallelStep, task_id: int) -> dict:
+        return {"name": f"{state.name}#{state.run_id}", "run_id": int(step.step_id) * TASK_KEY_STRIDE + int(task_id)}
+
+
+    @staticmethod
+    def _cache_item_key(name: str, id: int, key: str) -> dict:
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        return {"name": f"{name}#{id}{CACHE_SUFFIX}", "run_id": int.from_bytes(digest, "big")}
+
+
+    def _put_cache(self, state: State, keys: list[str]):
+        '''
+        Write the values of the cache keys to their cache items, before the state item that lists them is written.
+        '''
+        if not keys:
+            return
+        tbl = self.get_table()
+        with tbl.batch_writer() as batch:
+            for k in keys:
+                batch.put_item(Item=self._cache_item_key(state.name, state.run_id, k) | {"cache_key": k, "value": state.cache.stored(k)})
+        log.bind(
+            component="db_service",
+            workflow_name=state.name,
+            run_id=state.run_id,
+            keys=len(keys)
+        ).info("-- Cache items written. --")
+
+
+    @staticmethod
+    def _cache_keys_update(state: State, force: bool = False) -> tuple[list[str], list[str], dict]:
+        '''
+        The clauses updating the state item's cache key set when it changed since the state was read (always when `force` is set).
+        The `cache` map of states stored before cache items existed is removed with it.
+        '''
+        keys = list(state.cache)
+        if not force and set(keys) == set(state.cache.stored_keys()):
+            return [], [], {}
+        if not keys:
+            # DynamoDB has no empty sets
+            return [], ["cache_keys", "cache"], {}
+        return ["cache_keys = :cache_keys"], ["cache"], {":cache_keys": set(keys)}
+
+
+    @staticmethod
+    def _is_new_step(state: State, idx: int) -> bool:
+        return not state.has_baseline() or idx >= state._loaded_steps
+
+
+    def _shard_new_steps(self, state: State):
+        '''
+        Pick the layout of the ParallelSteps that haven't been stored yet.
+        '''
+        if self.shard_threshold is None:
+            return
+        # only the steps added since the state was read, older steps of a partially read state aren't loaded
+        for step in state.steps[state._loaded_steps if state.has_baseline() else 0:]:
+            if isinstance(step, ParallelStep) and not step.sharded and step.task_count >= self.shard_threshold:
+                step.sharded = True
+
+
+    def _load_tasks(self, tbl, item: dict):
+        '''
+        Query the task items of the item's sharded steps into the step headers, tasks come back in task_id order.
+        '''
+        headers = {int(step["step_id"]): step for step in item["steps"] if step.get("sharded")}
+        tasks: dict[int, list[dict]] = {step_id: [] for step_id in headers}
+        # a strongly consistent read, a header must never be combined with an incomplete set of tasks
+        query = {"KeyConditionExpression": Key("name").eq(f"{item['name']}#{int(item['run_id'])}"), "ConsistentRead": True}
+        while True:
+            response = tbl.query(**query)
+            for task in response.get("Items", []):
+                step_id, task_id = divmod(int(task["run_id"]), TASK_KEY_STRIDE)
+                # task items of a write that lost a conflict may be left behind for steps that were never stored
+                if step_id in headers and task_id < int(headers[step_id]["task_count"]):
+                    tasks[step_id].append(task)
+            if "LastEvaluatedKey" not in response:
+                break
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        for step_id, header in headers.items():
+            if len(tasks[step_id]) != int(header["task_count"]):
+                log.bind(
+                    component="db_service",
+                    workflow_name=item["name"],
+                    run_id=item["run_id"],
+                    step_id=step_id,
+                    task_count=header["task_count"],
+                    found=len(tasks[step_id])
+                ).error("-- Task items missing for a sharded step. --")
+                raise RuntimeError(f"Sharded step {step_id} of {item['name']} run_id {item['run_id']} is missing task items")
+            header["tasks"] = tasks[step_id]
+
+
+    def _put_tasks(self, state: State, step: ParallelStep):
+        assert step.task_count <= TASK_KEY_STRIDE, f"A sharded ParallelStep can have at most {TASK_KEY_STRIDE} tasks, step {step.step_name} has {step.task_count}"
+        tbl = self.get_table()
+        # the batch writer sends 25 items per BatchWriteItem and resends unprocessed items
+        with tbl.batch_writer() as batch:
+            for j in range(step.task_count):
+                batch.put_item(Item=self._task_key(state, step, j) | step.task_record(j))
+        log.bind(
+            component="db_service",
+            workflow_name=state.name,
+            run_id=state.run_id,
+            step_id=step.step_id,
+            tasks=step.task_count
+        ).info("-- Task items written. --")
+
+
+    def _update_task_item(self, state: State, step: ParallelStep, task: Step) -> set[str]:
+        '''
+        Write a sharded task's changed fields to its item. Returns the flags this update set, flags the item already had are not included.
+        '''
+        fields = task.dirty_fields()
+        if not fields:
+            return set()
+        tbl = self.get_table()
+        try:
+            response = tbl.update_item(
+                Key=self._task_key(state, step, task.task_id),
+                UpdateExpression="SET " + ", ".join(f"#f_{field} = :f_{field}" for field in fields),
+                ExpressionAttributeNames={f"#f_{field}": field for field in fields},
+                ExpressionAttributeValues={f":f_{field}": getattr(task, field) for field in fields},
+                # the whole (small) item, some emulators leave attributes whose value didn't change out of UPDATED_OLD
+                ReturnValues="ALL_OLD",
+            )
+        except ClientError as err:
+            log.bind(
+                component="db_service",
+                workflow_name=state.name,
+                run_id=state.run_id
+            ).error(f"""Error in {state.name} - Couldn't update task {task.task_id} of step {step.step_id} for run_id {state.run_id} in table {tbl.table_name}. {err.response["Error"]["Code"]}: {err.response["Error"]["Message"]}""")
+            raise
+        old = response.get("Attributes", {})
+        task.mark_clean()
+        return {flag for flag, _ in _TASK_COUNTERS if flag in fields and getattr(task, flag) and not old.get(flag, False)}
+
+
+    def _update_state(
+            self, 
+            state: State, 
+            set_clauses: list[str], 
+            remove_clauses: list[str], 
+            names: dict, 
+            values: dict, 
+            write_size: int, 
+            cache_puts: list[str] = (), 
+            cache_deletes: list[str] = ()
+    ):
+        '''
+        Conditionally update the state item. The cache items of `cache_puts` and `cache_deletes` are written in one transaction with the update, 
+        so a write that loses a conflict doesn't change the cache either.
+        '''
+        tbl = self.get_table()
+        update_expression = "SET " + ", ".join(set_clauses + ["#ver = :next_version"])
+        if remove_clauses:
+            update_expression += " REMOVE " + ", ".join(remove_clauses)
+        update = {
+            "Key": {"name": state.name, "run_id": state.run_id},
+            "UpdateExpression": update_expression,
+            "ConditionExpression": "attribute_not_exists(#ver) OR #ver = :version",
+            "ExpressionAttributeNames": names | {"#ver": "version"},
+            "ExpressionAttributeValues": values | {":version": state.version, ":next_version": state.version + 1},
+        }
+        puts, deletes = self._transact_cache(state, cache_puts, cache_deletes)
+        try:
+            if puts or deletes:
+                response = self.conn.meta.client.transact_write_items(
+                    TransactItems=[{"Update": update | {"TableName": tbl.table_name}}]
+                        + [{"Put": {"TableName": tbl.table_name, "Item": item}} for item in puts]
+                        + [{"Delete": {"TableName": tbl.table_name, "Key": key}} for key in deletes],
+                    ReturnConsumedCapacity="TOTAL",
+                )
+            else:
+                response = tbl.update_item(**update, ReturnConsumedCapacity="TOTAL")
+        except ClientError as err:
+            reasons = err.response.get("CancellationReasons") or [{}]
+            if err.response["Error"]["Code"] == "ConditionalCheckFailedException" or reasons[0].get("Code") == "ConditionalCheckFailed":
+                log.bind(
+                    component="db_service",
+                    workflow_name=state.name,
+                    run_id=state.run_id,
+                    version=state.version
+                ).warning(f"-- Write conflict, state version {state.version} is stale. --")
+                raise WriteConflict(state.name, state.run_id, state.version)
+            log.bind(
+                component="db_service",
+                workflow_name=state.name,
+                run_id=state.run_id,
+                update_expression=update_expression
             ).error(f"""Error in {state.name} - Couldn't update state for run_id {state.run_id} to table {tbl.table_name}. {err.response["Error"]["Code"]}: {err.response["Error"]["Message"]}""")
             raise
 
         else:
+            # a transaction returns the capacity consumed per table
+            consumed = response.get("ConsumedCapacity", {})
             log.bind(
                 component="db_service",
                 workflow_name=state.name,
                 run_id=state.run_id,
-                state=state_dict
+                update_expression=update_expression,
+                write_size_bytes=write_size,
+                cache_items=len(puts) + len(deletes),
+                consumed_wcu=sum(c.get("CapacityUnits", 0) for c in consumed) if isinstance(consumed, list) else consumed.get("CapacityUnits")
                 ).info(f"Write response: {response}")
             assert response['ResponseMetadata']['HTTPStatusCode'] == 200
-            
+            state.version += 1
+            state.mark_clean()
+
+
+    def _transact_cache(self, state: State, cache_puts: list[str], cache_deletes: list[str]) -> tuple[list[dict], list[dict]]:
+        '''
+        The cache items and keys to write in the state's transaction. Items that don't fit in the transaction are written before it, 
+        the deletes that don't fit are left behind (a key that isn't in the key set is never read).
+        '''
+        puts, overflow, size = [], [], 0
+        for k in cache_puts:
+            item = self._cache_item_key(state.name, state.run_id, k) | {"cache_key": k, "value": state.cache.stored(k)}
+            size += _dynamodb_size(item)
+            if len(puts) + 1 < MAX_TRANSACT_ITEMS and size <= MAX_TRANSACT_BYTES:
+                puts.append(item)
+            else:
+                overflow.append(k)
+        if overflow:
+            log.bind(
+                component="db_service",
+                workflow_name=state.name,
+                run_id=state.run_id,
+                keys=len(overflow)
+            ).warning("-- Too many cache changes for one transaction, writing the rest ahead of it. --")
+            self._put_cache(state, overflow)
+        deletes = [self._cache_item_key(state.name, state.run_id, k) for k in cache_deletes][:MAX_TRANSACT_ITEMS - 1 - len(puts)]
+        return puts, deletes
 
     def increment_id(self, name: str) -> int:
+        '''
+        Allocates the next run_id with a single atomic `ADD` on the workflow's counter item, so concurrent triggers never share a run_id.
+        A workflow without a counter item (e.g. on a table created before run_id counters existed) has it seeded from its latest stored run on first use, 
+        running `seed_run_counters()` once ahead of time saves that first lookup.
+        When `run_id_blocks` is set, ids are served from a locally reserved block and the counter is only written once per block.
+        '''
+        if self.run_id_blocks is not None:
+            return self.run_id_blocks.next(name, lambda size: self._reserve_run_ids(name, size))
+        return self._reserve_run_ids(name, 1)
+
+
+    def _reserve_run_ids(self, name: str, size: int) -> int:
+        '''
+        Atomically add `size` to the workflow's run_id counter and return the counter's new value (the last id reserved).
+        The `ADD` requires the counter to exist, a missing counter would restart at 1 and hand out run_ids of existing runs.
+        '''
         tbl = self.get_table()
+        try:
+            try:
+                response = self._add_run_ids(tbl, name, size)
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                log.bind(
+                    component="db_service",
+                    workflow_name=name
+                ).info("-- No run_id counter found, seeding it from the latest run. --")
+                self.seed_run_counters([name])
+                response = self._add_run_ids(tbl, name, size)
+        except ClientError as err:
+            log.bind(
+                component="db_service",
+                workflow_name=name
+            ).error(f"""Error in {name} - Couldn't increment run_id counter in table {tbl.table_name} - {err.response["Error"]["Code"]}: {err.response["Error"]["Message"]}""")
+            raise
 
+        run_id = int(response["Attributes"]["next_run_id"])
         log.bind(
             component="db_service",
-            workflow=name
-        ).debug(f"DEBUG: Type of name: {type(name)}, value: {name}")
-        log.bind(
-            component="db_service",
-            workflow=name
-        ).debug(f"DEBUG: Type of table name: {type(tbl.table_name)}, value: {tbl.table_name}")
+            workflow_name=name,
+            run_id=run_id,
+            reserved=size
+        ).debug("-- run_id counter incremented. --")
+        return run_id
 
-        response = tbl.query(
-            KeyConditionExpression=Key('name').eq(name),
-            ScanIndexForward=False,  
-            Limit=1 
+
+    def _add_run_ids(self, tbl, name: str, size: int) -> dict:
+        return tbl.update_item(
+            Key=self._run_counter_key(name),
+            UpdateExpression="ADD next_run_id :inc",
+            ConditionExpression="attribute_exists(next_run_id)",
+            ExpressionAttributeValues={":inc": size},
+            ReturnValues="UPDATED_NEW",
         )
 
-        items = response.get('Items', [])
-        latest_run_id = items[0]['run_id'] if items else 0
-        return latest_run_id + 1
+
+    def seed_run_counters(self, names: list[str] | None = None) -> dict[str, int]:
+        '''
+        Migration for tables created before run_id counters existed.
+
+        Args ->
+
+            names: The workflows to seed. When omitted the SwitchboardState table is scanned for every workflow name.
+
+        Sets each workflow's counter to its highest existing run_id. Counters that are already ahead are left untouched, so this is safe to run more than once.
+        increment_id() seeds a missing counter on its own, running this ahead of time only saves each workflow's first lookup.
+        Returns the highest existing run_id found for each workflow.
+        '''
+        tbl = self.get_table()
+        latest = {}
+        if names is None:
+            scan_kwargs = {"ProjectionExpression": "#n, run_id, task_key, cache_key", "ExpressionAttributeNames": {"#n": "name"}}
+            while True:
+                response = tbl.scan(**scan_kwargs)
+                for item in response.get("Items", []):
+                    # skip run_id counters, the task items of sharded steps and cache items
+                    if item["name"].endswith(RUN_COUNTER_SUFFIX) or "task_key" in item or "cache_key" in item:
+                        continue
+                    latest[item["name"]] = max(latest.get(item["name"], 0), int(item["run_id"]))
+                if "LastEvaluatedKey" not in response:
+                    break
+                scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        else:
+            for name in names:
+                response = tbl.query(
+                    KeyConditionExpression=Key('name').eq(name),
+                    ScanIndexForward=False,  
+                    Limit=1 
+                )
+                items = response.get('Items', [])
+                latest[name] = int(items[0]['run_id']) if items else 0
+
+        for name, run_id in latest.items():
+            try:
+                tbl.update_item(
+                    Key=self._run_counter_key(name),
+                    UpdateExpression="SET next_run_id = :latest",
+                    ConditionExpression="attribute_not_exists(next_run_id) OR next_run_id < :latest",
+                    ExpressionAttributeValues={":latest": run_id},
+                )
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+            log.bind(
+                component="db_service",
+                workflow_name=name,
+                run_id=run_id
+            ).info("-- run_id counter seeded. --")
+        return latest
 
 
     def get_endpoint(self, name: str, component: SwitchboardComponent) -> str:
@@ -218,7 +1213,7 @@ class AWS_DataInterface(DBInterface):
                 workflow_name=name,
                 switchboard_component=component
             ).error(f"No entry found for name={name}, component={component} in {tbl.table_name}")
-            raise 
+            raise EndpointNotFound(name, component)
 
         resource = Resource(**item)
         log.bind(
@@ -234,11 +1229,49 @@ class AWS_DataInterface(DBInterface):
 
 
 
-    # dynamodb specific helper function
+    def get_endpoints(self, name: str) -> dict[SwitchboardComponent, str]:
+        '''
+        Args ->
+
+            name: The name of the workflow.
+
+        Retrieves every SwitchboardComponent's endpoint for the given workflow with a single BatchGetItem call.
+        Components with no entry are left out of the returned mapping.
+        '''
+        table_name = TableName.SwitchboardResources.value
+        request = {table_name: {"Keys": [{"component": c.value, "name": name} for c in SwitchboardComponent]}}
+        items = []
+        try:
+            while request:
+                resp = self.conn.batch_get_item(RequestItems=request)
+                items.extend(resp.get("Responses", {}).get(table_name, []))
+                request = resp.get("UnprocessedKeys")
+        except ClientError as err:
+            log.bind(
+                component="db_service",
+                workflow_name=name
+            ).error(f""" Error - Couldn't get {name} endpoints from table {table_name} - {err.response["Error"]["Code"]}: {err.response["Error"]["Message"]}""")
+            raise
+
+        endpoints = {SwitchboardComponent(item["component"]): item["url"] for item in items}
+        log.bind(
+            component="db_service",
+            workflow_name=name,
+            endpoints={c.value: url for c, url in endpoints.items()}
+        ).info(f"-- Retrieved {len(endpoints)} endpoints. --")
+        return endpoints
+
+
+
+    # dynamodb specific helper functions
     def get_table(self, table=TableName.SwitchboardState):
         tbl = self.conn.Table(table.value)
         return tbl
 
+    @staticmethod
+    def _run_counter_key(name: str) -> dict:
+        return {"name": f"{name}{RUN_COUNTER_SUFFIX}", "run_id": 0}
+
 
 
 # class GCP_DataInterface(DBInterface):
@@ -263,18 +1296,45 @@ class AWS_DataInterface(DBInterface):
 #         pass
 
 
+# Exceptions
+class EndpointNotFound(Exception):
+    def __init__(self, name: str, component: SwitchboardComponent):
+        self.message = f"No {component.value} endpoint registered for workflow {name}"
+        super().__init__(self.message)
+        self.name = name
+        self.component = component
+
+    def __str__(self):
+        return f"EndpointNotFound Error: {self.message}"
+
+
+
+class WriteConflict(Exception):
+    def __init__(self, name: str, run_id: int, version: int):
+        self.message = f"State for {name} run_id {run_id} was modified after version {version} was read"
+        super().__init__(self.message)
+        self.name = name
+        self.run_id = run_id
+        self.version = version
+
+    def __str__(self):
+        return f"WriteConflict Error: {self.message}"
+
+
+
 # SDK database interface initializer
 class DB():
     '''
     Class for establishing a connection for switchboard to interface with. switchboard comes with a default interface for each cloud provider.
     Use the custom_interface arg to pass in your own custom interface.
+    Use the run_id_blocks arg to reserve run_ids in blocks per container (see RunIdBlocks), it is ignored for custom interfaces.
     '''
-    def __init__(self, cloud: Cloud, custom_interface: DBInterface | None = None) -> None:
+    def __init__(self, cloud: Cloud, custom_interface: DBInterface | None = None, run_id_blocks: RunIdBlocks | None = None) -> None:
         def _connect(cloud: Cloud) -> DBInterface:
             match cloud:
                 case Cloud.AWS:
                     conn = AWS_db_connect()
-                    return AWS_DataInterface(conn)
+                    return AWS_DataInterface(conn, run_id_blocks=run_id_blocks)
                 # case Cloud.GCP:
                 #     conn = GCP_db_connect()
                 #     return GCP_DataInterface(conn)
@@ -1,9 +1,14 @@
+import asyncio
+import inspect
+import json
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable
 
-from switchboard.response import Response
+from switchboard.response import Response, send_batch, send_batch_async
+from .claim_check import resolve
 from .db import DBInterface
 from .enums import Cloud, SwitchboardComponent
-from .invocation import QueuePush
+from .invocation import QueuePush, QueuePushAsync, QueuePushBatch, QueuePushBatchAsync
 from .schemas import Context, Task
 from .logging_config import log
 
@@ -15,14 +20,80 @@ from .logging_config import log
 
 
 
-def push_to_executor(cloud: Cloud, db: DBInterface, name: str, body: str, custom_execution_queue: Callable | None = None) -> dict:
+# Endpoints prefetched by InitExecutor, keyed by workflow name
+EXECUTOR_ENDPOINTS: dict[str, dict[SwitchboardComponent, str]] = {}
 
-    ep = db.get_endpoint(name, SwitchboardComponent.ExecutorQueue)
+# Default number of tasks switchboard_execute_batch runs at once, the largest SQS batch is 10 messages
+EXECUTOR_MAX_WORKERS = 10
+
+# Default number of tasks the async executor awaits at once on the event loop
+EXECUTOR_MAX_CONCURRENCY = 100
+
+
+def InitExecutor(db: DBInterface, name: str) -> dict[SwitchboardComponent, str]:
+    '''
+    Load every endpoint registered for the workflow `name` in one read so the executor (and any Response created for it) doesn't need a resource-table read per task.
+    Call this once outside of your handler to do the work during the container's cold start.
+    '''
+    endpoints = db.get_endpoints(name)
+    EXECUTOR_ENDPOINTS[name] = endpoints
+    log.bind(
+        component="executor_service",
+        workflow_name=name,
+        endpoints={c.value: url for c, url in endpoints.items()}
+    ).info("-- Executor endpoints prefetched. --")
+    return endpoints
+
+
+def push_to_executor(cloud: Cloud, db: DBInterface, name: str, body: str, custom_execution_queue: Callable | None = None, endpoint: str | None = None) -> dict:
+
+    ep = endpoint or db.get_endpoint(name, SwitchboardComponent.ExecutorQueue)
 
     response = QueuePush(cloud, ep, body, custom_execution_queue)
     return response
 
 
+def push_to_executor_batch(
+        cloud: Cloud, 
+        db: DBInterface, 
+        name: str, 
+        bodies: list[str], 
+        custom_execution_queue: Callable | None = None, 
+        custom_execution_queue_batch: Callable | None = None,
+        endpoint: str | None = None
+) -> dict:
+
+    ep = endpoint or db.get_endpoint(name, SwitchboardComponent.ExecutorQueue)
+
+    response = QueuePushBatch(cloud, ep, bodies, custom_execution_queue, custom_execution_queue_batch)
+    return response
+
+
+
+async def push_to_executor_async(cloud: Cloud, db: DBInterface, name: str, body: str, custom_execution_queue: Callable | None = None, endpoint: str | None = None) -> dict:
+
+    ep = endpoint or await asyncio.to_thread(db.get_endpoint, name, SwitchboardComponent.ExecutorQueue)
+
+    response = await QueuePushAsync(cloud, ep, body, custom_execution_queue)
+    return response
+
+
+async def push_to_executor_batch_async(
+        cloud: Cloud, 
+        db: DBInterface, 
+        name: str, 
+        bodies: list[str], 
+        custom_execution_queue: Callable | None = None, 
+        custom_execution_queue_batch: Callable | None = None,
+        endpoint: str | None = None
+) -> dict:
+
+    ep = endpoint or await asyncio.to_thread(db.get_endpoint, name, SwitchboardComponent.ExecutorQueue)
+
+    response = await QueuePushBatchAsync(cloud, ep, bodies, custom_execution_queue, custom_execution_queue_batch)
+    return response
+
+
 
 # The switchboard executor function will be wrapped in a simple serverless function call.
 # It is important to note that the executor function will vary based on the cloud provider used.
@@ -32,7 +103,8 @@ def switchboard_execute(
         db: DBInterface,
         context: dict,
         task_map: dict[str, Task],
-        custom_invocation_queue: Callable | None = None
+        custom_invocation_queue: Callable | None = None,
+        ack: bool = True
 ) -> int:
     '''
     Switchboard's execution function for use by the executor.
@@ -53,6 +125,14 @@ def switchboard_execute(
 
     The context passed to the executor will have one additonal field -
       'task_key': the task that should be executed, this correspond to a key in `task_map` - str
+
+    acknowledgement:
+      By default the executor sends an `executed` response before running the task, so the workflow knows the task started.
+      Pass `ack=False` (or set `Task.ack=False` for a single task) to skip it and only send the task's completion response,
+      this halves the invocation queue messages and workflow invocations per task. The completion response marks the task executed.
+
+    async tasks:
+      A task's `execute` can be an `async def` function, it runs on a new event loop. Use `switchboard_execute_async` from async code.
     '''
 
     if (task_key := context['task_key']) in task_map:
@@ -69,17 +149,268 @@ def switchboard_execute(
 
         # all functions passed into tasks inside of the task_map should take 
         # the raw context as an argument and return a valid status code
-        cntxt = Context(**context)
+        cntxt = resolve(Context.from_dict(context))
         cntxt.executed = True
 
-        executor_response = Response(cloud, db, context['workflow'], cntxt, custom_queue_push=custom_invocation_queue)
-        executor_response.send()
+        if ack and task.ack:
+            endpoint = EXECUTOR_ENDPOINTS.get(context['workflow'], {}).get(SwitchboardComponent.InvocationQueue)
+            executor_response = Response(cloud, db, context['workflow'], cntxt, custom_queue_push=custom_invocation_queue, endpoint=endpoint)
+            executor_response.send()
         
         # tasks take a Context object as an argument
-        task_response = task.execute(cntxt)
+        task_response = _run_task(task, cntxt)
         return task_response
     else:
         return 404
 
 
 
+def _run_task(task: Task, cntxt: Context):
+    # async tasks run to completion on their own event loop, one per thread when called from the batch thread pool
+    task_response = task.execute(cntxt)
+    if inspect.isawaitable(task_response):
+        task_response = asyncio.run(_await(task_response))
+    return task_response
+
+
+async def _await(awaitable):
+    return await awaitable
+
+
+async def _run_task_async(task: Task, cntxt: Context):
+    # sync tasks run in a worker thread so they don't block the event loop
+    if inspect.iscoroutinefunction(task.execute):
+        return await task.execute(cntxt)
+    task_response = await asyncio.to_thread(task.execute, cntxt)
+    if inspect.isawaitable(task_response):
+        task_response = await task_response
+    return task_response
+
+
+def _parse_records(records: list[dict], task_map: dict[str, Task]) -> tuple[list[tuple[str | None, Task, Context]], list[str | None]]:
+    '''
+    Returns a (message_id, task, context) job for every record whose task is in `task_map`, and the message ids of the records that couldn't be parsed.
+    '''
+    failures = []
+    jobs = []
+    for record in records:
+        message_id = record.get("messageId")
+        try:
+            context = json.loads(record["body"])
+            task_key = context.pop("task_key")
+            cntxt = resolve(Context.from_dict(context))
+        except (KeyError, TypeError, ValueError) as err:
+            log.bind(
+                component="executor_service",
+                message_id=message_id,
+                error=str(err)
+            ).error("-- Invalid task context in batch record. --")
+            failures.append(message_id)
+            continue
+
+        if task_key not in task_map:
+            log.bind(
+                component="executor_service",
+                workflow_name=cntxt.workflow,
+                message_id=message_id,
+                task_key=task_key
+            ).error("-- Task not found in task_map. --")
+            continue
+
+        cntxt.executed = True
+        jobs.append((message_id, task_map[task_key], cntxt))
+    return jobs, failures
+
+
+def _ack_responses(cloud: Cloud, db: DBInterface, acks: list[tuple[str | None, Task, Context]], custom_invocation_queue: Callable | None) -> list[Response]:
+    return [
+        Response(
+            cloud, 
+            db, 
+            cntxt.workflow, 
+            cntxt, 
+            custom_queue_push=custom_invocation_queue, 
+            endpoint=EXECUTOR_ENDPOINTS.get(cntxt.workflow, {}).get(SwitchboardComponent.InvocationQueue)
+        ) 
+        for _, _, cntxt in acks
+    ]
+
+
+def _acknowledged(
+        jobs: list[tuple[str | None, Task, Context]], 
+        acks: list[tuple[str | None, Task, Context]], 
+        delivered: list[bool]
+) -> tuple[list[tuple[str | None, Task, Context]], list[str | None]]:
+    # a task only runs once the workflow can be told it started
+    undelivered = [job for job, ok in zip(acks, delivered) if not ok]
+    return [job for job in jobs if not any(job is failed for failed in undelivered)], [message_id for message_id, _, _ in undelivered]
+
+
+def _acknowledge(
+        cloud: Cloud, 
+        db: DBInterface, 
+        jobs: list[tuple[str | None, Task, Context]], 
+        custom_invocation_queue: Callable | None, 
+        custom_invocation_queue_batch: Callable | None
+) -> tuple[list[tuple[str | None, Task, Context]], list[str | None]]:
+    '''
+    Send the executed acknowledgement of every job whose task wants one. Returns the jobs that can run and the message ids of the jobs whose acknowledgement failed.
+    '''
+    acks = [job for job in jobs if job[1].ack]
+    if not acks:
+        return jobs, []
+    responses = _ack_responses(cloud, db, acks, custom_invocation_queue)
+    return _acknowledged(jobs, acks, send_batch(responses, custom_invocation_queue_batch))
+
+
+async def _acknowledge_async(
+        cloud: Cloud, 
+        db: DBInterface, 
+        jobs: list[tuple[str | None, Task, Context]], 
+        custom_invocation_queue: Callable | None, 
+        custom_invocation_queue_batch: Callable | None
+) -> tuple[list[tuple[str | None, Task, Context]], list[str | None]]:
+    acks = [job for job in jobs if job[1].ack]
+    if not acks:
+        return jobs, []
+    # creating a Response may look up the invocation queue's endpoint
+    responses = await asyncio.to_thread(_ack_responses, cloud, db, acks, custom_invocation_queue)
+    return _acknowledged(jobs, acks, await send_batch_async(responses, custom_invocation_queue_batch))
+
+
+def _batch_response(records: list[dict], executed: int, failures: list[str | None]) -> dict:
+    log.bind(
+        component="executor_service",
+        records=len(records),
+        executed=executed,
+        failures=len(failures)
+    ).info("-- Executor batch processed. --")
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]}
+
+
+def switchboard_execute_batch(
+        cloud: Cloud, 
+        db: DBInterface,
+        records: list[dict],
+        task_map: dict[str, Task],
+        custom_invocation_queue: Callable | None = None,
+        custom_invocation_queue_batch: Callable | None = None,
+        ack: bool = True,
+        max_workers: int = EXECUTOR_MAX_WORKERS
+) -> dict:
+    '''
+    Batched counterpart of `switchboard_execute`, runs every task context in `records` (e.g. the `Records` of an SQS event) in one invocation.
+
+    The executed acknowledgements of all tasks are sent together (see `send_batch`), then the tasks run concurrently on a thread pool of 
+    at most `max_workers` threads, which suits tasks that mostly wait on I/O. `custom_invocation_queue_batch` receives the acknowledgement bodies for custom queues.
+
+    Returns the SQS partial batch response, `{"batchItemFailures": [{"itemIdentifier": messageId}]}`, listing the records that couldn't be parsed, 
+    whose acknowledgement couldn't be sent, or whose task raised. Records for a task_key missing from `task_map` are logged and dropped, as `switchboard_execute` returns 404 for them.
+    Set `ReportBatchItemFailures` on the queue's event source mapping so only the failed records are retried.
+    '''
+    jobs, failures = _parse_records(records, task_map)
+    if ack:
+        jobs, undelivered = _acknowledge(cloud, db, jobs, custom_invocation_queue, custom_invocation_queue_batch)
+        failures.extend(undelivered)
+
+    if jobs:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as pool:
+            # tasks take a Context object as an argument
+            futures = [(message_id, task, pool.submit(_run_task, task, cntxt)) for message_id, task, cntxt in jobs]
+            for message_id, task, future in futures:
+                try:
+                    future.result()
+                except Exception as err:
+                    log.bind(
+                        component="executor_service",
+                        message_id=message_id,
+                        task=task.name,
+                        error=str(err)
+                    ).exception("-- Task raised, its record will be retried. --")
+                    failures.append(message_id)
+
+    return _batch_response(records, len(jobs), failures)
+
+
+async def switchboard_execute_async(
+        cloud: Cloud, 
+        db: DBInterface,
+        context: dict,
+        task_map: dict[str, Task],
+        custom_invocation_queue: Callable | None = None,
+        ack: bool = True,
+        timeout: float | None = None
+) -> int:
+    '''
+    Awaitable counterpart of `switchboard_execute` for async handlers. `async def` tasks are awaited on the running event loop, sync tasks run in a worker thread.
+    The task is cancelled after `Task.timeout` (or `timeout`) seconds, raising TimeoutError.
+    '''
+    if context['task_key'] not in task_map:
+        return 404
+    jobs, _ = _parse_records([{"body": json.dumps(context)}], task_map)
+    responses, _ = await _execute_async(cloud, db, jobs, custom_invocation_queue, None, ack, 1, timeout, raise_errors=True)
+    # the task doesn't run when its acknowledgement couldn't be sent
+    return responses[0] if responses else 500
+
+
+async def switchboard_execute_batch_async(
+        cloud: Cloud, 
+        db: DBInterface,
+        records: list[dict],
+        task_map: dict[str, Task],
+        custom_invocation_queue: Callable | None = None,
+        custom_invocation_queue_batch: Callable | None = None,
+        ack: bool = True,
+        max_concurrency: int = EXECUTOR_MAX_CONCURRENCY,
+        timeout: float | None = None
+) -> dict:
+    '''
+    Async counterpart of `switchboard_execute_batch`. Every task runs concurrently on the running event loop, `async def` tasks are awaited directly 
+    and sync tasks run in a worker thread. At most `max_concurrency` tasks run at once and each task is cancelled after `Task.timeout` 
+    (or `timeout`) seconds, which counts as a failure. The acknowledgements are sent with `send_batch_async` so they don't block the loop.
+
+    Returns the same partial batch response as `switchboard_execute_batch`.
+    '''
+    jobs, failures = _parse_records(records, task_map)
+    responses, failed = await _execute_async(cloud, db, jobs, custom_invocation_queue, custom_invocation_queue_batch, ack, max_concurrency, timeout)
+    return _batch_response(records, len(responses), failures + failed)
+
+
+async def _execute_async(
+        cloud: Cloud, 
+        db: DBInterface,
+        jobs: list[tuple[str | None, Task, Context]],
+        custom_invocation_queue: Callable | None,
+        custom_invocation_queue_batch: Callable | None,
+        ack: bool,
+        max_concurrency: int,
+        timeout: float | None,
+        raise_errors: bool = False
+) -> tuple[list, list[str | None]]:
+    '''
+    Acknowledge and run the jobs, returning the task return values (None for failed tasks) and the message ids of the failed jobs.
+    '''
+    failures = []
+    if ack:
+        jobs, undelivered = await _acknowledge_async(cloud, db, jobs, custom_invocation_queue, custom_invocation_queue_batch)
+        failures.extend(undelivered)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(message_id: str | None, task: Task, cntxt: Context):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(_run_task_async(task, cntxt), task.timeout or timeout)
+            except Exception as err:
+                if raise_errors:
+                    raise
+                log.bind(
+                    component="executor_service",
+                    message_id=message_id,
+                    task=task.name,
+                    error=repr(err)
+                ).exception("-- Task failed, its record will be retried. --")
+                failures.append(message_id)
+
+    responses = await asyncio.gather(*(run(*job) for job in jobs))
+    return list(responses), failures
@@ -1,15 +1,45 @@
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable
 
 from .db import DBInterface
 from .cloud import (
+    AWS_SQS_CONFIG,
     AWS_message_push,
+    AWS_message_push_batch,
     GCP_message_push, 
-    AZURE_message_push
+    GCP_message_push_batch, 
+    AZURE_message_push,
+    AZURE_message_push_batch
 )
 from .enums import Cloud, SwitchboardComponent
 
 
 
+# Blocking cloud SDK pushes made by the async API run here, sized to the SQS client's connection pool so a push never waits on a connection
+_PUSH_POOL = ThreadPoolExecutor(max_workers=AWS_SQS_CONFIG.max_pool_connections, thread_name_prefix="switchboard-push")
+
+
+
+def _resolve(result):
+    # custom push functions may be coroutine functions, the sync API runs them to completion
+    if not inspect.isawaitable(result):
+        return result
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_await(result))
+    # called from a coroutine, which blocks its event loop until the push is done (the *_async variants don't),
+    # asyncio.run can't start a loop in a thread that runs one so the push gets a loop of its own on the push pool
+    return _PUSH_POOL.submit(asyncio.run, _await(result)).result()
+
+
+async def _await(awaitable):
+    return await awaitable
+
+
+
 def QueuePush(cloud: Cloud, endpoint: str, body: str, custom_queue_push: Callable | None = None) -> dict:
     '''
     Interface for interacting with the switchboard invocation and execution queues.
@@ -23,7 +53,55 @@ def QueuePush(cloud: Cloud, endpoint: str, body: str, custom_queue_push: Callabl
             return AZURE_message_push(body)
         case Cloud.CUSTOM:
             assert custom_queue_push is not None, "Custom queue indicated but no queue push function provided!"
-            return custom_queue_push(body)
+            return _resolve(custom_queue_push(body))
+
+
+
+def QueuePushBatch(cloud: Cloud, endpoint: str, bodies: list[str], custom_queue_push: Callable | None = None, custom_queue_push_batch: Callable | None = None) -> dict:
+    '''
+    Batched counterpart of QueuePush. Used to fan out many messages to the same queue with as few round trips as possible.
+    
+    For custom queues `custom_queue_push_batch` receives the full list of bodies, when it is not provided each body is pushed individually with `custom_queue_push`.
+    '''
+    match cloud:
+        case Cloud.AWS:
+            return AWS_message_push_batch(endpoint, bodies)
+        case Cloud.GCP:
+            return GCP_message_push_batch(bodies)
+        case Cloud.AZURE:
+            return AZURE_message_push_batch(bodies)
+        case Cloud.CUSTOM:
+            if custom_queue_push_batch is not None:
+                return _resolve(custom_queue_push_batch(bodies))
+            assert custom_queue_push is not None, "Custom queue indicated but no queue push function provided!"
+            return {"Successful": [_resolve(custom_queue_push(body)) for body in bodies], "Failed": []}
+
+
+
+async def QueuePushAsync(cloud: Cloud, endpoint: str, body: str, custom_queue_push: Callable | None = None) -> dict:
+    '''
+    Awaitable counterpart of QueuePush. Cloud SDK pushes run on a bounded thread pool so many pushes can be awaited at once without blocking the event loop,
+    custom queue push functions may be coroutine functions.
+    '''
+    if cloud is Cloud.CUSTOM:
+        assert custom_queue_push is not None, "Custom queue indicated but no queue push function provided!"
+        result = custom_queue_push(body)
+        return await result if inspect.isawaitable(result) else result
+    return await asyncio.get_running_loop().run_in_executor(_PUSH_POOL, QueuePush, cloud, endpoint, body)
+
+
+
+async def QueuePushBatchAsync(cloud: Cloud, endpoint: str, bodies: list[str], custom_queue_push: Callable | None = None, custom_queue_push_batch: Callable | None = None) -> dict:
+    '''
+    Awaitable counterpart of QueuePushBatch, see QueuePushAsync. Without a custom batch function the bodies are pushed concurrently.
+    '''
+    if cloud is Cloud.CUSTOM:
+        if custom_queue_push_batch is not None:
+            result = custom_queue_push_batch(bodies)
+            return await result if inspect.isawaitable(result) else result
+        responses = await asyncio.gather(*(QueuePushAsync(cloud, endpoint, body, custom_queue_push) for body in bodies))
+        return {"Successful": list(responses), "Failed": []}
+    return await asyncio.get_running_loop().run_in_executor(_PUSH_POOL, QueuePushBatch, cloud, endpoint, bodies)
 
 
 
@@ -35,3 +113,25 @@ def discover_invocation_endpoint(db: DBInterface, name: str) -> str:
 
 
 
+
+
+
+def raise_on_failed_entries(name: str, resp) -> None:
+    '''
+    Batch pushes report the entries that were still rejected after retries in `Failed`, raise so the invocation fails and its message is redelivered.
+    '''
+    if isinstance(resp, dict) and resp.get("Failed"):
+        raise EnqueueFailed(name, resp["Failed"])
+
+
+
+# Exceptions
+class EnqueueFailed(Exception):
+    def __init__(self, name: str, failed: list):
+        self.message = f"{len(failed)} executor messages for workflow {name} could not be enqueued"
+        super().__init__(self.message)
+        self.name = name
+        self.failed = failed
+
+    def __str__(self):
+        return f"EnqueueFailed Error: {self.message}"
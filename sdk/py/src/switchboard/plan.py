@@ -0,0 +1,364 @@
+import ast
+import functools
+import inspect
+import sys
+import textwrap
+import types
+from dataclasses import dataclass
+from typing import Callable
+
+from .enums import StepType
+from .logging_config import log
+from .workflow import CURRENT_RUN, Call, Done, DoneAsync, ParallelCall, WorkflowRun
+
+
+
+
+# Process-wide plan counters
+#   compiled - workflow functions compiled to a plan
+#   fallbacks - workflow functions that could not be compiled and are replayed
+#   jumps - invocations that started at the run's current step
+#   walks - invocations that walked the plan from its first step (new runs, or a current step the plan doesn't know)
+PLAN_STATS = {"compiled": 0, "fallbacks": 0, "jumps": 0, "walks": 0}
+
+# index of the node after the last one
+_END = -1
+
+# FunctionDef only has type_params (and requires it) from Python 3.12 on
+_FUNCTION_DEF_FIELDS = {"type_params": []} if sys.version_info >= (3, 12) else {}
+
+
+
+class PlanError(Exception):
+    """
+    Raised when a workflow function can't be compiled to a static plan.
+    """
+    def __init__(self, message: str) -> None:
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self) -> str:
+        return f"Plan Error: {self.message}"
+
+
+
+@dataclass(slots=True)
+class StepNode:
+    type: StepType
+    step_name: str
+    # evaluates to the (args, kwargs) the step's Call() or ParallelCall() is made with
+    args: types.CodeType
+    next: int
+
+
+@dataclass(slots=True)
+class BranchNode:
+    test: types.CodeType
+    then: int
+    orelse: int
+
+
+@dataclass(slots=True)
+class ExprNode:
+    # an expression statement between steps, e.g. a print() or a log call
+    expr: types.CodeType
+    next: int
+
+
+@dataclass(slots=True)
+class WorkflowPlan:
+    """
+    A workflow function compiled to the statements that run before its first step (`prefix`),
+    a graph of step nodes joined by conditional edges, and the Done() call that ends it.
+    """
+    prefix: types.FunctionType
+    nodes: list[StepNode | BranchNode | ExprNode]
+    entry: int
+    steps: dict[str, int]
+    returns_status: bool
+    freevars: tuple[str, ...]
+
+
+def _args(*args, **kwargs) -> tuple[tuple, dict]:
+    return args, kwargs
+
+
+
+def compiled_workflow(workflow_fn: Callable) -> Callable:
+    '''
+    Decorator that runs a workflow function from a static plan instead of replaying it from the top on every invocation.
+
+    The first time the function is called it is compiled to a plan of its steps and the conditions between them, which is cached for the life of the container.
+    Each invocation then runs the statements before the first step (InitWorkflow(), SetCustomExecutorQueue(), reading the cache, ...),
+    jumps straight to the run's current step and only evaluates the conditions between it and the next step.
+
+    A function can be compiled when, after the statements before its first step, it only contains
+        - Call() and ParallelCall() statements with a literal step name
+        - `if` statements whose conditions don't call switchboard functions, containing more of the same
+        - expression statements that don't call switchboard functions or assign, e.g. print() or log calls. 
+          They run when an invocation passes them, not for every completed step before the run's current one as with replay
+        - a final `Done()` or `return Done()`
+    Anything else (loops, assignments between steps, early returns, async functions, comprehensions or lambdas reading the function's variables, ...)
+    can't be planned statically and the function is replayed as usual.
+    '''
+    compiled = False
+
+    @functools.wraps(workflow_fn)
+    def run_plan(*args, **kwargs):
+        nonlocal compiled
+        if not compiled:
+            compiled = True
+            try:
+                run_plan.plan = _compile(workflow_fn)
+                PLAN_STATS["compiled"] += 1
+            except PlanError as err:
+                PLAN_STATS["fallbacks"] += 1
+                log.bind(
+                    component="workflow_plan",
+                    workflow_fn=workflow_fn.__qualname__,
+                    reason=err.message
+                ).info("-- Workflow can't be planned statically, it will be replayed. --")
+        if run_plan.plan is None:
+            return workflow_fn(*args, **kwargs)
+        return _execute(run_plan.plan, workflow_fn, args, kwargs)
+
+    # the compiled WorkflowPlan, None until the first call or when the function is replayed
+    run_plan.plan = None
+    return run_plan
+
+
+
+def _execute(plan: WorkflowPlan, workflow_fn: Callable, args: tuple, kwargs: dict):
+    namespace = {name: cell.cell_contents for name, cell in zip(plan.freevars, workflow_fn.__closure__ or ())}
+    namespace.update(plan.prefix(*args, **kwargs))
+    namespace["__sb_args__"] = _args
+
+    run = CURRENT_RUN.get()
+    node = plan.entry
+    if isinstance(run, WorkflowRun) and run.curr_step is not None and run.curr_step.step_name in plan.steps:
+        # every step before the current one is done, the run picks up where replay would reach it
+        node = plan.steps[run.curr_step.step_name]
+        run.step_cnt = run.step_idx
+        PLAN_STATS["jumps"] += 1
+    else:
+        PLAN_STATS["walks"] += 1
+
+    while node != _END and not _waiting():
+        match plan.nodes[node]:
+            case BranchNode(test=test, then=then, orelse=orelse):
+                node = then if eval(test, workflow_fn.__globals__, namespace) else orelse
+            case ExprNode(expr=expr, next=next_node):
+                eval(expr, workflow_fn.__globals__, namespace)
+                node = next_node
+            case StepNode(type=step_type, args=step_args, next=next_node):
+                a, k = eval(step_args, workflow_fn.__globals__, namespace)
+                if step_type is StepType.Parallel:
+                    ParallelCall(*a, **k)
+                else:
+                    Call(*a, **k)
+                node = next_node
+
+    status = Done()
+    return status if plan.returns_status else None
+
+
+def _waiting() -> bool:
+    return not isinstance(CURRENT_RUN.get(), WorkflowRun)
+
+
+
+def _compile(workflow_fn: Callable) -> WorkflowPlan:
+    if inspect.iscoroutinefunction(workflow_fn):
+        raise PlanError("async workflow functions are replayed")
+    try:
+        source = textwrap.dedent(inspect.getsource(workflow_fn))
+    except (OSError, TypeError) as err:
+        raise PlanError(f"source unavailable: {err}")
+
+    fn_def = next((node for node in ast.parse(source).body if isinstance(node, ast.FunctionDef)), None)
+    if fn_def is None or fn_def.name != workflow_fn.__name__:
+        raise PlanError("the workflow function's definition was not found in its source")
+    ast.increment_lineno(fn_def, workflow_fn.__code__.co_firstlineno - fn_def.lineno)
+
+    resolver = _Resolver(workflow_fn)
+    body = fn_def.body
+    if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) and isinstance(body[0].value.value, str):
+        body = body[1:] # docstring
+
+    start = next((i for i, stmt in enumerate(body) if resolver.calls_step(stmt)), None)
+    if start is None:
+        raise PlanError("no Call() or ParallelCall() found")
+    prefix, steps, last = body[:start], body[start:-1], body[-1]
+
+    for stmt in prefix:
+        if resolver.calls_done(stmt) or any(isinstance(node, ast.Return) for node in ast.walk(stmt)):
+            raise PlanError(f"line {stmt.lineno}: the workflow can end before its first step")
+
+    match last:
+        case ast.Expr(value=ast.Call() as done) | ast.Return(value=ast.Call() as done) if resolver.resolve(done.func) is Done and not (done.args or done.keywords):
+            returns_status = isinstance(last, ast.Return)
+        case _:
+            raise PlanError(f"line {last.lineno}: the workflow has to end with `Done()` or `return Done()`")
+
+    nodes: list[StepNode | BranchNode | ExprNode] = []
+    step_index: dict[str, int] = {}
+    entry = _compile_block(steps, _END, nodes, step_index, resolver, workflow_fn)
+
+    return WorkflowPlan(_compile_prefix(fn_def, prefix, workflow_fn), nodes, entry, step_index, returns_status, workflow_fn.__code__.co_freevars)
+
+
+def _compile_block(
+        stmts: list[ast.stmt],
+        next_node: int,
+        nodes: list[StepNode | BranchNode | ExprNode],
+        step_index: dict[str, int],
+        resolver: "_Resolver",
+        workflow_fn: Callable
+) -> int:
+    '''
+    Add the nodes of a block of statements, built back to front so every node knows its successor. Returns the block's first node.
+    '''
+    filename = workflow_fn.__code__.co_filename
+    for stmt in reversed(stmts):
+        match stmt:
+            case ast.Pass():
+                continue
+            case ast.Expr(value=ast.Call() as call) if (step_type := resolver.step_type(call.func)) is not None:
+                step_name = call.args[0] if call.args else next((kw.value for kw in call.keywords if kw.arg == "step_name"), None)
+                if not (isinstance(step_name, ast.Constant) and isinstance(step_name.value, str)):
+                    raise PlanError(f"line {stmt.lineno}: step names have to be string literals")
+                if step_name.value in step_index:
+                    raise PlanError(f"line {stmt.lineno}: step `{step_name.value}` is called more than once")
+                if any(resolver.calls_switchboard(arg) for arg in [*call.args, *(kw.value for kw in call.keywords)]):
+                    raise PlanError(f"line {stmt.lineno}: step arguments can't call switchboard functions")
+                _check_nested_scopes(stmt, call, resolver)
+                args = ast.Expression(ast.Call(ast.Name("__sb_args__", ast.Load()), call.args, call.keywords))
+                ast.copy_location(args.body, call)
+                ast.fix_missing_locations(args)
+                nodes.append(StepNode(step_type, step_name.value, compile(args, filename, "eval"), next_node))
+                step_index[step_name.value] = len(nodes)-1
+            case ast.If(test=test, body=body, orelse=orelse):
+                if resolver.calls_switchboard(test):
+                    raise PlanError(f"line {stmt.lineno}: conditions can't call switchboard functions")
+                _check_nested_scopes(stmt, test, resolver)
+                then = _compile_block(body, next_node, nodes, step_index, resolver, workflow_fn)
+                other = _compile_block(orelse, next_node, nodes, step_index, resolver, workflow_fn)
+                nodes.append(BranchNode(compile(ast.Expression(test), filename, "eval"), then, other))
+            case ast.Expr(value=value) if not resolver.calls_switchboard(value) and not any(isinstance(node, ast.NamedExpr) for node in ast.walk(value)):
+                _check_nested_scopes(stmt, value, resolver)
+                nodes.append(ExprNode(compile(ast.Expression(value), filename, "eval"), next_node))
+            case _:
+                raise PlanError(f"line {stmt.lineno}: `{ast.unparse(stmt).splitlines()[0]}` can't be planned statically")
+        next_node = len(nodes)-1
+    return next_node
+
+
+def _check_nested_scopes(stmt: ast.stmt, expr: ast.expr, resolver: "_Resolver"):
+    # plan expressions are evaluated with the workflow function's variables as a separate locals mapping, which
+    # generator expressions, comprehensions and lambdas can't see, they would only find globals of the same name
+    if names := resolver.nested_locals(expr):
+        raise PlanError(f"line {stmt.lineno}: a comprehension or lambda reads the workflow function's variables {sorted(names)}")
+
+
+def _compile_prefix(fn_def: ast.FunctionDef, prefix: list[ast.stmt], workflow_fn: Callable) -> types.FunctionType:
+    '''
+    Build a function with the workflow function's signature that runs the statements before its first step and returns its local variables.
+    '''
+    freevars = workflow_fn.__code__.co_freevars
+    prefix_def = ast.FunctionDef(
+        name=workflow_fn.__name__,
+        args=fn_def.args,
+        body=[*prefix, ast.Return(ast.Call(ast.Name("locals", ast.Load()), [], []))],
+        decorator_list=[],
+        returns=None,
+        **_FUNCTION_DEF_FIELDS,
+    )
+    # free variables have to be defined in an enclosing function for the prefix to share the workflow function's closure cells
+    outer = ast.FunctionDef(
+        name="__sb_outer__",
+        args=ast.arguments(posonlyargs=[], args=[ast.arg(name) for name in freevars], kwonlyargs=[], kw_defaults=[], defaults=[]),
+        body=[prefix_def, ast.Return(ast.Name(workflow_fn.__name__, ast.Load()))],
+        decorator_list=[],
+        returns=None,
+        **_FUNCTION_DEF_FIELDS,
+    )
+    ast.copy_location(prefix_def, fn_def)
+    ast.copy_location(outer, fn_def)
+    ast.fix_missing_locations(outer)
+    module = compile(ast.Module([outer], type_ignores=[]), workflow_fn.__code__.co_filename, "exec")
+
+    outer_code = next(const for const in module.co_consts if isinstance(const, types.CodeType))
+    code = next(const for const in outer_code.co_consts if isinstance(const, types.CodeType))
+    cells = dict(zip(freevars, workflow_fn.__closure__ or ()))
+    prefix_fn = types.FunctionType(
+        code,
+        workflow_fn.__globals__,
+        workflow_fn.__name__,
+        workflow_fn.__defaults__,
+        tuple(cells[name] for name in code.co_freevars)
+    )
+    prefix_fn.__kwdefaults__ = workflow_fn.__kwdefaults__
+    return prefix_fn
+
+
+
+class _Resolver:
+    '''
+    Resolves the functions called by a workflow function's statements against its globals and closure, e.g. `Call`, `sb.Call` or `switchboard.Call`.
+    '''
+    STEPS = ((Call, StepType.Call), (ParallelCall, StepType.Parallel))
+    SWITCHBOARD = (Call, ParallelCall, Done, DoneAsync)
+
+    def __init__(self, workflow_fn: Callable) -> None:
+        code = workflow_fn.__code__
+        # names that are local to the workflow function or its closure rather than globals
+        self.locals = {*code.co_varnames, *code.co_cellvars, *code.co_freevars}
+        self.names = dict(workflow_fn.__globals__)
+        for name, cell in zip(workflow_fn.__code__.co_freevars, workflow_fn.__closure__ or ()):
+            try:
+                self.names[name] = cell.cell_contents
+            except ValueError:
+                pass # not bound yet
+
+    def resolve(self, func: ast.expr):
+        match func:
+            case ast.Name(id=name):
+                return self.names.get(name)
+            case ast.Attribute(value=value, attr=attr):
+                return getattr(self.resolve(value), attr, None)
+        return None
+
+    def step_type(self, func: ast.expr) -> StepType | None:
+        target = self.resolve(func)
+        return next((step_type for fn, step_type in self.STEPS if target is fn), None)
+
+    def _calls(self, node: ast.AST, targets: tuple) -> bool:
+        # compared by identity, whatever a name resolves to may not be hashable
+        return any(
+            isinstance(call, ast.Call) and any(self.resolve(call.func) is target for target in targets) 
+            for call in ast.walk(node)
+        )
+
+    def nested_locals(self, node: ast.AST) -> set[str]:
+        '''
+        The workflow function's variables read inside the comprehensions, generator expressions and lambdas of `node`.
+        '''
+        found = set()
+        for scope in ast.walk(node):
+            if not isinstance(scope, (ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp)):
+                continue
+            bound = {n.id for n in ast.walk(scope) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)}
+            if isinstance(scope, ast.Lambda):
+                args = scope.args
+                bound |= {a.arg for a in [*args.posonlyargs, *args.args, *args.kwonlyargs, args.vararg, args.kwarg] if a is not None}
+            found |= {n.id for n in ast.walk(scope) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load) and n.id in self.locals and n.id not in bound}
+        return found
+
+    def calls_step(self, node: ast.AST) -> bool:
+        return self._calls(node, (Call, ParallelCall))
+
+    def calls_done(self, node: ast.AST) -> bool:
+        return self._calls(node, (Done, DoneAsync))
+
+    def calls_switchboard(self, node: ast.AST) -> bool:
+        return self._calls(node, self.SWITCHBOARD)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 from dataclasses import dataclass
 from typing import Callable
@@ -5,9 +6,11 @@ from typing import Callable
 from switchboard.logging_config import log
 from switchboard.schemas import Context
 
-from .db import DBInterface
+from .claim_check import offload, unresolved
+from .db import DBInterface, WriteConflict
 from .enums import Cloud
-from .invocation import QueuePush, discover_invocation_endpoint
+from .invocation import QueuePush, QueuePushAsync, QueuePushBatch, QueuePushBatchAsync, discover_invocation_endpoint
+from .schemas import ParallelStep
 
 
 
@@ -23,10 +26,23 @@ def to_dict(self):
     return self.__dict__
 
 
+# Process-wide fan-in counters
+#   recorded - ParallelCall task responses written straight to the state instead of invoking the workflow
+#   woken - task responses that completed their ParallelStep and invoked the workflow
+FAN_IN_STATS = {"recorded": 0, "woken": 0}
+
+# Number of attempts to record a task response when a concurrent response for the same task is recorded first
+MAX_RECORD_ATTEMPTS = 3
+
+
 class Response():
     '''
     Response interface for updating the switchboard of the status of a separate component. 
     This could be a task worker or another internal switchboard component.
+
+    Responses from the tasks of a ParallelCall are fanned in: each one is recorded in the workflow's state (see DBInterface.write_task)
+    and only the response that completes the ParallelStep invokes the workflow. Pass `fan_in=False` to invoke the workflow for every response.
+    Database interfaces that don't implement write_task always invoke the workflow.
     '''
     def __init__(
             self, 
@@ -35,6 +51,8 @@ class Response():
             name: str, # Workflow name
             context: Context,
             custom_queue_push: Callable | None = None,
+            endpoint: str | None = None, # skips endpoint discovery when the invocation queue url is already known
+            fan_in: bool = True,
     ) -> None:
 
         log.bind(
@@ -45,9 +63,12 @@ class Response():
 
         assert len(context.ids)==3, "ids should be a list of length three representing [run_id, step_id, task_id], if there is no task_id use '-1'"
         self._cloud = cloud
+        self._db = db
+        self._name = name
+        self._fan_in = fan_in
         self._context = context
         self._custom = custom_queue_push
-        self._endpoint = discover_invocation_endpoint(db, name)
+        self._endpoint = endpoint or discover_invocation_endpoint(db, name)
         self.body = self._context.to_dict()
 
     def send(self):
@@ -55,12 +76,141 @@ class Response():
         The response object returned here varies by cloud platform.
 
         AWS - https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/send_message.html
+
+        Returns None when the response was recorded in the state without invoking the workflow.
         '''
-        body = json.dumps(self.body)
+        if not self._needs_push():
+            return None
+
+        body = self._message()
         response = QueuePush(self._cloud, self._endpoint, body, self._custom)
 
         return response
 
+    async def send_async(self):
+        '''
+        Awaitable counterpart of send(), for async task code. Recording a fanned in ParallelCall response runs in a worker thread
+        and `custom_queue_push` may be a coroutine function.
+        '''
+        if not await asyncio.to_thread(self._needs_push):
+            return None
+
+        body = self._message()
+        response = await QueuePushAsync(self._cloud, self._endpoint, body, self._custom)
+
+        return response
+
+    def _message(self) -> str:
+        # large cache values are offloaded when the message is sent, a fanned in response is recorded with its whole cache
+        return json.dumps(offload(self.body))
+
+    def _needs_push(self) -> bool:
+        # ParallelCall task responses are recorded in the state and only pushed when they complete the step
+        return not (self._fan_in and self._context.ids[2] >= 0) or self._record_task()
+
+    def _record_task(self) -> bool:
+        '''
+        Record a ParallelCall task's response in the state. Returns True when the workflow should be invoked, which is when the response 
+        completed the ParallelStep or couldn't be recorded here.
+        '''
+        # database interfaces that don't implement write_task can't record the response
+        if getattr(type(self._db), "write_task", None) is DBInterface.write_task:
+            return True
+        run_id, step_id, task_id = self._context.ids
+        for attempt in range(1, MAX_RECORD_ATTEMPTS+1):
+            state = self._db.read_latest(self._name, run_id, step_id)
+            if state is None:
+                return True
+            if not state.has_baseline():
+                state.mark_clean()
+
+            step_idx = len(state.steps)-1
+            step = state.steps[step_idx]
+            task = state.find_task(step_id, task_id)
+            # responses for an earlier step are left for the workflow to ignore
+            if not isinstance(step, ParallelStep) or step.step_id != step_id or task is None:
+                return True
+
+            changed = step.update_task(task, self._context.executed or self._context.completed, self._context.completed, self._context.success)
+            for k, v in unresolved(self._context.cache).items():
+                state.cache[k] = v
+            try:
+                if (changed or self._context.cache) and not self._db.write_task(state, step_idx, task_id):
+                    return True
+                break
+            except WriteConflict:
+                # a duplicate of this response was recorded first, the state is read again so its flags aren't counted twice
+                if attempt == MAX_RECORD_ATTEMPTS:
+                    return True
+
+        # redelivered completions of a finished step invoke the workflow again, which is idempotent
+        wake = self._context.completed and step.completed
+        FAN_IN_STATS["woken" if wake else "recorded"] += 1
+        log.bind(
+            component="Response",
+            workflow_name=self._name,
+            run_id=run_id,
+            step_id=step_id,
+            task_id=task_id,
+            completed_count=step.completed_count,
+            tasks=step.task_count,
+            wake=wake
+        ).info("-- Parallel task response recorded. --")
+        return wake
+
+
+
+def send_batch(responses: list[Response], custom_queue_push_batch: Callable | None = None) -> list[bool]:
+    '''
+    Send many responses with as few queue round trips as possible. ParallelCall task responses are fanned in the same way as Response.send(),
+    the rest are pushed with QueuePushBatch, one batch per invocation queue. `custom_queue_push_batch` receives the bodies for custom queues.
+    Returns whether each response was delivered.
+    '''
+    queues = _queues(responses, [response._needs_push() for response in responses])
+    results = [
+        QueuePushBatch(cloud, endpoint, [responses[i]._message() for i in indexes], custom, custom_queue_push_batch)
+        for (cloud, endpoint, custom), indexes in queues.items()
+    ]
+    return _delivered(responses, queues, results)
+
+
+async def send_batch_async(responses: list[Response], custom_queue_push_batch: Callable | None = None) -> list[bool]:
+    '''
+    Awaitable counterpart of send_batch. Fanned in responses are recorded concurrently in worker threads and every queue's batch is pushed concurrently.
+    '''
+    needs_push = await asyncio.gather(*(asyncio.to_thread(response._needs_push) for response in responses))
+    queues = _queues(responses, needs_push)
+    results = await asyncio.gather(*(
+        QueuePushBatchAsync(cloud, endpoint, [responses[i]._message() for i in indexes], custom, custom_queue_push_batch)
+        for (cloud, endpoint, custom), indexes in queues.items()
+    ))
+    return _delivered(responses, queues, results)
+
+
+def _queues(responses: list[Response], needs_push: list[bool]) -> dict[tuple, list[int]]:
+    # positions of the responses to push, grouped by the queue they go to
+    queues: dict[tuple, list[int]] = {}
+    for i, response in enumerate(responses):
+        if needs_push[i]:
+            queues.setdefault((response._cloud, response._endpoint, response._custom), []).append(i)
+    return queues
+
+
+def _delivered(responses: list[Response], queues: dict[tuple, list[int]], results: list[dict]) -> list[bool]:
+    delivered = [True] * len(responses)
+    for indexes, result in zip(queues.values(), results):
+        # entry ids are the body's position in the batch
+        for entry in (result or {}).get("Failed", []):
+            delivered[indexes[int(entry["Id"])]] = False
+
+    log.bind(
+        component="Response",
+        responses=len(responses),
+        pushed=sum(len(indexes) for indexes in queues.values()),
+        failed=delivered.count(False)
+    ).info("-- Response batch sent. --")
+    return delivered
+
 
 
 class Trigger(Response):
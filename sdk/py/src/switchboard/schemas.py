@@ -1,4 +1,7 @@
-from dataclasses import asdict, dataclass
+import copy
+from array import array
+from collections.abc import ItemsView, Mapping, MutableMapping, Sequence, ValuesView
+from dataclasses import dataclass
 from typing import Callable
 
 from .enums import (
@@ -12,15 +15,50 @@ from .enums import (
 
 
 
+class DirtyTracking:
+    '''
+    Records a snapshot of the tracked fields when the object is loaded (or written) so the fields changed since can be found without
+    intercepting every assignment. Only the changed fields need to be written back.
+    '''
+    __slots__ = ("_clean",)
+    _tracked: tuple[str, ...] = ()
+
+    def mark_clean(self):
+        self._clean = tuple([getattr(self, f) for f in self._tracked])
+
+    def dirty_fields(self) -> list[str]:
+        clean = getattr(self, "_clean", None)
+        if clean is None:
+            return list(self._tracked)
+        return [f for f, was in zip(self._tracked, clean) if (now := getattr(self, f)) is not was and now != was]
+
+    def mark_fields_clean(self, *fields: str):
+        clean = list(self._clean)
+        for f in fields:
+            clean[self._tracked.index(f)] = getattr(self, f)
+        self._clean = tuple(clean)
+
+    def clean_value(self, field: str):
+        '''
+        The value the field had at the last mark_clean().
+        '''
+        return self._clean[self._tracked.index(field)]
+
+
+
 # task object for tasks.py
 @dataclass
 class Task:
     name: str
     execute: Callable
+    ack: bool = True # False skips the executor's "executed" response, the task's completion response marks it executed
+    timeout: float | None = None # seconds before the async executor cancels the task, see switchboard_execute_batch_async
 
 
-@dataclass
-class Step:
+# The schema classes below are encoded and decoded on every log line, read and write, so their codecs are written out by hand
+# instead of using dataclasses.asdict (which deep copies recursively) or **kwargs construction.
+@dataclass(slots=True)
+class Step(DirtyTracking):
     step_id: int
     step_name: str # used to identify if step has already been called in _determine_step_execution
     task_key: str # key that will be used to lookup function in task_map in executor function's tasks.py
@@ -30,55 +68,883 @@ class Step:
     task_id: int = -1 # -1 unless step is part of a tasks list in a parallel step
     retries: int = 0
 
+    _tracked = ("executed", "completed", "success", "retries")
+
     def to_dict(self):
-        return asdict(self)
+        return {
+            "step_id": self.step_id,
+            "step_name": self.step_name,
+            "task_key": self.task_key,
+            "executed": self.executed,
+            "completed": self.completed,
+            "success": self.success,
+            "task_id": self.task_id,
+            "retries": self.retries,
+        }
 
+    @classmethod
+    def from_dict(cls, d: dict) -> "Step":
+        return cls(
+            d["step_id"], 
+            d["step_name"], 
+            d["task_key"], 
+            d.get("executed", False), 
+            d.get("completed", False), 
+            d.get("success", False), 
+            d.get("task_id", -1), 
+            d.get("retries", 0)
+        )
 
-@dataclass
-class ParallelStep:
-    step_id: int
-    step_name: str # used to identify if step has already been called in _determine_step_execution
-    tasks: list[Step] 
-    executed: bool = False
-    completed: bool = False
-    success: bool = False
+
+# task flags packed into a bitset each, in the order of Step._tracked
+_TASK_FLAGS = ("executed", "completed", "success")
+
+
+def _pack_bits(flags) -> bytearray:
+    '''
+    Pack a sequence of truthy values into a bitset, task j is bit j % 8 of byte j // 8.
+    '''
+    bits = bytearray((len(flags) + 7) // 8)
+    for j, flag in enumerate(flags):
+        if flag:
+            bits[j >> 3] |= 1 << (j & 7)
+    return bits
+
+
+def _unpack_bits(bits: bytearray, n: int) -> list[int]:
+    return [bits[j >> 3] >> (j & 7) & 1 for j in range(n)]
+
+
+def _changed_bits(bits: bytearray, clean: bytearray):
+    '''
+    Yield the positions of the bits that differ, in order.
+    '''
+    diff = int.from_bytes(bits, "little") ^ int.from_bytes(clean, "little")
+    while diff:
+        low = diff & -diff
+        yield low.bit_length() - 1
+        diff ^= low
+
+
+class TaskView(Step):
+    '''
+    A task of a ParallelStep seen as a Step. The view holds no fields of its own, reading or assigning a field goes to the step's packed arrays.
+    '''
+    __slots__ = ("_step", "_j")
+
+    def __init__(self, step: "ParallelStep", j: int):
+        self._step = step
+        self._j = j
+
+    step_id = property(lambda self: self._step.step_id)
+    step_name = property(lambda self: self._step.step_name)
+    task_key = property(lambda self: self._step._keys[self._step._key_idx[self._j]])
+    task_id = property(lambda self: self._j)
+    executed = property(lambda self: self._step._flag(self._j, "executed"), lambda self, v: self._step._set_flag(self._j, "executed", v))
+    completed = property(lambda self: self._step._flag(self._j, "completed"), lambda self, v: self._step._set_flag(self._j, "completed", v))
+    success = property(lambda self: self._step._flag(self._j, "success"), lambda self, v: self._step._set_flag(self._j, "success", v))
+    retries = property(lambda self: self._step._retries[self._j], lambda self, v: self._step._retries.__setitem__(self._j, v))
+
+    def mark_clean(self):
+        self._step._mark_task_clean(self._j, self._tracked)
+
+    def dirty_fields(self) -> list[str]:
+        return self._step._dirty_task_fields(self._j)
+
+    def mark_fields_clean(self, *fields: str):
+        self._step._mark_task_clean(self._j, fields)
+
+    def clean_value(self, field: str):
+        step = self._step
+        if field == "retries":
+            return step._clean_retries[self._j]
+        return bool(step._clean_bits[field][self._j >> 3] >> (self._j & 7) & 1)
+
+
+class TaskList(Sequence):
+    '''
+    The tasks of a ParallelStep as a read only sequence of TaskViews.
+    '''
+    __slots__ = ("_step",)
+
+    def __init__(self, step: "ParallelStep"):
+        self._step = step
+
+    def __len__(self) -> int:
+        return len(self._step._key_idx)
+
+    def __getitem__(self, j):
+        if isinstance(j, slice):
+            return [self._step.task(i) for i in range(*j.indices(len(self)))]
+        if j < 0:
+            j += len(self)
+        if not 0 <= j < len(self):
+            raise IndexError("task index out of range")
+        return self._step.task(j)
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+class ParallelStep(DirtyTracking):
+    '''
+    A step whose tasks are executed concurrently. The tasks are packed instead of kept as a list of Steps so large fan-outs stay small 
+    in memory, in JSON and in the stored item:
+        - task keys are interned, every distinct key is kept once and each task holds an index into them
+        - the executed, completed and success flags are bitsets, bit j of each belongs to task j
+        - retries are an array of small ints
+    A task's task_id is its position in the step. `tasks` returns a TaskView (a Step) per task, views are created when first accessed.
+
+    The encoded step stores the flags as lists of 0/1 per task (`task_executed`, `task_completed`, `task_success`) rather than as the bitsets, 
+    DynamoDB has no bitwise update and a task response must be able to set its own flag without rewriting the others (see write_task).
+    '''
+    __slots__ = (
+        "step_id", "step_name", "executed", "completed", "success", "executed_count", "completed_count", "succeeded_count", "sharded",
+        "_keys", "_key_idx", "_bits", "_retries", "_task_list", "_views", "_clean_bits", "_clean_retries"
+    )
+
+    _tracked = ("executed", "completed", "success", "tasks", "executed_count", "completed_count", "succeeded_count")
+    _counters = ("executed_count", "completed_count", "succeeded_count")
+
+    def __init__(
+            self, 
+            step_id: int, 
+            step_name: str, # used to identify if step has already been called in _determine_step_execution
+            tasks: list[Step], 
+            executed: bool = False, 
+            completed: bool = False, 
+            success: bool = False, 
+            # number of tasks with each flag set, maintained as task responses arrive so the join check doesn't scan every task
+            # None means count them from the tasks
+            executed_count: int | None = None, 
+            completed_count: int | None = None, 
+            succeeded_count: int | None = None, 
+            sharded: bool = False # each task is stored as its own item and the step only as a header, see AWS_DataInterface
+    ):
+        self.step_id = step_id
+        self.step_name = step_name
+        self.executed = executed
+        self.completed = completed
+        self.success = success
+        self.executed_count = executed_count
+        self.completed_count = completed_count
+        self.succeeded_count = succeeded_count
+        self.sharded = sharded
+        self.tasks = tasks
+        if executed_count is None or completed_count is None or succeeded_count is None:
+            self.recount()
+
+    @property
+    def tasks(self) -> TaskList:
+        return self._task_list
+
+    @tasks.setter
+    def tasks(self, tasks: list[Step]):
+        keys: dict[str, int] = {}
+        self._key_idx = array("I", [keys.setdefault(task.task_key, len(keys)) for task in tasks])
+        self._keys = list(keys)
+        self._bits = {flag: _pack_bits([getattr(task, flag) for task in tasks]) for flag in _TASK_FLAGS}
+        self._retries = array("h", [task.retries for task in tasks])
+        self._task_list = TaskList(self)
+        self._views = {}
+        # replaced tasks are all new, none of them has a stored value to compare against
+        self._clean_bits = None
+        self._clean_retries = None
+
+    @property
+    def task_count(self) -> int:
+        return len(self._key_idx)
+
+    @property
+    def task_keys(self) -> list[str]:
+        '''
+        The task_key of every task, in task_id order.
+        '''
+        keys = self._keys
+        return [keys[i] for i in self._key_idx]
+
+    def task(self, task_id: int) -> TaskView:
+        view = self._views.get(task_id)
+        if view is None:
+            view = self._views[task_id] = TaskView(self, task_id)
+        return view
+
+    def _flag(self, j: int, flag: str) -> bool:
+        return bool(self._bits[flag][j >> 3] >> (j & 7) & 1)
+
+    def _set_flag(self, j: int, flag: str, value: bool):
+        if value:
+            self._bits[flag][j >> 3] |= 1 << (j & 7)
+        else:
+            self._bits[flag][j >> 3] &= ~(1 << (j & 7)) & 0xFF
+
+    def recount(self):
+        '''
+        Recompute the counters from the task flags.
+        '''
+        self.executed_count = int.from_bytes(self._bits["executed"], "little").bit_count()
+        self.completed_count = int.from_bytes(self._bits["completed"], "little").bit_count()
+        self.succeeded_count = int.from_bytes(self._bits["success"], "little").bit_count()
+
+    def refresh_flags(self):
+        '''
+        Derive the step flags from the counters, a flag is set once every task has it set.
+        '''
+        n = self.task_count
+        self.executed = self.executed_count >= n
+        self.completed = self.completed_count >= n
+        self.success = self.succeeded_count >= n
+
+    def update_task(self, task: Step, executed: bool, completed: bool, success: bool) -> bool:
+        '''
+        Set the task's flags, counting each flag that flips from False to True, and re-derive the step flags.
+        Flags already set are not counted again so redelivered responses are idempotent. Returns True if any flag changed.
+        '''
+        changed = False
+        if executed and not task.executed:
+            task.executed = True
+            self.executed_count += 1
+            changed = True
+        if completed and not task.completed:
+            task.completed = True
+            self.completed_count += 1
+            changed = True
+        if success and not task.success:
+            task.success = True
+            self.succeeded_count += 1
+            changed = True
+        self.refresh_flags()
+        return changed
+
+    def merge_tasks(self, other: "ParallelStep"):
+        '''
+        Combine the other step's task flags and retries into this step's, a flag is set if either step has it set.
+        '''
+        n = self.task_count
+        if other.task_count != n:
+            return
+        size = len(self._bits["executed"])
+        for flag in _TASK_FLAGS:
+            merged = int.from_bytes(self._bits[flag], "little") | int.from_bytes(other._bits[flag], "little")
+            self._bits[flag][:] = merged.to_bytes(size, "little")
+        self._retries = array("h", map(min, self._retries, other._retries))
+        self.recount()
+        self.refresh_flags()
+
+    def dirty_tasks(self) -> list[tuple[int, list[str]]]:
+        '''
+        The (task_id, fields) of every task changed since the last mark_clean(), found by comparing the packed arrays.
+        '''
+        if self._clean_bits is None:
+            return [(j, list(Step._tracked)) for j in range(self.task_count)]
+        changed: dict[int, list[str]] = {}
+        for flag in _TASK_FLAGS:
+            for j in _changed_bits(self._bits[flag], self._clean_bits[flag]):
+                changed.setdefault(j, []).append(flag)
+        if self._retries != self._clean_retries:
+            for j, (now, was) in enumerate(zip(self._retries, self._clean_retries)):
+                if now != was:
+                    changed.setdefault(j, []).append("retries")
+        return sorted(changed.items())
+
+    def _dirty_task_fields(self, j: int) -> list[str]:
+        if self._clean_bits is None:
+            return list(Step._tracked)
+        byte, bit = j >> 3, 1 << (j & 7)
+        fields = [flag for flag in _TASK_FLAGS if (self._bits[flag][byte] ^ self._clean_bits[flag][byte]) & bit]
+        if self._retries[j] != self._clean_retries[j]:
+            fields.append("retries")
+        return fields
+
+    def _mark_task_clean(self, j: int, fields: tuple[str, ...]):
+        if self._clean_bits is None:
+            return
+        byte, bit = j >> 3, 1 << (j & 7)
+        for field in fields:
+            if field == "retries":
+                self._clean_retries[j] = self._retries[j]
+            else:
+                clean = self._clean_bits[field]
+                clean[byte] = clean[byte] & ~bit | self._bits[field][byte] & bit
+
+    def mark_clean(self):
+        DirtyTracking.mark_clean(self)
+        self._clean_bits = {flag: bytearray(bits) for flag, bits in self._bits.items()}
+        self._clean_retries = array("h", self._retries)
+
+    def task_record(self, task_id: int) -> dict:
+        '''
+        The fields of one task, as stored in a sharded task item.
+        '''
+        return {
+            "task_key": self._keys[self._key_idx[task_id]],
+            "executed": self._flag(task_id, "executed"),
+            "completed": self._flag(task_id, "completed"),
+            "success": self._flag(task_id, "success"),
+            "retries": self._retries[task_id],
+        }
 
     def to_dict(self):
-        tasks = [task.to_dict() for task in self.tasks]
-        d = asdict(self)
-        d["tasks"] = tasks
+        n = self.task_count
+        d = {
+            "step_id": self.step_id,
+            "step_name": self.step_name,
+            "task_count": n,
+            "task_keys": list(self._keys),
+            "task_executed": _unpack_bits(self._bits["executed"], n),
+            "task_completed": _unpack_bits(self._bits["completed"], n),
+            "task_success": _unpack_bits(self._bits["success"], n),
+            "task_retries": self._retries.tolist(),
+            "executed": self.executed,
+            "completed": self.completed,
+            "success": self.success,
+            "executed_count": self.executed_count,
+            "completed_count": self.completed_count,
+            "succeeded_count": self.succeeded_count,
+            "sharded": self.sharded,
+        }
+        # keys are interned in order of first use, so the index is only needed when a key repeats
+        if len(self._keys) != n:
+            d["task_key_idx"] = self._key_idx.tolist()
         return d
 
+    def header(self) -> dict:
+        '''
+        The step without its tasks, which is what's stored in the state when the tasks are sharded.
+        '''
+        return {
+            "step_id": self.step_id,
+            "step_name": self.step_name,
+            "task_count": self.task_count,
+            "executed": self.executed,
+            "completed": self.completed,
+            "success": self.success,
+            "executed_count": self.executed_count,
+            "completed_count": self.completed_count,
+            "succeeded_count": self.succeeded_count,
+            "sharded": True,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "ParallelStep":
+        executed_count = d.get("executed_count")
+        completed_count = d.get("completed_count")
+        succeeded_count = d.get("succeeded_count")
+        step = cls(
+            d["step_id"], 
+            d["step_name"], 
+            [], 
+            d.get("executed", False), 
+            d.get("completed", False), 
+            d.get("success", False),
+            None if executed_count is None else int(executed_count),
+            None if completed_count is None else int(completed_count),
+            None if succeeded_count is None else int(succeeded_count),
+            d.get("sharded", False),
+        )
+        if "tasks" in d:
+            # a list of task dicts, written before tasks were packed or loaded from sharded task items
+            tasks = d["tasks"]
+            if tasks and "task_id" in tasks[0]:
+                tasks = sorted(tasks, key=lambda task: int(task["task_id"]))
+            step.tasks = [Step("", "", task["task_key"], task.get("executed", False), task.get("completed", False), task.get("success", False), retries=int(task.get("retries", 0))) for task in tasks]
+        else:
+            n = int(d["task_count"])
+            key_idx = d.get("task_key_idx")
+            step._keys = list(d["task_keys"])
+            step._key_idx = array("I", range(n) if key_idx is None else map(int, key_idx))
+            step._bits = {flag: _pack_bits(d[f"task_{flag}"]) for flag in _TASK_FLAGS}
+            step._retries = array("h", map(int, d["task_retries"]))
+        # the counters are authoritative, states written before they existed are counted from the tasks
+        if executed_count is None or completed_count is None or succeeded_count is None:
+            step.recount()
+        step.refresh_flags()
+        return step
+
+    def __eq__(self, other) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (
+            (self.step_id, self.step_name, self.executed, self.completed, self.success, self.executed_count, self.completed_count, self.succeeded_count, self.sharded) 
+            == (other.step_id, other.step_name, other.executed, other.completed, other.success, other.executed_count, other.completed_count, other.succeeded_count, other.sharded)
+            and self.task_keys == other.task_keys and self._bits == other._bits and self._retries == other._retries
+        )
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return (
+            f"ParallelStep(step_id={self.step_id!r}, step_name={self.step_name!r}, tasks={self.task_count}, executed={self.executed!r}, "
+            f"completed={self.completed!r}, success={self.success!r}, executed_count={self.executed_count!r}, "
+            f"completed_count={self.completed_count!r}, succeeded_count={self.succeeded_count!r}, sharded={self.sharded!r})"
+        )
+
+
+def _step_from_dict(d: dict) -> Step | ParallelStep:
+    return ParallelStep.from_dict(d) if "task_count" in d or "tasks" in d else Step.from_dict(d)
+
+
+class LazySteps(list):
+    '''
+    The steps of a partially read State. Only the steps read with the state (usually the latest one) are decoded, the others are None 
+    until any of them is accessed, which loads and decodes every missing step with a single call to `load`.
+    `names` holds the step_name of every stored step, so the state's step index is built without loading the steps.
+    '''
+    __slots__ = ("names", "_load")
+
+    def __init__(self, names: list[str], steps: dict[int, dict], load: Callable[[], list[dict]]):
+        super().__init__([None] * len(names))
+        for i, d in steps.items():
+            list.__setitem__(self, i, _step_from_dict(d))
+        self.names = names
+        self._load = load
+
+    def is_loaded(self) -> bool:
+        return self._load is None
+
+    def peek(self, i: int) -> Step | ParallelStep | None:
+        '''
+        The step at i, or None when it hasn't been loaded. Never loads.
+        '''
+        return list.__getitem__(self, i)
+
+    def present(self):
+        '''
+        Iterate over the (index, step) of the steps that are loaded.
+        '''
+        return ((i, step) for i, step in enumerate(list.__iter__(self)) if step is not None)
+
+    def load(self):
+        if self._load is None:
+            return
+        stored = self._load()
+        for i in range(len(self)):
+            if list.__getitem__(self, i) is None:
+                step = _step_from_dict(stored[i])
+                # loaded steps are as stored, which is the baseline of a state that was read
+                step.mark_clean()
+                list.__setitem__(self, i, step)
+        self._load = None
+
+    def __getitem__(self, i):
+        steps = list.__getitem__(self, i)
+        if steps is None or (isinstance(i, slice) and any(step is None for step in steps)):
+            self.load()
+            steps = list.__getitem__(self, i)
+        return steps
+
+    def __iter__(self):
+        self.load()
+        return list.__iter__(self)
+
+    def __reversed__(self):
+        self.load()
+        return list.__reversed__(self)
+
+    def __contains__(self, step) -> bool:
+        self.load()
+        return list.__contains__(self, step)
+
+    def __eq__(self, other) -> bool:
+        self.load()
+        if isinstance(other, LazySteps):
+            other.load()
+        return list.__eq__(self, other)
+
+    def __ne__(self, other) -> bool:
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return "[" + ", ".join("<not loaded>" if step is None else repr(step) for step in list.__iter__(self)) + "]"
+
+
+class LazyCache(MutableMapping):
+    '''
+    A run's cache. Every key is known up front but stored values are only fetched when a key is first read, `fetch(keys)` returns 
+    the values of the keys it's given (keys without a stored value are left out). Reading all values (items(), values(), to_dict()) fetches 
+    the missing ones with a single call.
+
+    Changes are tracked per key against the values as they were stored, see changed_keys() and removed_keys().
+
+    A stored value can be a reference to a value kept elsewhere (an offloaded value, see claim_check.py), `resolve_stored` turns it into 
+    the value a read returns. The reference stays the stored value, it's only replaced when the resolved value is changed, see stored().
+    '''
+    __slots__ = ("_values", "_keys", "_missing", "_fetch", "_clean", "_stored_keys", "_resolved")
+
+    # returns the value a stored value resolves to, the value itself when it isn't a reference. Set by claim_check.py
+    resolve_stored: Callable | None = None
+
+    def __init__(self, values: dict | None = None, keys=(), fetch: Callable[[list[str]], dict] | None = None):
+        self._values = dict(values or {})
+        self._keys = dict.fromkeys(self._values)
+        self._missing = {k for k in keys if k not in self._keys}
+        self._keys.update(dict.fromkeys(k for k in keys if k in self._missing))
+        self._fetch = fetch
+        # None until mark_clean(), a cache that was never stored has every key changed
+        self._clean: dict | None = None
+        self._stored_keys: dict[str, None] = {}
+        # key -> (resolved value, its value as resolved) for keys whose stored value is a reference
+        self._resolved: dict[str, tuple] = {}
+
+    def _load(self, keys: list[str]):
+        fetched = self._fetch(keys) if self._fetch else {}
+        for k in keys:
+            self._missing.discard(k)
+            if k in fetched:
+                self._values[k] = fetched[k]
+                if self._clean is not None:
+                    self._clean[k] = copy.deepcopy(fetched[k])
+            else:
+                # removed since the key set was read
+                del self._keys[k]
+                self._stored_keys.pop(k, None)
+
+    def load(self):
+        '''
+        Fetch every value that hasn't been read yet.
+        '''
+        if self._missing:
+            self._load(list(self._missing))
+
+    def loaded(self) -> dict:
+        '''
+        The keys whose values are in memory, never fetches.
+        '''
+        return self._values
+
+    def __getitem__(self, key):
+        if key in self._missing:
+            self._load([key])
+        if key in self._resolved:
+            return self._resolved[key][0]
+        value = self._values[key]
+        resolve = type(self).resolve_stored
+        if resolve is not None and (resolved := resolve(value)) is not value:
+            self._resolved[key] = (resolved, copy.deepcopy(resolved))
+            return resolved
+        return value
+
+    def __setitem__(self, key, value):
+        self._missing.discard(key)
+        self._resolved.pop(key, None)
+        self._keys[key] = None
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._keys[key]
+        self._missing.discard(key)
+        self._resolved.pop(key, None)
+        self._values.pop(key, None)
+
+    def _resolved_changed(self, key) -> bool:
+        resolved = self._resolved.get(key)
+        return resolved is not None and resolved[0] != resolved[1]
+
+    def stored(self, key):
+        '''
+        The value to write for the key. A reference is written as it is unless the value it resolved to was changed in place.
+        '''
+        if key in self._missing:
+            self._load([key])
+        if self._resolved_changed(key):
+            return self._resolved[key][0]
+        return self._values[key]
+
+    def stored_dict(self) -> dict:
+        '''
+        The values to write, see stored(). Never resolves a reference.
+        '''
+        self.load()
+        return {k: self.stored(k) for k in self._keys}
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def items(self):
+        self.load()
+        return ItemsView(self)
+
+    def values(self):
+        self.load()
+        return ValuesView(self)
+
+    def to_dict(self) -> dict:
+        self.load()
+        return {k: self[k] for k in self._keys}
+
+    def copy(self) -> dict:
+        return self.to_dict()
+
+    # merging works as it does for a dict, i.e. `{"default": None} | GetCache()`
+    def __or__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.to_dict() | dict(other.items())
+
+    def __ror__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(other.items()) | self.to_dict()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, LazyCache):
+            other = other.to_dict()
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.to_dict() == dict(other.items())
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return "{" + ", ".join(f"{k!r}: <not loaded>" if k in self._missing else f"{k!r}: {self._values[k]!r}" for k in self._keys) + "}"
+
+    def _store_resolved(self, key):
+        # a resolved value that was changed in place is written in full, from then on it's the stored value
+        if self._resolved_changed(key):
+            self._values[key] = self._resolved.pop(key)[0]
+
+    def mark_clean(self):
+        for k in list(self._resolved):
+            self._store_resolved(k)
+        self._clean = copy.deepcopy(self._values)
+        self._stored_keys = dict.fromkeys(self._keys)
+
+    def mark_keys_clean(self, keys: list[str]):
+        if self._clean is None:
+            self._clean = {}
+        for k in keys:
+            self._store_resolved(k)
+            self._clean[k] = copy.deepcopy(self._values[k])
+            self._stored_keys[k] = None
+
+    def mark_keys_dirty(self, keys):
+        '''
+        Treat the keys as not stored yet, so they're written with the next write.
+        '''
+        for k in keys:
+            if self._clean is not None:
+                self._clean.pop(k, None)
+            self._stored_keys.pop(k, None)
+
+    def changed_keys(self) -> list[str]:
+        '''
+        Keys added or assigned a different value since the last mark_clean(), keys that were never read can't have changed.
+        '''
+        clean = self._clean or {}
+        return [k for k, v in self._values.items() if k not in clean or clean[k] != v or self._resolved_changed(k)]
+
+    def removed_keys(self) -> list[str]:
+        return [k for k in self._stored_keys if k not in self._keys]
+
+    def stored_keys(self) -> list[str]:
+        '''
+        The keys as of the last mark_clean().
+        '''
+        return list(self._stored_keys)
+
+
+class _StateTracking(DirtyTracking):
+    # set by mark_clean(), a State that was never loaded or written has no baseline to compute a delta against
+    # _indexed is the (steps list, length) the step name and parallel step id indexes (both to a position in steps) were built from
+    __slots__ = ("_loaded_steps", "_step_index", "_task_index", "_indexed")
+
 
 # dataclass for SwitchboardState table
-@dataclass
-class State:
+@dataclass(slots=True)
+class State(_StateTracking):
     name: str
     run_id: int
     steps: list[Step|ParallelStep]
-    cache: dict # cache can be used to store data that is pertinent to conditional steps in a workflow.
+    cache: LazyCache # cache can be used to store data that is pertinent to conditional steps in a workflow. A dict is wrapped in a LazyCache.
     status: Status
+    version: int = 0 # incremented on every successful write, used for optimistic concurrency control
+
+    _tracked = ("steps", "cache", "status")
+
+    def __post_init__(self):
+        self._loaded_steps = None
+        self._indexed = None
+        if not isinstance(self.cache, LazyCache):
+            self.cache = LazyCache(self.cache)
+
+    def reindex(self):
+        '''
+        Rebuild the step_name -> position and ParallelStep step_id -> position indexes, tasks are found by their position in the ParallelStep.
+        Steps that aren't loaded are indexed by their stored name without loading them.
+        '''
+        self._step_index = {}
+        self._task_index = {}
+        for i in range(len(self.steps)):
+            self._index_step(i, self._peek(i))
+        self._indexed = (self.steps, len(self.steps))
+
+    def _index_step(self, i: int, step: Step | ParallelStep | None):
+        self._step_index.setdefault(self.steps.names[i] if step is None else step.step_name, i)
+        if isinstance(step, ParallelStep):
+            self._task_index[step.step_id] = i
+
+    def _peek(self, i: int) -> Step | ParallelStep | None:
+        steps = self.steps
+        return steps.peek(i) if isinstance(steps, LazySteps) else steps[i]
+
+    def _present_steps(self):
+        steps = self.steps
+        return steps.present() if isinstance(steps, LazySteps) else enumerate(steps)
+
+    def _ensure_index(self):
+        # steps appended or replaced without add_step() invalidate the index
+        indexed = self._indexed
+        if indexed is None or indexed[0] is not self.steps or indexed[1] != len(self.steps):
+            self.reindex()
+
+    def add_step(self, step: Step | ParallelStep):
+        self._ensure_index()
+        self.steps.append(step)
+        self._index_step(len(self.steps) - 1, step)
+        self._indexed = (self.steps, len(self.steps))
+
+    def find_step(self, step_name: str) -> Step | ParallelStep | None:
+        self._ensure_index()
+        i = self._step_index.get(step_name)
+        return None if i is None else self.steps[i]
+
+    def find_task(self, step_id: int, task_id: int) -> Step | None:
+        self._ensure_index()
+        i = self._task_index.get(step_id)
+        if i is None and isinstance(self.steps, LazySteps) and not self.steps.is_loaded():
+            # only loaded steps are known to be ParallelSteps
+            self.steps.load()
+            self.reindex()
+            i = self._task_index.get(step_id)
+        if i is None:
+            return None
+        step = self.steps[i]
+        if not 0 <= task_id < step.task_count:
+            return None
+        return step.task(task_id)
 
     def to_dict(self):
-        steps = [step.to_dict() for step in self.steps]
-        d = asdict(self)
-        d["steps"] = steps
-        d["status"] = self.status.value
-        return d
+        return {
+            "name": self.name,
+            "run_id": self.run_id,
+            "steps": [step.to_dict() for step in self.steps],
+            "cache": self.cache.stored_dict(),
+            "status": self.status.value,
+            "version": self.version,
+        }
+
+    def mark_clean(self):
+        '''
+        Record the current state as the stored baseline, called after a read or a successful write.
+        '''
+        if not isinstance(self.cache, LazyCache):
+            self.cache = LazyCache(self.cache)
+        DirtyTracking.mark_clean(self)
+        # steps that aren't loaded yet are marked clean when they're loaded
+        for _, step in self._present_steps():
+            step.mark_clean()
+        self._loaded_steps = len(self.steps)
+        self.cache.mark_clean()
+
+    def is_dirty(self) -> bool:
+        '''
+        False only when the state has a baseline and nothing changed since, a state without a baseline always needs writing.
+        '''
+        delta = self.delta()
+        return delta is None or any(delta.values())
+
+    def has_baseline(self) -> bool:
+        return self._loaded_steps is not None
+
+    def changed_cache_keys(self) -> list[str]:
+        return self.cache.changed_keys()
+
+    def mark_cache_keys_clean(self, keys: list[str]):
+        '''
+        Record the current values of the cache keys as stored, after they were written on their own.
+        '''
+        self.cache.mark_keys_clean(keys)
+
+    def delta(self) -> dict | None:
+        '''
+        The changes made since the last mark_clean(), or None when a full write is required.
+
+        Returns ->
+            {
+                "fields": [(path, value)], # path into the steps list, i.e. (3, "completed") or (3, "tasks", 7, "success")
+                "increments": [(path, n)], # ParallelStep counters, i.e. ((3, "completed_count"), 1)
+                "append": [step dicts],    # steps added after the baseline
+                "cache": {key: value},     # cache keys added or changed
+                "cache_removed": [key],
+                "status": str | None
+            }
+        '''
+        dirty = self.dirty_fields()
+        if self._loaded_steps is None or len(self.steps) < self._loaded_steps or "steps" in dirty or "cache" in dirty:
+            return None
+
+        fields = []
+        increments = []
+        for i, step in self._present_steps():
+            if i >= self._loaded_steps:
+                break
+            for name in step.dirty_fields():
+                if name == "tasks":
+                    return None
+                if name in ParallelStep._counters:
+                    increments.append(((i, name), getattr(step, name) - (step.clean_value(name) or 0)))
+                    continue
+                fields.append(((i, name), getattr(step, name)))
+            if isinstance(step, ParallelStep):
+                for j, names in step.dirty_tasks():
+                    task = step.task(j)
+                    for name in names:
+                        fields.append(((i, "tasks", j, name), getattr(task, name)))
+
+        return {
+            "fields": fields,
+            "increments": increments,
+            "append": [step.to_dict() for step in self.steps[self._loaded_steps:]],
+            "cache": {k: self.cache.stored(k) for k in self.changed_cache_keys()},
+            "cache_removed": self.cache.removed_keys(),
+            "status": self.status.value if "status" in dirty else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "State":
+        '''
+        data["steps"] may be a LazySteps for a partially read state, the steps it holds are already decoded.
+        '''
+        steps = data["steps"]
+        return cls(
+            data["name"], 
+            int(data["run_id"]), 
+            steps if isinstance(steps, LazySteps) else [_step_from_dict(step) for step in steps], 
+            data.get("cache", {}), 
+            Status(data["status"]), 
+            int(data.get("version", 0))
+        )
 
 
 def NewState(data: dict) -> State:
     '''
     Takes the state as a dictionary and converts to a State object.
     '''
-    deserialized_steps = []
-    for step_data in data["steps"]:
-        if "tasks" in step_data: # It's a ParallelStep
-            deserialized_tasks = [Step(**task_data) for task_data in step_data["tasks"]]
-            deserialized_steps.append(ParallelStep(**{**step_data, "tasks": deserialized_tasks}))
-        else: # It's a Step
-            deserialized_steps.append(Step(**step_data))
-    return State(data["name"], int(data["run_id"]), deserialized_steps, data["cache"], Status(data["status"]))
+    state = State.from_dict(data)
+    state.mark_clean()
+    return state
 
 
 
@@ -92,7 +958,7 @@ def NewState(data: dict) -> State:
 #             "success" : True,
 #             ...etc...
 #         }
-@dataclass
+@dataclass(slots=True)
 class Context:
     '''
     ids - [
@@ -109,9 +975,18 @@ class Context:
     cache: dict # cache is used to add variables to the State cache which can be defined in the switchboard response object body.
 
     def to_dict(self):
-        d = asdict(self)
-        d["ids"] = [int(i) for i in d["ids"]]
-        return d
+        return {
+            "workflow": self.workflow,
+            "ids": [int(i) for i in self.ids],
+            "executed": self.executed,
+            "completed": self.completed,
+            "success": self.success,
+            "cache": self.cache,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Context":
+        return cls(d["workflow"], d["ids"], d["executed"], d["completed"], d["success"], d["cache"])
 
 
 
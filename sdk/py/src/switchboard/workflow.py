@@ -1,15 +1,26 @@
+import asyncio
+import contextvars
 import json
-from typing import Callable, Self
-
-from .db import DB, DBInterface
-from .executor import push_to_executor
-from .schemas import State, Step, ParallelStep, Context 
-from .enums import Cloud, Status, StepType
+from typing import Awaitable, Callable, Self
+
+from .claim_check import offload, offload_cache, resolve, unresolved
+from .db import DB, DBInterface, WriteConflict
+from .executor import push_to_executor, push_to_executor_async, push_to_executor_batch, push_to_executor_batch_async
+from .invocation import QueuePush, raise_on_failed_entries
+from .schemas import LazyCache, State, Step, ParallelStep, Context 
+from .enums import Cloud, Status, StepType, SwitchboardComponent
 from .logging_config import log
 
 
 
 
+# Number of read-merge-retry attempts when a state write conflicts with a concurrent invocation
+MAX_WRITE_ATTEMPTS = 5
+
+# Process-wide state write counters, conflict_rate = conflicts / attempts
+#   skipped - flushes where nothing had changed since the state was read
+#   coalesced - write requests folded into an already pending flush
+WRITE_STATS = {"attempts": 0, "conflicts": 0, "skipped": 0, "coalesced": 0}
 
 
 
@@ -17,8 +28,9 @@ class WaitStatus:
     """
     The WaitStatus class is a dummy object used to avoid execution of downstream tasks during execution of the main switchboard serverless function.
     """
-    def __init__(self, status: Status, state: State) -> None:
+    def __init__(self, status: Status, state: State, workflow: "WorkflowRun | None" = None) -> None:
         self.state = state
+        self._workflow = workflow
 
     def call(self, *args, **kargs) -> Self:
         return self
@@ -30,35 +42,32 @@ class WaitStatus:
         log.bind(
             workflow=self.state.name
         ).info("-- WaitStatus done called --")
+        if self._workflow:
+            self._workflow._flush(self._workflow.db)
         return 200
 
+    async def done_async(self) -> int:
+        if self._workflow:
+            await self._workflow._dispatch_async()
+        return await asyncio.to_thread(self.done)
+
 
 
-class Workflow:
+class WorkflowRun:
     """
     The main engine for Switchboard orchestrations.
 
-    The Workflow class is a singleton that manages the state of a single workflow execution.
+    A WorkflowRun manages the state of a single workflow execution, one invocation of the workflow function for one run.
     It is responsible for initializing the workflow's state from a database,
     tracking the progress of steps, handling retries, and executing tasks.
 
-    It is not meant to be instantiated directly. Instead, the `InitWorkflow` function
-    should be used to create and initialize the singleton instance.
+    Runs share nothing, so any number of them can be driven concurrently in one process. The `InitWorkflow` function
+    creates a run and makes it the current run of the calling thread or asyncio task (see CURRENT_RUN), 
+    which the other public interface functions act on.
     """
-    _instance = None
-    _initialized = False
-
-    def __new__(cls, cloud: Cloud, name: str, db: DB, context: str) -> Self:
-        if not cls._instance:
-            cls._instance = super().__new__(cls)
-        return cls._instance
-
     def __init__(self, cloud: Cloud, name: str, db: DB, context: str) -> None:
         """
-        Initializes the Workflow singleton.
-
-        This constructor is called by the `__new__` method only when an instance
-        of the Workflow does not yet exist. It sets up the initial state of the
+        Initializes the WorkflowRun, setting up the initial state of the
         workflow based on the provided context.
 
         Args:
@@ -68,39 +77,59 @@ class Workflow:
             context: The JSON string context from the invocation event, which determines
                      the current state of the workflow.
         """
-        if self._initialized:
-            return
-        
         self.custom_execution_queue = None
+        self.custom_execution_queue_batch = None
+        self.custom_invocation_queue = None
         self.cloud = cloud
         self.name = name
         self.step_idx = 0
         self.step_cnt = 0
         self.curr_step = None
+        self._pending_write = False
+        # set by InitWorkflowAsync(), executor pushes are collected in _dispatches and awaited together by DoneAsync()
+        self._async_dispatch = False
+        self._dispatches: list[Callable[[], Awaitable]] = []
 
         self.db = db.interface
 
         self.context = self._get_context(context)
         assert self.name == self.context.workflow, "Context provided to Workflow does not match the Workflow's name!"
 
+        # every endpoint is loaded up front so no dispatch in this invocation needs a resource table read
+        self.endpoints = self._prefetch_endpoints(self.db)
+
         self.state = self._init_state(self.db)
 
+        # contexts received in the same batch for this run are applied to the same state, see process_batch()
+        batched = _batched_contexts.get()
+        _batched_contexts.set(())
+        if batched:
+            self._apply_batched_contexts(self.db, list(batched))
 
-        self._initialized = True
         log.bind(
             component="workflow_service", 
             workflow_name=name,
             context=context
-        ).info("-- Workflow.__init__ executed. --")
+        ).info("-- WorkflowRun.__init__ executed. --")
 
 
-    def _set_custom_execution_queue(self, custom_execution_queue_function: Callable):
+    def _set_custom_execution_queue(self, custom_execution_queue_function: Callable, custom_execution_queue_batch_function: Callable | None = None):
         log.bind(
             component="workflow_service", 
             workflow_name=self.name,
             context=self.context
-        ).info("-- Custom execution queue added to WORKFLOW. --")
+        ).info("-- Custom execution queue added to the workflow run. --")
         self.custom_execution_queue = custom_execution_queue_function
+        self.custom_execution_queue_batch = custom_execution_queue_batch_function
+
+
+    def _set_custom_invocation_queue(self, custom_invocation_queue_function: Callable):
+        log.bind(
+            component="workflow_service", 
+            workflow_name=self.name,
+            context=self.context
+        ).info("-- Custom invocation queue added to the workflow run. --")
+        self.custom_invocation_queue = custom_invocation_queue_function
 
 
     @staticmethod
@@ -115,7 +144,7 @@ class Workflow:
             raw_context=raw_context
         ).info("-- Raw context received. --")
 
-        cntx = Context(**raw_context)
+        cntx = resolve(Context.from_dict(raw_context))
         assert len(cntx.ids) == 3, "context ids should have the run_id (0 idx), step_id (1 idx), and the task_id (2 idx)"
 
         log.bind(
@@ -135,13 +164,17 @@ class Workflow:
         state = None
 
         if run_id >= 0:
-            state = db.read(self.name, run_id)
+            # the context carries the id of the run's latest step, which is its position in the steps
+            state = db.read_latest(self.name, run_id, self.context.ids[1])
+            # the state as it was read is the baseline for delta writes and for merging after a write conflict
+            if state and not state.has_baseline():
+                state.mark_clean()
 
         if state:
             assert isinstance(state, State) 
             log.bind(
                 workflow=state.name,
-                state=state.to_dict()
+                state=state
             ).debug("-- Existing State found --")
         else:
             log.bind(
@@ -161,12 +194,22 @@ class Workflow:
 
             return state
         
+        return self._apply_context(db, state)
+
+
+    def _apply_context(self, db: DBInterface, state: State) -> State:
+        '''
+        Update an existing state with the current context.
+        '''
         # if we already have an initialized state it should never be emtpy
         assert state.steps
 
+        # a task can only complete if it was executed, which matters when the executor's "executed" acknowledgement was skipped
+        if self.context.completed:
+            self.context.executed = True
         
-        # keys can and should be overwritten in the cache
-        for k,v in self.context.cache.items():
+        # keys can and should be overwritten in the cache, offloaded values are copied as their references and only fetched when they're read
+        for k,v in unresolved(self.context.cache).items():
             if k in state.cache:
                 log.bind(
                     state=state,
@@ -194,31 +237,13 @@ class Workflow:
             assert isinstance(self.curr_step, ParallelStep)
 
             # we ingest the context from an individual task, but need to analyze it within the context of the whole set of parallel tasks
-            # first we update the status in the task located in the curr_step
-            for task in self.curr_step.tasks:
-                if task.task_id == self.context.ids[2]:
-                    if self.context.executed:
-                        task.executed = True
-                    if self.context.completed:
-                        task.completed = True
-                    if self.context.success:
-                        task.success = True
-                    break
-
-            # we then compare against all other tasks and update the curr_step and context appropriately
-            executed = []
-            completed = []
-            success = []
-            for task in self.curr_step.tasks:
-                executed.append(task.executed)
-                completed.append(task.completed)
-                success.append(task.success)
-            
-            self.curr_step.executed = min(executed)
+            # the task's flags are set and the step's counters incremented, the step flags are derived from the counters
+            task = state.find_task(self.curr_step.step_id, self.context.ids[2])
+            if task is not None and self.curr_step.update_task(task, self.context.executed, self.context.completed, self.context.success):
+                self._record_task(db, state, task.task_id)
+
             self.context.executed = self.curr_step.executed
-            self.curr_step.completed = min(completed)
             self.context.completed = self.curr_step.completed
-            self.curr_step.success = min(success)
             self.context.success = self.curr_step.success
                 
         else:
@@ -239,6 +264,82 @@ class Workflow:
         return state
 
 
+    def _record_task(self, db: DBInterface, state: State, task_id: int):
+        '''
+        Record the current context's task response, recording it atomically refreshes the counters with every concurrent task response.
+        A duplicate or racing response recorded first makes the write conflict, the step is then read again and the response re-applied
+        to it so its flags aren't counted twice.
+        '''
+        for attempt in range(1, MAX_WRITE_ATTEMPTS+1):
+            try:
+                db.write_task(state, self.step_idx, task_id) # task_ids are the task's position in the step
+                return
+            except WriteConflict:
+                log.bind(
+                    component="workflow_service",
+                    workflow_name=self.name,
+                    run_id=state.run_id,
+                    task_id=task_id,
+                    attempt=attempt
+                ).warning("-- Task response write conflict, reading the step again. --")
+                if attempt == MAX_WRITE_ATTEMPTS:
+                    raise
+                stored = db.read_latest(self.name, state.run_id, self.curr_step.step_id)
+                assert stored, f"State for run_id {state.run_id} disappeared during a write conflict"
+                if not stored.has_baseline():
+                    stored.mark_clean()
+                # only the step is replaced, the rest of the state keeps the changes of the contexts applied so far
+                self.curr_step = stored.steps[self.step_idx]
+                state.steps[self.step_idx] = self.curr_step
+                task = self.curr_step.task(task_id)
+                if not self.curr_step.update_task(task, self.context.executed, self.context.completed, self.context.success):
+                    return
+
+
+    def _apply_batched_contexts(self, db: DBInterface, contexts: list[str]):
+        '''
+        Apply the other contexts received for this run in the same batch, then continue from the resulting step state as if it were a single context.
+        '''
+        if self.curr_step is None:
+            log.bind(
+                component="workflow_service",
+                workflow_name=self.name,
+                contexts=contexts
+            ).warning("-- Batched contexts received for a run that has no state, ignoring them. --")
+            return
+
+        cache = unresolved(self.context.cache)
+        for raw in contexts:
+            self.context = self._get_context(raw)
+            assert self.name == self.context.workflow, "Context provided to Workflow does not match the Workflow's name!"
+            cache |= unresolved(self.context.cache)
+            self.state = self._apply_context(db, self.state)
+        self.context = self._step_context(cache)
+
+        log.bind(
+            component="workflow_service",
+            workflow_name=self.name,
+            run_id=self.state.run_id,
+            batched=len(contexts),
+            context=self.context
+        ).info("-- Batched contexts applied. --")
+
+
+    def _step_context(self, cache: dict) -> Context:
+        '''
+        A context carrying the current step's flags, for this run's task id.
+        '''
+        assert self.curr_step is not None
+        return Context(
+            self.name, 
+            [self.state.run_id, self.curr_step.step_id, self.context.ids[2]], 
+            self.curr_step.executed, 
+            self.curr_step.completed, 
+            self.curr_step.success, 
+            cache
+        )
+
+
     def _add_step(self, type: StepType, step_name: str, *tasks: tuple[str, int]):
         '''
         Add the next step to the state. Adding an additional step to the workflow state brings the assumption that it was attempted to be executed.
@@ -253,10 +354,10 @@ class Workflow:
             for task, retries in tasks:
                 parallel_tasks.append(Step(step_id, step_name, task, task_id=task_id, retries=retries)) # add Step object to task list
                 task_id += 1 # generate task_id
-            self.state.steps.append(ParallelStep(step_id, step_name, parallel_tasks))
+            self.state.add_step(ParallelStep(step_id, step_name, parallel_tasks))
         else:
             task, retries = tasks[0]
-            self.state.steps.append(Step(self._generate_step_id(), step_name, task, retries=retries))
+            self.state.add_step(Step(self._generate_step_id(), step_name, task, retries=retries))
         
         self.curr_step = self.state.steps[self.step_cnt]
         
@@ -274,20 +375,148 @@ class Workflow:
         ).info("-- Step added to workflow state. --")
 
 
-    @classmethod
-    def _reset_singleton(cls):
-        cls._instance = None
-        cls._initialized = False
+    def _update_db(self, db: DBInterface):
+        '''
+        Schedule the state to be written. Writes are coalesced into a single flush when the invocation finishes (see Done()),
+        or when a step is enqueued, which is written before call()/parallel_call() return.
+        '''
+        if self._pending_write:
+            WRITE_STATS["coalesced"] += 1
+        self._pending_write = True
 
 
-    def _update_db(self, db: DBInterface):
+    def _flush(self, db: DBInterface):
+        '''
+        Write the state if a write is pending and anything changed since it was read, resolving conflicts with concurrent 
+        invocations (e.g. the task responses of a ParallelCall) by re-reading the stored state, merging this invocation's changes into it and retrying.
+        '''
+        if not self._pending_write:
+            return
+        self._pending_write = False
+
+        if not self.state.is_dirty():
+            WRITE_STATS["skipped"] += 1
+            log.bind(
+                component="workflow_service",
+                workflow_name=self.name,
+                run_id=self.state.run_id,
+                context=self.context
+            ).info("-- State unchanged, write skipped. --")
+            return
+
+        for attempt in range(1, MAX_WRITE_ATTEMPTS+1):
+            WRITE_STATS["attempts"] += 1
+            try:
+                db.write_delta(self.state)
+            except WriteConflict:
+                WRITE_STATS["conflicts"] += 1
+                log.bind(
+                    component="workflow_service",
+                    workflow_name=self.name,
+                    run_id=self.state.run_id,
+                    attempt=attempt,
+                    conflict_rate=WRITE_STATS["conflicts"] / WRITE_STATS["attempts"]
+                ).warning("-- State write conflict, merging with stored state. --")
+                if attempt == MAX_WRITE_ATTEMPTS:
+                    raise
+                stored = db.read(self.name, self.state.run_id)
+                assert stored, f"State for run_id {self.state.run_id} disappeared during a write conflict"
+                if not stored.has_baseline():
+                    stored.mark_clean()
+                self._merge_state(stored)
+                continue
+
+            log.bind(
+                component="workflow_service",
+                workflow_name=self.name,
+                context=self.context,
+                state=self.state
+            ).info("-- State written to database. --")
+            return
+
+
+    def _merge_state(self, stored: State):
+        '''
+        Merge this invocation's changes into a newer copy of the state. Step flags only ever move from False to True so they are OR'd,
+        retries only decrease so the lowest count wins, and only the cache keys this invocation changed are applied.
+        If the merge completes the current step, which this invocation was still waiting on, the workflow is re-invoked so the next step is not lost.
+        '''
+        waiting = self.curr_step is not None and not self.curr_step.completed
+
+        for ours, theirs in zip(self.state.steps, stored.steps):
+            if ours.step_id != theirs.step_id or ours.step_name != theirs.step_name:
+                log.bind(
+                    component="workflow_service",
+                    workflow_name=self.name,
+                    run_id=self.state.run_id,
+                    step_name=ours.step_name
+                ).warning("-- Concurrent invocations added different steps, keeping the stored step. --")
+                continue
+            self._merge_step(ours, theirs)
+        # steps added by this invocation
+        stored.steps.extend(self.state.steps[len(stored.steps):])
+
+        for k in self.state.changed_cache_keys():
+            stored.cache[k] = self.state.cache.stored(k)
+        if self.state.status is Status.Completed:
+            stored.status = Status.Completed
+
+        self.state = stored
+        if self.curr_step is not None:
+            step_id = self.curr_step.step_id
+            self.curr_step = next((step for step in stored.steps if step.step_id == step_id), stored.steps[-1])
+            if waiting and self.curr_step.completed:
+                self._reinvoke()
+
+
+    @staticmethod
+    def _merge_step(ours: Step | ParallelStep, theirs: Step | ParallelStep):
+        if isinstance(ours, ParallelStep) and isinstance(theirs, ParallelStep):
+            theirs.merge_tasks(ours)
+        elif isinstance(ours, Step) and isinstance(theirs, Step):
+            theirs.executed = theirs.executed or ours.executed
+            theirs.completed = theirs.completed or ours.completed
+            theirs.success = theirs.success or ours.success
+            theirs.retries = min(theirs.retries, ours.retries)
+
+
+    def _prefetch_endpoints(self, db: DBInterface) -> dict[SwitchboardComponent, str]:
+        '''
+        A custom DBInterface may not support reading every endpoint at once, the prefetch is only an optimization so any failure 
+        leaves the endpoints empty and each dispatch looks up its own endpoint.
+        '''
+        try:
+            return db.get_endpoints(self.name)
+        except Exception as err:
+            log.bind(
+                component="workflow_service",
+                workflow_name=self.name,
+                error=str(err)
+            ).warning("-- Endpoint prefetch failed, endpoints will be looked up per dispatch. --")
+            return {}
+
+
+    def _reinvoke(self):
+        '''
+        Push a context carrying the merged step's flags onto the invocation queue. Applying a context is idempotent, so the next invocation
+        sees the merged state and moves the workflow forward. This invocation's own context may have been an executed acknowledgement,
+        which would be ignored for a completed step.
+        '''
+        endpoint = self.endpoints.get(SwitchboardComponent.InvocationQueue)
+        if self.cloud is Cloud.CUSTOM and self.custom_invocation_queue is None:
+            log.bind(
+                component="workflow_service",
+                workflow_name=self.name,
+                run_id=self.state.run_id
+            ).error("-- Step completed during a write conflict but no custom invocation queue is set, see SetCustomInvocationQueue(). --")
+            return
+        resp = QueuePush(self.cloud, endpoint or self.db.get_endpoint(self.name, SwitchboardComponent.InvocationQueue), json.dumps(offload(self._step_context(self.context.cache).to_dict())), self.custom_invocation_queue)
         log.bind(
             component="workflow_service",
             workflow_name=self.name,
-            context=self.context,
-            state=self.state
-        ).info("-- State written to database. --")
-        db.write(self.state)
+            run_id=self.state.run_id,
+            enqueue_response=resp
+        ).info("-- Step completed by a concurrent invocation, workflow re-invoked. --")
 
     
     def _generate_id(self, db: DBInterface) -> int:
@@ -309,13 +538,10 @@ class Workflow:
                     step.retries -= 1 # this will update the appropriate step in self.state
                 case StepType.Parallel:
                     assert isinstance(step, ParallelStep)
-                    found = False
-                    for s in step.tasks:
-                        if s.task_id == self.context.ids[2]:
-                            found = True
-                            retries = s.retries
-                            s.retries -= 1 # this will update the appropriate step in self.state
-                    assert found, "no task id matches the task id in the context - \ntasks={step.tasks}\ncontext={self.context}"
+                    task = self.state.find_task(step.step_id, self.context.ids[2])
+                    assert task is not None, f"no task id matches the task id in the context - \ntasks={step.tasks}\ncontext={self.context}"
+                    retries = task.retries
+                    task.retries -= 1 # this will update the appropriate step in self.state
         if retries <= 0:
             return False
         return True
@@ -354,11 +580,7 @@ class Workflow:
             return False
 
         # Check if the step has already been processed or is the current one.
-        step_already_exists = False
-        for step in self.state.steps:
-            if step.step_name == step_name:
-                step_already_exists = True
-                break
+        step_already_exists = self.state.find_step(step_name) is not None
         
         log.bind(
             component="workflow_service",
@@ -382,12 +604,16 @@ class Workflow:
         return False
 
     
-    def _enqueue_execution(self, cloud: Cloud, db: DBInterface, name: str, task: str, task_id: int = -1):
-        assert self.curr_step, "There should be a curr_step populated for the Workflow object when _enqueue_execution() is called."
+    def _execution_message(self, task: str, task_id: int = -1, cache: dict | None = None) -> str:
         # task_id has to be added here in order to handle parallel tasks
         self.context.ids[2] = task_id
-        # the task needs to be added to the context at this point
-        msg_body = json.dumps({"task_key": task} | self.context.to_dict())
+        # the task needs to be added to the context at this point, a batch of messages passes the cache it offloaded once
+        return json.dumps({"task_key": task} | self.context.to_dict() | {"cache": offload_cache(self.context.cache) if cache is None else cache})
+
+
+    def _enqueue_execution(self, cloud: Cloud, db: DBInterface, name: str, task: str, task_id: int = -1):
+        assert self.curr_step, "There should be a curr_step populated for the WorkflowRun when _enqueue_execution() is called."
+        msg_body = self._execution_message(task, task_id)
         log.bind(
             component="workflow_service",
             workflow_name=name,
@@ -397,8 +623,14 @@ class Workflow:
             task_key=task,
             message=msg_body
         ).info("-- Enqueuing task for execution. --")
+
+        if self._async_dispatch:
+            self._dispatches.append(lambda: push_to_executor_async(
+                cloud, db, name, msg_body, self.custom_execution_queue, self.endpoints.get(SwitchboardComponent.ExecutorQueue)
+            ))
+            return
         
-        resp = push_to_executor(cloud, db, name, msg_body, self.custom_execution_queue)
+        resp = push_to_executor(cloud, db, name, msg_body, self.custom_execution_queue, self.endpoints.get(SwitchboardComponent.ExecutorQueue))
         
         log.bind(
             component="workflow_service",
@@ -410,6 +642,69 @@ class Workflow:
         ).info("-- Enqueue Response received. --")
 
 
+    def _enqueue_batch_execution(self, cloud: Cloud, db: DBInterface, name: str, tasks: list[tuple[str, int]]):
+        '''
+        Enqueue a group of (task_key, task_id) pairs with a single endpoint lookup and batched queue pushes.
+        '''
+        assert self.curr_step, "There should be a curr_step populated for the WorkflowRun when _enqueue_batch_execution() is called."
+        cache = offload_cache(self.context.cache)
+        msg_bodies = [self._execution_message(task, task_id, cache) for task, task_id in tasks]
+        log.bind(
+            component="workflow_service",
+            workflow_name=name,
+            run_id=self.state.run_id,
+            step_name=self.curr_step.step_name,
+            context=self.context,
+            tasks=tasks
+        ).info(f"-- Enqueuing {len(tasks)} tasks for execution. --")
+
+        if self._async_dispatch:
+            self._dispatches.append(lambda: push_to_executor_batch_async(
+                cloud, db, name, msg_bodies, 
+                self.custom_execution_queue, 
+                self.custom_execution_queue_batch, 
+                self.endpoints.get(SwitchboardComponent.ExecutorQueue)
+            ))
+            return
+
+        resp = push_to_executor_batch(
+            cloud, db, name, msg_bodies, 
+            self.custom_execution_queue, 
+            self.custom_execution_queue_batch, 
+            self.endpoints.get(SwitchboardComponent.ExecutorQueue)
+        )
+
+        log.bind(
+            component="workflow_service",
+            workflow_name=name,
+            run_id=self.state.run_id,
+            step_name=self.curr_step.step_name,
+            tasks=tasks,
+            enqueue_response=resp
+        ).info("-- Batch Enqueue Response received. --")
+        # nothing has been written yet, failing here redelivers the invocation and the whole fan-out is pushed again
+        raise_on_failed_entries(name, resp)
+
+
+    async def _dispatch_async(self):
+        '''
+        Await every executor push collected since the last dispatch concurrently.
+        '''
+        dispatches, self._dispatches = self._dispatches, []
+        if not dispatches:
+            return
+        responses = await asyncio.gather(*(dispatch() for dispatch in dispatches))
+        log.bind(
+            component="workflow_service",
+            workflow_name=self.name,
+            run_id=self.state.run_id,
+            dispatches=len(dispatches),
+            enqueue_responses=responses
+        ).info("-- Async Enqueue Responses received. --")
+        for resp in responses:
+            raise_on_failed_entries(self.name, resp)
+
+
     def _next(self, step_name, *tasks) -> Self:
         log.bind(
             component="workflow_service",
@@ -439,7 +734,7 @@ class Workflow:
                   in the executor's task_map.
 
         Returns:
-            The Workflow instance to allow for method chaining, or a WaitStatus
+            The WorkflowRun to allow for method chaining, or a WaitStatus
             object if the workflow should pause.
         """
 
@@ -447,13 +742,13 @@ class Workflow:
             component="workflow_service",
             workflow=self.name,
             run_id=self.state.run_id,
-            context=self.context.to_dict(),
-            state=self.state.to_dict()
+            context=self.context.to_dict()
         ).debug(f"-- step_cnt: {self.step_cnt}, step_idx: {self.step_idx} --")
         if self.step_cnt < self.step_idx:
             return self._next(step_name, task)
 
-        if self._determine_step_execution(StepType.Call, step_name, (task, retries)):
+        enqueued = self._determine_step_execution(StepType.Call, step_name, (task, retries))
+        if enqueued:
 
             # we don't need to update the db until after a successful execution
             self._enqueue_execution(self.cloud, self.db, self.name, task)
@@ -463,6 +758,9 @@ class Workflow:
             return self._next(step_name, task)
 
         self._update_db(self.db)
+        if enqueued:
+            # an enqueued step is saved right away, it would be lost if the workflow function raised before Done()
+            self._flush(self.db)
 
         log.bind(
             component="workflow_service",
@@ -470,7 +768,7 @@ class Workflow:
             run_id=self.state.run_id,
             step_name=step_name
         ).info("-- Returning WaitStatus from call() execution. --")
-        return WaitStatus(self.state.status, self.state)
+        return WaitStatus(self.state.status, self.state, self)
 
 
     def parallel_call(self, step_name: str, *tasks: tuple[str,int]) -> Self | WaitStatus:
@@ -486,32 +784,34 @@ class Workflow:
                     correspond to a key in the executor's task_map.
 
         Returns:
-            The Workflow instance to allow for method chaining, or a WaitStatus
+            The WorkflowRun to allow for method chaining, or a WaitStatus
             object if the workflow should pause.
         """
         if self.step_cnt < self.step_idx:
             return self._next(step_name, *tasks)
 
-        if self._determine_step_execution(StepType.Parallel, step_name, *tasks):
+        enqueued = self._determine_step_execution(StepType.Parallel, step_name, *tasks)
+        if enqueued:
             assert isinstance(self.curr_step, ParallelStep)
             
             # task_ids are generated not provided, so we have to match up the task_ids with each task_key
-            task_lookup = {task.task_key: task.task_id for task in self.curr_step.tasks}
+            task_lookup = {task_key: task_id for task_id, task_key in enumerate(self.curr_step.task_keys)}
+            batch = []
             for task_key, _ in tasks:
                 task_id = task_lookup.get(task_key)
                 assert task_id is not None, f"task_id was not found in parallel_call - task_key: {task_key}, task_lookup: {task_lookup}"
-                # enqueue each task individually
-                self._enqueue_execution(self.cloud, self.db, self.name, task_key, task_id)
+                batch.append((task_key, task_id))
+            # all tasks are enqueued together to minimize queue round trips
+            self._enqueue_batch_execution(self.cloud, self.db, self.name, batch)
         
         elif self.curr_step and self.curr_step.success:
             return self._next(step_name, *tasks)
         
         # we don't need to update the db until after a successful execution
         # when we determine the step doesn't need to be executed then the db just needs to be updated
-        print(f"DEBUG: Before _update_db in parallel_call() - type(self.state.steps): {type(self.state.steps)}")
-        if self.state.steps:
-            print(f"DEBUG: Before _update_db in parallel_call() - type(self.state.steps[0]): {type(self.state.steps[0])}")
         self._update_db(self.db)
+        if enqueued:
+            self._flush(self.db)
 
         log.bind(
             component="workflow_service",
@@ -519,7 +819,7 @@ class Workflow:
             run_id=self.state.run_id,
             step_name=step_name
         ).info("-- Returning WaitStatus from parallel_call() execution. --")
-        return WaitStatus(self.state.status, self.state)
+        return WaitStatus(self.state.status, self.state, self)
 
 
     def done(self):
@@ -550,29 +850,40 @@ class Workflow:
                 run_id=self.state.run_id,
                 context=self.context,
                 state=self.state
-            ).error("No tasks found in WORKFLOW!")
+            ).error("No tasks found in workflow run!")
             status_code = 204
 
         # Database needs to be updated one last time
         self._update_db(self.db)
+        self._flush(self.db)
 
         return status_code
 
 
+    async def done_async(self) -> int:
+        await self._dispatch_async()
+        return await asyncio.to_thread(self.done)
 
 
 
 
-WORKFLOW = None
+
+
+# The run the public interface functions act on. Each thread and asyncio task sees its own value, 
+# so concurrent handlers in one process drive their runs independently. Call() and ParallelCall() replace it with a WaitStatus once the run has to wait.
+CURRENT_RUN: contextvars.ContextVar["WorkflowRun | WaitStatus | None"] = contextvars.ContextVar("switchboard_current_run", default=None)
+
+# contexts for the same run that the next WorkflowRun applies along with its own, set by process_batch()
+_batched_contexts: contextvars.ContextVar[tuple[str, ...]] = contextvars.ContextVar("switchboard_batched_contexts", default=())
 
 
 def wf_interface(func):
     """
-    Ensures that the Workflow singleton is initialized before calling a public interface function.
+    Ensures that a workflow run is active before calling a public interface function.
 
     This decorator acts as a guard for all public functions that interact with the
-    global `WORKFLOW` instance. It checks if the singleton has been instantiated via
-    `InitWorkflow()` and raises a `RuntimeError` if it has not. This prevents
+    current run. It checks if a run has been started via `InitWorkflow()` in the calling 
+    thread or asyncio task and raises a `RuntimeError` if it has not. This prevents
     errors from trying to use the workflow engine before it's ready.
 
     Args:
@@ -582,14 +893,13 @@ def wf_interface(func):
         The decorated function, which will perform the check before execution.
 
     Raises:
-        RuntimeError: If the `WORKFLOW` singleton is not initialized.
+        RuntimeError: If no workflow run is active.
     """
     def nullcheck(*args, **kargs):
-        global WORKFLOW
-        if WORKFLOW:
+        if CURRENT_RUN.get():
             return func(*args, **kargs)
         else:
-            raise RuntimeError("Attempted to interact with the WORKFLOW without it being active. Make sure you call the InitWorkflow() function before calling this function.")
+            raise RuntimeError("Attempted to interact with a workflow run without one being active. Make sure you call the InitWorkflow() function before calling this function.")
     return nullcheck
 
 
@@ -598,34 +908,62 @@ def wf_interface(func):
 
 def InitWorkflow(cloud: Cloud, name: str, db: DB, context: str):
     '''
-    Initialize the Workflow singleton. The Workflow acts as the orchestration engine for switchboard. 
+    Start a run of the Workflow. The WorkflowRun acts as the orchestration engine for switchboard, it becomes the current run of the calling thread or asyncio task.
         Args:
             cloud: The cloud provider being used. See switchboard.Cloud.
             name: The name of the Worflow. Used to differentiate between workflows in the database.
             db: The DB object. Must be initialized before passing in to the Workflow. See switchboard.DB.
             context: The context of the Workflow. This typically represents the step the Workflow needs to pick up at. See swithcboard.Context.
     '''
-    global WORKFLOW
-    if WORKFLOW:
+    _start_run(WorkflowRun(cloud, name, db, context), context)
+
+
+async def InitWorkflowAsync(cloud: Cloud, name: str, db: DB, context: str):
+    '''
+    Start a run of the Workflow from an async workflow function, see InitWorkflow(). The state is loaded in a worker thread.
+    Call() and ParallelCall() are used as usual, their executor pushes are sent concurrently when `await DoneAsync()` is called and 
+    custom executor queue functions may be coroutine functions.
+    '''
+    run = await asyncio.to_thread(WorkflowRun, cloud, name, db, context)
+    run._async_dispatch = True
+    _start_run(run, context)
+
+
+def _start_run(run: WorkflowRun, context: str):
+    if CURRENT_RUN.get():
         log.bind(
             component="workflow_service", 
-            workflow_name=name,
+            workflow_name=run.name,
             context=context
-        ).debug("-- WORKFLOW singleton already exists! --")
-    WORKFLOW = Workflow(cloud, name, db, context)
+        ).debug("-- Replacing a workflow run that never called Done()! --")
+    CURRENT_RUN.set(run)
     log.bind(
         component="workflow_service", 
-        workflow_name=name,
+        workflow_name=run.name,
         context=context,
-        wf=WORKFLOW
+        wf=run
     ).info("-- Workflow Initialized. --")
 
 @wf_interface
-def SetCustomExecutorQueue(executor_queue_function: Callable):
-    global WORKFLOW
-    assert WORKFLOW is not None
-    assert not isinstance(WORKFLOW, WaitStatus)
-    WORKFLOW._set_custom_execution_queue(executor_queue_function)
+def SetCustomExecutorQueue(executor_queue_function: Callable, executor_queue_batch_function: Callable | None = None):
+    '''
+    Use a custom queue for pushing tasks to the executor. 
+    `executor_queue_batch_function` is optional, it receives a list of message bodies and is used for ParallelCall fan-outs.
+    '''
+    run = CURRENT_RUN.get()
+    assert run is not None
+    assert not isinstance(run, WaitStatus)
+    run._set_custom_execution_queue(executor_queue_function, executor_queue_batch_function)
+
+@wf_interface
+def SetCustomInvocationQueue(invocation_queue_function: Callable):
+    '''
+    Use a custom queue for re-invoking the workflow. This is needed with custom queues when a concurrent write conflict completes a step.
+    '''
+    run = CURRENT_RUN.get()
+    assert run is not None
+    assert not isinstance(run, WaitStatus)
+    run._set_custom_invocation_queue(invocation_queue_function)
 
 @wf_interface
 def Call(step_name: str, task: str, retries: int = 0) -> None:
@@ -634,9 +972,9 @@ def Call(step_name: str, task: str, retries: int = 0) -> None:
     A task string must match a key in the task_map located in tasks.py as part of the executor function.
     '''
     log.info(f"-- Calling task `{task}` --")
-    global WORKFLOW
-    assert WORKFLOW is not None
-    WORKFLOW = WORKFLOW.call(step_name, task, retries)
+    run = CURRENT_RUN.get()
+    assert run is not None
+    CURRENT_RUN.set(run.call(step_name, task, retries))
 
 
 @wf_interface
@@ -647,29 +985,105 @@ def ParallelCall(step_name: str, *tasks: tuple[str, int]) -> None:
     Task key must correspond to a key in the task_map located in tasks.py as part of the executor function.
     '''
     log.info(f"-- Calling parallel tasks `{[task for task, _ in tasks]}` --")
-    global WORKFLOW
-    assert WORKFLOW is not None
-    WORKFLOW = WORKFLOW.parallel_call(step_name, *tasks)
+    run = CURRENT_RUN.get()
+    assert run is not None
+    CURRENT_RUN.set(run.parallel_call(step_name, *tasks))
 
 
 @wf_interface
-def GetCache() -> dict:
+def GetCache() -> LazyCache:
     '''
     Retrieve the switchboard cache. The switchboard cache is a simple dictionary used to pass information between tasks and your workflow orchestration.
+    It's returned as a mapping that fetches a value the first time its key is read, so only the values a workflow uses are read from the database.
     '''
-    assert WORKFLOW is not None
-    return WORKFLOW.state.cache
+    run = CURRENT_RUN.get()
+    assert run is not None
+    return run.state.cache
 
 
 @wf_interface
 def Done() -> int:
     '''
     Calling Done() signifies the end of a switchboard workflow. This function will return the status code of the workflows execution.
+    All state changes made during the invocation are written here, in a single write.
+    '''
+    run = CURRENT_RUN.get()
+    assert run is not None
+    status = run.done()
+    CURRENT_RUN.set(None)
+    return status
+
+
+@wf_interface
+async def DoneAsync() -> int:
+    '''
+    Awaitable counterpart of Done() for workflows initialized with InitWorkflowAsync(). Every executor push made by the invocation is sent concurrently, 
+    then the state is written.
     '''
-    assert WORKFLOW is not None
-    status = WORKFLOW.done()
-    Workflow._reset_singleton()
+    run = CURRENT_RUN.get()
+    assert run is not None
+    status = await run.done_async()
+    CURRENT_RUN.set(None)
     return status
 
 
 
+
+
+def process_batch(records: list[dict], workflow_fn: Callable[[str], object]) -> dict:
+    '''
+    Process a batch of invocation queue messages, such as the `Records` of an SQS event, with one run of the workflow function per workflow run.
+        Args:
+            records: The queue records, each with a `messageId` and a `body` holding the switchboard context.
+            workflow_fn: Takes a context string and runs the workflow, the same function body as a single message handler (InitWorkflow() through Done()).
+
+    Records are grouped by workflow and run_id, each run's contexts are applied to one loaded state and the state is written once when Done() is called.
+    Every trigger (a context without a run_id) starts its own run.
+
+    Returns the SQS partial batch response listing the records of every run that raised, `{"batchItemFailures": [{"itemIdentifier": messageId}]}`.
+    Set `ReportBatchItemFailures` on the queue's event source mapping so only those records are retried.
+    '''
+    groups: dict[tuple, list[dict]] = {}
+    failures = []
+    for i, record in enumerate(records):
+        try:
+            context = json.loads(record["body"])
+            workflow, run_id = context["workflow"], int(context["ids"][0])
+        except (KeyError, IndexError, TypeError, ValueError) as err:
+            log.bind(
+                component="workflow_service",
+                message_id=record.get("messageId"),
+                error=str(err)
+            ).error("-- Invalid context in batch record. --")
+            failures.append(record.get("messageId"))
+            continue
+        key = (workflow, run_id) if run_id >= 0 else (workflow, run_id, i)
+        groups.setdefault(key, []).append(record)
+
+    for key, group in groups.items():
+        try:
+            # each run gets a fresh context, a run that raised before Done() can't leak into the next one
+            contextvars.copy_context().run(_run_group, workflow_fn, group)
+        except Exception as err:
+            log.bind(
+                component="workflow_service",
+                workflow_name=key[0],
+                run_id=key[1],
+                records=len(group),
+                error=str(err)
+            ).exception("-- Workflow run failed, its records will be retried. --")
+            failures.extend(record.get("messageId") for record in group)
+
+    log.bind(
+        component="workflow_service",
+        records=len(records),
+        runs=len(groups),
+        failures=len(failures)
+    ).info("-- Batch processed. --")
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]}
+
+
+def _run_group(workflow_fn: Callable[[str], object], group: list[dict]):
+    CURRENT_RUN.set(None)
+    _batched_contexts.set(tuple(record["body"] for record in group[1:]))
+    workflow_fn(group[0]["body"])
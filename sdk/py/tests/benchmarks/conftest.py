@@ -0,0 +1,14 @@
+import pytest
+
+
+
+
+@pytest.fixture
+def report(request):
+    '''
+    Print a benchmark's results, only when output isn't captured (`make py-bench` runs `pytest -m benchmark -s`).
+    '''
+    def _report(*lines: str):
+        if request.config.getoption("capture") == "no":
+            print(*lines, sep="\n")
+    return _report
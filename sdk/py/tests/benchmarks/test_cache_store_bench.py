@@ -0,0 +1,57 @@
+import os
+import pytest
+from moto import mock_aws
+import boto3
+
+from switchboard.db import AWS_DataInterface, _dynamodb_size
+from switchboard.enums import Status, TableName
+from switchboard.schemas import State, Step
+
+
+
+
+@pytest.fixture
+def dynamodb():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    with mock_aws():
+        dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
+        dynamodb.create_table(
+            TableName=TableName.SwitchboardState.value,
+            KeySchema=[{"AttributeName": "name", "KeyType": "HASH"}, {"AttributeName": "run_id", "KeyType": "RANGE"}],
+            AttributeDefinitions=[{"AttributeName": "name", "AttributeType": "S"}, {"AttributeName": "run_id", "AttributeType": "N"}],
+            BillingMode="PAY_PER_REQUEST"
+        )
+        yield dynamodb
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("payload_kb", [1, 10, 100])
+def test_bench_cache_items(dynamodb, payload_kb, report):
+    """
+    A workflow invocation that doesn't read the cache, compare the state item it reads with the state item that held the cache as a map.
+    """
+    db = AWS_DataInterface(dynamodb, endpoint_cache=None)
+    cache = {f"payload{i}": "x" * (payload_kb * 1024) for i in range(3)} | {"flag": True}
+    state = State("bench", 1, [Step(i, f"step{i}", "task", True, True, True) for i in range(10)], cache, Status.InProcess)
+    db.write(state)
+
+    legacy_bytes = _dynamodb_size(state.to_dict())
+    item = db.get_table().get_item(Key={"name": "bench", "run_id": 1})["Item"]
+    item_bytes = _dynamodb_size(item)
+    assert "cache" not in item and item["cache_keys"] == set(cache)
+    if payload_kb >= 10:
+        assert item_bytes * 10 < legacy_bytes
+
+    fetched = []
+    read = db.read_latest("bench", 1, 9)
+    assert read
+    read.cache._fetch = lambda keys: fetched.extend(keys) or db._read_cache("bench", 1, keys)
+    assert read.cache["flag"] is True
+    read.steps.append(Step(10, "step10", "task"))
+    db.write_delta(read)
+    # only the key that was read is fetched, nothing in the cache is written
+    assert fetched == ["flag"] and read.changed_cache_keys() == []
+
+    report(f"\n{payload_kb} KB payloads - state item: cache map {legacy_bytes} B, cache items {item_bytes} B | values fetched: {len(fetched)} of {len(cache)}")
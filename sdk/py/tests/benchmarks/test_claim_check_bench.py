@@ -0,0 +1,59 @@
+import json
+import math
+import time
+import pytest
+
+from switchboard.claim_check import CLAIM_CHECK_STATS, CLAIM_CHECK_THRESHOLD, InitClaimCheck, LocalBlobStore, offload_cache
+from switchboard.cloud import SQS_MAX_BATCH_BYTES
+from switchboard.schemas import Context
+
+
+
+
+TASKS = 100
+
+# SQS bills every 64 KB of a message as one request
+SQS_CHUNK_BYTES = 65536
+
+
+def _messages(context: Context, cache: dict) -> list[str]:
+    # the bodies of a ParallelCall's execution messages, see WorkflowRun._enqueue_batch_execution
+    return [json.dumps({"task_key": f"task{t}"} | context.to_dict() | {"cache": cache}) for t in range(TASKS)]
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("payload_kb", [8, 64, 300])
+def test_bench_claim_check_fan_out(tmp_path, payload_kb, report):
+    """
+    A ParallelCall's execution messages carrying the run's cache, compare sending the cache inline with offloading its large values.
+    """
+    cache = {"flag": True, "payload": "x" * (payload_kb * 1024)}
+    context = Context("bench", [1, 1, -1], False, False, False, cache)
+    stored = CLAIM_CHECK_STATS["stored"]
+
+    start = time.perf_counter()
+    inline = _messages(context, cache)
+    inline_ms = (time.perf_counter() - start) * 1000
+
+    InitClaimCheck(LocalBlobStore(str(tmp_path)))
+    try:
+        start = time.perf_counter()
+        claimed = _messages(context, offload_cache(cache))
+        claimed_ms = (time.perf_counter() - start) * 1000
+    finally:
+        InitClaimCheck(None)
+
+    inline_bytes, claimed_bytes = sum(map(len, inline)), sum(map(len, claimed))
+    inline_chunks = sum(math.ceil(len(m) / SQS_CHUNK_BYTES) for m in inline)
+    claimed_chunks = sum(math.ceil(len(m) / SQS_CHUNK_BYTES) for m in claimed)
+    # the payload is stored once for every message
+    assert CLAIM_CHECK_STATS["stored"] == stored + (payload_kb * 1024 >= CLAIM_CHECK_THRESHOLD)
+    assert claimed_chunks == TASKS and max(map(len, claimed)) < SQS_MAX_BATCH_BYTES
+    if payload_kb >= 64:
+        assert claimed_bytes * 50 < inline_bytes and inline_chunks > TASKS
+    if payload_kb >= 300:
+        # too large to be sent at all
+        assert min(map(len, inline)) > SQS_MAX_BATCH_BYTES
+
+    report(f"\n{payload_kb} KB payload, {TASKS} tasks - bytes: inline {inline_bytes}, claim check {claimed_bytes}"
+          f" | billed 64 KB chunks: inline {inline_chunks}, claim check {claimed_chunks} | encode: inline {inline_ms:.2f} ms, claim check {claimed_ms:.2f} ms")
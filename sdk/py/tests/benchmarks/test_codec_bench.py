@@ -0,0 +1,93 @@
+import copy
+import time
+import pytest
+from dataclasses import asdict
+
+from switchboard.enums import Status
+from switchboard.schemas import Context, NewState, ParallelStep, State, Step
+
+
+
+
+ROUNDS = 20
+
+
+def _state(n_steps: int) -> State:
+    # every fifth step is a parallel step with 10 tasks
+    steps = []
+    for i in range(n_steps):
+        if i % 5 == 4:
+            steps.append(ParallelStep(i, f"step{i}", [Step(i, f"step{i}", f"task{t}", True, True, True, task_id=t) for t in range(10)], True, True, True))
+        else:
+            steps.append(Step(i, f"step{i}", f"task{i}", True, True, True))
+    return State("bench", 1, steps, {"key": "value", "nested": {"a": [1, 2, 3]}}, Status.InProcess)
+
+
+# the asdict / **kwargs paths the schema classes used previously, ParallelSteps were encoded with a list of task dicts
+def _legacy_encode(state: State) -> dict:
+    steps = []
+    for step in state.steps:
+        if isinstance(step, ParallelStep):
+            steps.append({
+                "step_id": step.step_id, 
+                "step_name": step.step_name, 
+                "tasks": [asdict(task) for task in step.tasks], 
+                "executed": step.executed, 
+                "completed": step.completed, 
+                "success": step.success, 
+                "executed_count": step.executed_count, 
+                "completed_count": step.completed_count, 
+                "succeeded_count": step.succeeded_count, 
+                "sharded": step.sharded,
+            })
+        else:
+            steps.append(asdict(step))
+    return {"name": state.name, "run_id": state.run_id, "steps": steps, "cache": copy.deepcopy(state.cache), "status": state.status.value, "version": state.version}
+
+
+def _legacy_decode(data: dict) -> State:
+    steps = []
+    for step_data in data["steps"]:
+        if "tasks" in step_data:
+            tasks = [Step(**task_data) for task_data in step_data["tasks"]]
+            steps.append(ParallelStep(**{**step_data, "tasks": tasks}))
+        else:
+            steps.append(Step(**step_data))
+    return State(data["name"], int(data["run_id"]), steps, data["cache"], Status(data["status"]), int(data.get("version", 0)))
+
+
+def _ms(fn, *args) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(*args)
+    return (time.perf_counter() - start) * 1000 / ROUNDS
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("n_steps", [10, 100, 1000])
+def test_bench_state_codecs(n_steps, report):
+    state = _state(n_steps)
+    encoded = state.to_dict()
+    legacy = _legacy_encode(state)
+
+    # both paths must agree before their timings mean anything, items written in the legacy layout still decode
+    assert NewState(encoded) == _legacy_decode(legacy) == NewState(legacy) == state
+
+    legacy_encode = _ms(_legacy_encode, state)
+    fast_encode = _ms(State.to_dict, state)
+    legacy_decode = _ms(_legacy_decode, legacy)
+    fast_decode = _ms(State.from_dict, encoded)
+
+    report(f"\n{n_steps} steps - encode: asdict {legacy_encode:.3f} ms, to_dict {fast_encode:.3f} ms"
+          f" | decode: **kwargs {legacy_decode:.3f} ms, from_dict {fast_decode:.3f} ms")
+
+
+@pytest.mark.benchmark
+def test_bench_context_codec(report):
+    context = Context("bench", [1, 2, -1], True, True, True, {"key": "value"})
+    assert context.to_dict() == {**asdict(context), "ids": [1, 2, -1]}
+    assert Context.from_dict(context.to_dict()) == context
+
+    legacy = _ms(lambda: [asdict(context) for _ in range(1000)])
+    fast = _ms(lambda: [context.to_dict() for _ in range(1000)])
+    report(f"\n1000 contexts - asdict {legacy:.3f} ms, to_dict {fast:.3f} ms")
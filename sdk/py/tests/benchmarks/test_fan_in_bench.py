@@ -0,0 +1,56 @@
+import os
+import pytest
+from moto import mock_aws
+import boto3
+
+from switchboard.db import AWS_DataInterface
+from switchboard.enums import Cloud, Status, TableName
+from switchboard.response import Response
+from switchboard.schemas import Context, ParallelStep, State, Step
+
+
+
+
+@pytest.fixture
+def aws_interface():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    with mock_aws():
+        dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
+        dynamodb.create_table(
+            TableName=TableName.SwitchboardState.value,
+            KeySchema=[{"AttributeName": "name", "KeyType": "HASH"}, {"AttributeName": "run_id", "KeyType": "RANGE"}],
+            AttributeDefinitions=[{"AttributeName": "name", "AttributeType": "S"}, {"AttributeName": "run_id", "AttributeType": "N"}],
+            BillingMode="PAY_PER_REQUEST"
+        )
+        yield AWS_DataInterface(dynamodb, endpoint_cache=None)
+
+
+def _invocations(db: AWS_DataInterface, run_id: int, n_tasks: int, fan_in: bool) -> int:
+    '''
+    Send the executed acknowledgement and the completion of every task in a ParallelCall, returning how many reached the invocation queue.
+    '''
+    db.write(State("bench", run_id, [ParallelStep(0, "fan_out", [Step(0, "fan_out", f"task{t}", task_id=t) for t in range(n_tasks)])], {}, Status.InProcess))
+    pushed = []
+    for t in range(n_tasks):
+        for completed in (False, True):
+            context = Context("bench", [run_id, 0, t], True, completed, completed, {})
+            Response(Cloud.CUSTOM, db, "bench", context, custom_queue_push=pushed.append, endpoint="bench-queue", fan_in=fan_in).send()
+    return len(pushed)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("n_tasks", [10, 25, 50])
+def test_bench_fan_in_invocations(aws_interface, n_tasks, report):
+    # counts only, recording time under moto is dominated by its UpdateItem emulation
+    per_response = _invocations(aws_interface, 1, n_tasks, fan_in=False)
+    fanned_in = _invocations(aws_interface, 2, n_tasks, fan_in=True)
+
+    assert per_response == 2 * n_tasks
+    assert fanned_in == 1
+    stored = aws_interface.read("bench", 2)
+    assert stored
+    assert stored.steps[0].completed and stored.steps[0].completed_count == n_tasks
+
+    report(f"\n{n_tasks} tasks - workflow invocations: per response {per_response}, fan-in {fanned_in}")
@@ -0,0 +1,85 @@
+import os
+import time
+import pytest
+from moto import mock_aws
+import boto3
+
+from switchboard.db import AWS_DataInterface, _dynamodb_size
+from switchboard.enums import Status, TableName
+from switchboard.schemas import LazySteps, NewState, ParallelStep, State, Step
+
+
+
+
+ROUNDS = 20
+
+
+@pytest.fixture
+def dynamodb():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    with mock_aws():
+        dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
+        dynamodb.create_table(
+            TableName=TableName.SwitchboardState.value,
+            KeySchema=[{"AttributeName": "name", "KeyType": "HASH"}, {"AttributeName": "run_id", "KeyType": "RANGE"}],
+            AttributeDefinitions=[{"AttributeName": "name", "AttributeType": "S"}, {"AttributeName": "run_id", "AttributeType": "N"}],
+            BillingMode="PAY_PER_REQUEST"
+        )
+        yield dynamodb
+
+
+def _state(n_steps: int) -> State:
+    # every fifth step is a parallel step with 20 tasks
+    steps = []
+    for i in range(n_steps):
+        if i % 5 == 4:
+            steps.append(ParallelStep(i, f"step{i}", [Step(i, f"step{i}", f"task{t}", True, True, True, task_id=t) for t in range(20)], True, True, True))
+        else:
+            steps.append(Step(i, f"step{i}", f"task{i}", True, True, True))
+    return State("bench", 1, steps, {"key": "value"}, Status.InProcess)
+
+
+def _ms(fn, *args) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(*args)
+    return (time.perf_counter() - start) * 1000 / ROUNDS
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("n_steps", [10, 100, 1000])
+def test_bench_partial_state_read(dynamodb, n_steps, report):
+    """
+    A workflow invocation reads the state to apply its context to the latest step, compare reading every step with read_latest().
+    """
+    db = AWS_DataInterface(dynamodb, endpoint_cache=None, shard_threshold=None)
+    db.write(_state(n_steps))
+    latest = n_steps - 1
+
+    full = db.read("bench", 1)
+    partial = db.read_latest("bench", 1, latest)
+    assert full and partial and isinstance(partial.steps, LazySteps)
+    decoded = sum(1 for _ in partial.steps.present())
+    assert decoded == 1 and partial.steps[latest] == full.steps[latest]
+
+    # moto evaluates projections far slower than DynamoDB, so the responses are compared by size and decoding time rather than round trips
+    tbl = db.get_table()
+    full_item = tbl.get_item(Key={"name": "bench", "run_id": 1})["Item"]
+    partial_item = tbl.get_item(
+        Key={"name": "bench", "run_id": 1},
+        ProjectionExpression=f"#n, run_id, step_names, steps[{latest}], cache, #stat, version",
+        ExpressionAttributeNames={"#n": "name", "#stat": "status"}
+    )["Item"]
+    full_bytes, partial_bytes = _dynamodb_size(full_item), _dynamodb_size(partial_item)
+    if n_steps >= 100:
+        assert partial_bytes * 5 < full_bytes
+
+    full_ms = _ms(lambda: NewState(full_item))
+    partial_ms = _ms(lambda: NewState(partial_item | {"steps": LazySteps(partial_item["step_names"], {latest: partial_item["steps"][0]}, list)}))
+    # the older steps are only read when they're accessed
+    assert partial.steps[0] == full.steps[0] and partial.to_dict() == full.to_dict()
+
+    report(f"\n{n_steps} steps - response: full {full_bytes} B, latest {partial_bytes} B | steps decoded: full {n_steps}, latest {decoded}"
+          f" | decode: full {full_ms:.3f} ms, latest {partial_ms:.3f} ms")
@@ -0,0 +1,69 @@
+import json
+import sys
+import pytest
+from unittest.mock import patch
+
+import switchboard.workflow as wf
+from switchboard.db import DB
+from switchboard.enums import Cloud
+from switchboard.plan import compiled_workflow
+from switchboard.response import Trigger
+from tests.integration.db import DBMockInterface
+
+
+
+
+def _workflow_module(tmp_path, n_steps: int):
+    '''
+    Workflows have to be written out, a plan is compiled from the function's source.
+    '''
+    lines = [
+        "from switchboard import Cloud, InitWorkflow, SetCustomExecutorQueue, Call, Done",
+        "def workflow(context, db, push):",
+        "    InitWorkflow(Cloud.CUSTOM, 'bench', db, context)",
+        "    SetCustomExecutorQueue(push)",
+        *[f"    Call('step{i}', 'task{i}')" for i in range(n_steps)],
+        "    return Done()",
+    ]
+    path = tmp_path / f"plan_bench_{n_steps}.py"
+    path.write_text("\n".join(lines))
+    sys.path.insert(0, str(tmp_path))
+    try:
+        module = __import__(path.stem)
+    finally:
+        sys.path.remove(str(tmp_path))
+    return module.workflow
+
+
+def _replayed_steps(workflow_fn) -> tuple[int, int]:
+    '''
+    Run a workflow to completion, returns the number of invocations and the number of completed steps passed over while replaying.
+    '''
+    db = DB(Cloud.CUSTOM, DBMockInterface(None))
+    workflow_queue, executor_queue = [], []
+    invocations = 0
+    Trigger(Cloud.CUSTOM, db.interface, "bench", custom_queue_push=workflow_queue.append)
+    with patch.object(wf.WorkflowRun, "_next", autospec=True, side_effect=wf.WorkflowRun._next) as next_step:
+        while workflow_queue:
+            invocations += 1
+            workflow_fn(workflow_queue.pop(0), db, executor_queue.append)
+            for body in map(json.loads, executor_queue):
+                del body["task_key"]
+                workflow_queue.append(json.dumps(body | {"executed": True, "completed": True, "success": True}))
+            executor_queue.clear()
+    return invocations, next_step.call_count
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("n_steps", [10, 50, 100])
+def test_bench_plan_replay_work(tmp_path, n_steps, report):
+    workflow = _workflow_module(tmp_path, n_steps)
+
+    invocations, replayed = _replayed_steps(workflow)
+    plan_invocations, planned = _replayed_steps(compiled_workflow(workflow))
+
+    assert invocations == plan_invocations == n_steps + 1
+    # replay passes over every completed step on every invocation, a plan only over the one that just completed
+    assert replayed == n_steps * (n_steps + 1) // 2
+    assert planned == n_steps
+    report(f"\n{n_steps} steps - completed steps passed over: replay {replayed}, plan {planned}")
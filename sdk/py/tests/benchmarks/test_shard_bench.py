@@ -0,0 +1,93 @@
+import os
+import time
+import pytest
+from moto import mock_aws
+import boto3
+from botocore.exceptions import ClientError
+
+from switchboard.db import AWS_DataInterface, _dynamodb_size
+from switchboard.enums import Status, TableName
+from switchboard.schemas import ParallelStep, State, Step
+
+
+
+
+# task responses recorded per size, every response rewrites the same items so a sample shows the per response cost
+RESPONSES = 5
+
+# DynamoDB's item size limit
+MAX_ITEM_BYTES = 400 * 1024
+
+
+@pytest.fixture
+def dynamodb():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    with mock_aws():
+        dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
+        dynamodb.create_table(
+            TableName=TableName.SwitchboardState.value,
+            KeySchema=[{"AttributeName": "name", "KeyType": "HASH"}, {"AttributeName": "run_id", "KeyType": "RANGE"}],
+            AttributeDefinitions=[{"AttributeName": "name", "AttributeType": "S"}, {"AttributeName": "run_id", "AttributeType": "N"}],
+            BillingMode="PAY_PER_REQUEST"
+        )
+        yield dynamodb
+
+
+def _fan_out(db: AWS_DataInterface, n_tasks: int) -> dict:
+    '''
+    Write a run with an n_tasks ParallelStep, read it back and record a sample of task responses.
+    Returns the state item's size and the milliseconds spent, or None when the state item can't be stored.
+    '''
+    tasks = [Step(0, "fan_out", f"task{t}", task_id=t) for t in range(n_tasks)]
+    state = State("bench", 1, [ParallelStep(0, "fan_out", tasks)], {}, Status.InProcess)
+
+    start = time.perf_counter()
+    try:
+        db.write(state)
+    except ClientError as err:
+        assert err.response["Error"]["Code"] == "ValidationException"
+        return {"item_bytes": _dynamodb_size(state.to_dict()), "write_ms": None}
+    write_ms = (time.perf_counter() - start) * 1000
+
+    item = db.get_table().get_item(Key={"name": "bench", "run_id": 1})["Item"]
+
+    start = time.perf_counter()
+    stored = db.read("bench", 1)
+    read_ms = (time.perf_counter() - start) * 1000
+    assert stored and len(stored.steps[0].tasks) == n_tasks
+
+    responses = min(RESPONSES, n_tasks)
+    start = time.perf_counter()
+    for t in range(responses):
+        step = stored.steps[0]
+        step.update_task(step.tasks[t], True, True, True)
+        assert db.write_task(stored, 0, t)
+    response_ms = (time.perf_counter() - start) * 1000 / responses
+    assert stored.steps[0].completed_count == responses
+
+    return {"item_bytes": _dynamodb_size(item), "write_ms": write_ms, "read_ms": read_ms, "response_ms": response_ms}
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("n_tasks", [10, 100, 1000, 10000])
+def test_bench_sharded_fan_out(dynamodb, n_tasks, report):
+    inline = _fan_out(AWS_DataInterface(dynamodb, endpoint_cache=None, shard_threshold=None), n_tasks)
+    dynamodb.Table(TableName.SwitchboardState.value).delete_item(Key={"name": "bench", "run_id": 1})
+    sharded = _fan_out(AWS_DataInterface(dynamodb, endpoint_cache=None, shard_threshold=1), n_tasks)
+
+    # the state item only holds the step's header however many tasks there are
+    assert sharded["write_ms"] is not None
+    assert sharded["item_bytes"] < 1024
+    # packed tasks take a few bytes each inline, so even the largest fan-out fits the item size limit
+    assert inline["write_ms"] is not None
+    assert n_tasks * 10 < inline["item_bytes"] < MAX_ITEM_BYTES
+
+    def fmt(result: dict) -> str:
+        if result["write_ms"] is None:
+            return f"item {result['item_bytes']} B - over the item size limit"
+        return (f"item {result['item_bytes']} B, write {result['write_ms']:.1f} ms, read {result['read_ms']:.1f} ms, "
+                f"task response {result['response_ms']:.2f} ms")
+
+    report(f"\n{n_tasks} tasks\n  inline:  {fmt(inline)}\n  sharded: {fmt(sharded)}")
@@ -0,0 +1,64 @@
+import os
+import time
+import pytest
+from unittest.mock import patch
+from moto import mock_aws
+import boto3
+
+from switchboard import cloud
+from switchboard.cloud import AWS_message_push, CLIENT_STATS, reset_clients
+from switchboard.enums import Cloud
+from switchboard.invocation import QueuePush
+
+
+
+
+PUSHES = 50
+
+
+@pytest.fixture
+def sqs_queue():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    reset_clients()
+    with mock_aws():
+        sqs = boto3.client("sqs", region_name="us-east-1")
+        yield sqs.create_queue(QueueName="bench-queue")["QueueUrl"]
+    reset_clients()
+
+
+def _per_push_ms(push, url: str) -> float:
+    start = time.perf_counter()
+    for i in range(PUSHES):
+        push(url, f"msg-{i}")
+    return (time.perf_counter() - start) * 1000 / PUSHES
+
+
+@pytest.mark.benchmark
+def test_bench_pooled_vs_unpooled_push(sqs_queue, report):
+    def unpooled_push(endpoint, msg):
+        return boto3.client("sqs").send_message(QueueUrl=endpoint, MessageBody=msg)
+
+    with patch.object(cloud.boto3, "client", wraps=boto3.client) as constructed:
+        unpooled_ms = _per_push_ms(unpooled_push, sqs_queue)
+        unpooled_clients = constructed.call_count
+
+        constructed.reset_mock()
+        pooled_ms = _per_push_ms(AWS_message_push, sqs_queue)
+        pooled_clients = constructed.call_count
+
+    report(f"\nunpooled: {unpooled_clients} clients, {unpooled_ms:.2f} ms/push")
+    report(f"pooled:   {pooled_clients} clients, {pooled_ms:.2f} ms/push")
+
+    assert unpooled_clients == PUSHES
+    assert pooled_clients == 1
+    assert CLIENT_STATS["sqs_clients_created"] == 1
+
+
+@pytest.mark.benchmark
+def test_bench_queue_push_shares_client(sqs_queue):
+    # QueuePush is the path used by push_to_executor and Response.send
+    for i in range(PUSHES):
+        QueuePush(Cloud.AWS, sqs_queue, f"msg-{i}")
+    assert CLIENT_STATS["sqs_clients_created"] == 1
@@ -0,0 +1,82 @@
+import json
+import time
+import pytest
+from unittest.mock import MagicMock
+
+import switchboard.workflow as wf
+from switchboard.db import DB, DBInterface
+from switchboard.enums import Cloud, Status
+from switchboard.schemas import ParallelStep, State, Step
+
+
+
+
+LOOKUPS = 1000
+
+
+def _state(n_steps: int, n_tasks: int) -> State:
+    steps: list[Step | ParallelStep] = [Step(i, f"step{i}", f"task{i}", True, True, True) for i in range(n_steps)]
+    steps.append(ParallelStep(n_steps, "fan_out", [Step(n_steps, "fan_out", f"task{t}", True, task_id=t) for t in range(n_tasks)], True))
+    return State("bench", 1, steps, {}, Status.InProcess)
+
+
+def _linear_find_step(state: State, step_name: str):
+    for step in state.steps:
+        if step.step_name == step_name:
+            return step
+
+
+def _linear_find_task(step: ParallelStep, task_id: int):
+    for task in step.tasks:
+        if task.task_id == task_id:
+            return task
+
+
+def _us_per_call(fn) -> float:
+    start = time.perf_counter()
+    for _ in range(LOOKUPS):
+        fn()
+    return (time.perf_counter() - start) * 1_000_000 / LOOKUPS
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("size", [10, 100, 1000, 10000])
+def test_bench_step_lookups(size, report):
+    state = _state(size, size)
+    fan_out = state.steps[-1]
+    assert isinstance(fan_out, ParallelStep)
+
+    assert state.find_step(f"step{size-1}") is _linear_find_step(state, f"step{size-1}")
+    assert state.find_task(size, size-1) is _linear_find_task(fan_out, size-1)
+
+    linear_step = _us_per_call(lambda: _linear_find_step(state, "fan_out"))
+    indexed_step = _us_per_call(lambda: state.find_step("fan_out"))
+    linear_task = _us_per_call(lambda: _linear_find_task(fan_out, size-1))
+    indexed_task = _us_per_call(lambda: state.find_task(size, size-1))
+
+    report(f"\n{size} steps/tasks - find_step: scan {linear_step:.2f} us, index {indexed_step:.2f} us"
+          f" | find_task: scan {linear_task:.2f} us, index {indexed_task:.2f} us")
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("n_tasks", [10, 100, 1000])
+def test_bench_parallel_task_response_invocation(n_tasks, report):
+    """
+    One workflow invocation handling a single task response of a large ParallelCall.
+    """
+    db_mock = MagicMock(spec=DBInterface)
+    db_mock.get_endpoints.return_value = {}
+    db_mock.read_latest.side_effect = lambda *_: _state(0, n_tasks)
+    db = DB(Cloud.CUSTOM, db_mock)
+    context = json.dumps({"workflow": "bench", "ids": [1, 0, n_tasks-1], "executed": True, "completed": True, "success": True, "cache": {}})
+    tasks = [(f"task{t}", 0) for t in range(n_tasks)]
+
+    start = time.perf_counter()
+    wf.InitWorkflow(Cloud.CUSTOM, "bench", db, context)
+    wf.ParallelCall("fan_out", *tasks)
+    wf.Done()
+    elapsed = (time.perf_counter() - start) * 1000
+
+    task = db_mock.write_delta.call_args.args[0].find_task(0, n_tasks-1)
+    assert task.completed and task.success
+    report(f"\n{n_tasks} tasks - task response invocation {elapsed:.2f} ms")
@@ -0,0 +1,53 @@
+import json
+import tracemalloc
+import pytest
+from dataclasses import asdict
+
+from switchboard.db import _dynamodb_size
+from switchboard.schemas import ParallelStep, Step
+
+
+
+
+def _tasks(n_tasks: int) -> list[Step]:
+    # a fan-out over a handful of task functions, the way ParallelCall is usually used
+    return [Step(0, "fan_out", f"task{t % 8}", t % 3 == 0, t % 3 == 0, t % 6 == 0, task_id=t, retries=1) for t in range(n_tasks)]
+
+
+def _allocated(build) -> int:
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        kept = build()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    assert kept is not None
+    return sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("n_tasks", [10, 1000, 10000])
+def test_bench_packed_task_encoding(n_tasks, report):
+    tasks = _tasks(n_tasks)
+    step = ParallelStep(0, "fan_out", tasks)
+    # the list of task dicts ParallelSteps were encoded with before
+    legacy = {**step.header(), "tasks": [asdict(task) for task in tasks], "sharded": False}
+    del legacy["task_count"]
+    packed = step.to_dict()
+
+    assert ParallelStep.from_dict(legacy) == ParallelStep.from_dict(packed) == step
+    assert [task.to_dict() for task in step.tasks] == [task.to_dict() for task in tasks]
+
+    legacy_json, packed_json = len(json.dumps(legacy)), len(json.dumps(packed))
+    legacy_item, packed_item = _dynamodb_size(legacy), _dynamodb_size(packed)
+    legacy_memory = _allocated(lambda: _tasks(n_tasks))
+    packed_memory = _allocated(lambda: ParallelStep(0, "fan_out", _tasks(n_tasks)))
+
+    if n_tasks >= 1000:
+        assert packed_json * 5 < legacy_json
+        assert packed_item * 5 < legacy_item
+        assert packed_memory * 5 < legacy_memory
+
+    report(f"\n{n_tasks} tasks - json: {legacy_json} B -> {packed_json} B, item: {legacy_item} B -> {packed_item} B"
+          f", memory: {legacy_memory} B -> {packed_memory} B")
@@ -0,0 +1,156 @@
+import json
+import os
+import pytest
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+
+from switchboard.claim_check import CLAIM_CHECK_STATS, CLAIM_KEY, ClaimedCache, ClaimNotFound, InitClaimCheck, LocalBlobStore, S3BlobStore, offload, offload_cache, resolve
+from switchboard.db import DB
+from switchboard.enums import Cloud, Status
+from switchboard.executor import switchboard_execute
+from switchboard.response import Response, Trigger
+from switchboard.schemas import Context, ParallelStep, State, Step, Task
+from switchboard.workflow import Call, Done, GetCache, InitWorkflow, SetCustomExecutorQueue
+from .integration.db import DBMockInterface
+
+
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    InitClaimCheck(store, threshold=1024)
+    yield store
+    InitClaimCheck(None)
+
+
+def stored_files(store: LocalBlobStore) -> int:
+    return sum(len(files) for _, _, files in os.walk(store.root))
+
+
+def test_large_values_are_offloaded_once(store):
+    stats = dict(CLAIM_CHECK_STATS)
+    payload = {"rows": ["x" * 100] * 20}
+    body = Context("test_workflow", [1, 0, -1], True, True, True, {"small": 1, "payload": payload, "copy": dict(payload)}).to_dict()
+
+    sent = json.loads(json.dumps(offload(body)))
+    assert sent["cache"]["small"] == 1
+    assert sent["cache"]["payload"] == sent["cache"]["copy"] and CLAIM_KEY in sent["cache"]["payload"]
+    assert body["cache"]["payload"] is payload
+    # identical payloads are stored once
+    offload(body)
+    assert CLAIM_CHECK_STATS["stored"] == stats["stored"] + 1 and stored_files(store) == 1
+
+    context = resolve(Context.from_dict(sent))
+    assert isinstance(context.cache, ClaimedCache) and context.cache.loaded() == {"small": 1}
+    # an unread value is sent on as its reference
+    assert offload_cache(context.cache)["payload"] == sent["cache"]["payload"]
+    assert CLAIM_CHECK_STATS["fetched"] == stats["fetched"]
+
+    assert context.cache["payload"] == payload and context.cache["copy"] == payload
+    assert context.cache["payload"] is not context.cache["copy"]
+    # the second read of the same payload is served from memory
+    assert CLAIM_CHECK_STATS["fetched"] == stats["fetched"] + 1
+
+
+def test_references_need_a_claim_check(store):
+    sent = json.loads(json.dumps(offload(Context("test_workflow", [1, 0, -1], True, True, True, {"payload": "x" * 2000}).to_dict())))
+    InitClaimCheck(None)
+
+    context = resolve(Context.from_dict(sent))
+    assert offload_cache(context.cache) == sent["cache"]
+    with pytest.raises(ClaimNotFound, match="no claim check is configured"):
+        context.cache["payload"]
+
+    InitClaimCheck(LocalBlobStore(os.path.join(store.root, "empty")))
+    with pytest.raises(ClaimNotFound, match="not found"):
+        resolve(Context.from_dict(sent)).cache["payload"]
+
+
+def test_s3_store_writes_when_head_object_is_denied():
+    # without s3:ListBucket a missing object is reported as 403 instead of 404
+    client = MagicMock()
+    client.head_object.side_effect = ClientError({"Error": {"Code": "403", "Message": "Forbidden"}}, "HeadObject")
+    store = S3BlobStore("switchboard-claims", client=client)
+    assert not store.exists("abc")
+
+    client.head_object.side_effect = ClientError({"Error": {"Code": "500", "Message": "InternalError"}}, "HeadObject")
+    with pytest.raises(ClientError):
+        store.exists("abc")
+
+
+class FanInDB(DBMockInterface):
+    def write_task(self, state, step_idx, task_idx):
+        self.write(state)
+        return True
+
+
+def test_received_references_are_fetched_when_read(store):
+    """
+    A run's cache keeps the references it receives, neither recording a task response nor starting the workflow fetches them.
+    """
+    db = DB(Cloud.CUSTOM, FanInDB(None))
+    tasks = [Step(1, "fan_out", f"task_{i}", task_id=i) for i in range(2)]
+    db.interface.write(State("claim_workflow", 1, [Step(0, "first", "task", True, True, True), ParallelStep(1, "fan_out", tasks)], {}, Status.InProcess))
+    payload = ["row"] * 2000
+    fetched = CLAIM_CHECK_STATS["fetched"]
+
+    def received(task_id: int, cache: dict) -> Context:
+        return resolve(Context.from_dict(json.loads(json.dumps(offload(Context("claim_workflow", [1, 1, task_id], True, True, True, cache).to_dict())))))
+
+    pushed = []
+    Response(Cloud.CUSTOM, db.interface, "claim_workflow", received(0, {"payload": payload}), custom_queue_push=pushed.append).send()
+    assert pushed == [] and CLAIM_CHECK_STATS["fetched"] == fetched
+    assert CLAIM_KEY in db.interface.read("claim_workflow", 1).cache.loaded()["payload"]
+
+    Response(Cloud.CUSTOM, db.interface, "claim_workflow", received(1, {"other": payload}), custom_queue_push=pushed.append).send()
+    assert len(pushed) == 1
+    InitWorkflow(Cloud.CUSTOM, "claim_workflow", db, pushed[0])
+    assert CLAIM_CHECK_STATS["fetched"] == fetched
+
+    cache = GetCache()
+    assert cache["payload"] == payload and cache["other"] == payload
+    # both values are the same payload, fetched once
+    assert CLAIM_CHECK_STATS["fetched"] == fetched + 1
+    Done()
+    # a value that was only read is still stored as its reference
+    assert all(CLAIM_KEY in v for v in db.interface.read("claim_workflow", 1).cache.stored_dict().values())
+
+
+def test_run_sends_large_cache_values_by_reference(store):
+    """
+    A task's large response value should only travel by reference, the workflow stores it in the state and the next task reads it from the store.
+    """
+    db = DB(Cloud.CUSTOM, DBMockInterface(None))
+    workflow_queue, executor_queue, messages, received = [], [], [], []
+    payload = ["row"] * 2000
+
+    def respond(context: Context, cache: dict):
+        Response(Cloud.CUSTOM, db.interface, context.workflow, Context(context.workflow, context.ids, True, True, True, cache), custom_queue_push=workflow_queue.append).send()
+        return 200
+
+    task_map = {
+        "produce": Task("produce", lambda context: respond(context, {"payload": payload})),
+        "consume": Task("consume", lambda context: received.append(context.cache["payload"]) or respond(context, {})),
+    }
+
+    def workflow(context: str):
+        InitWorkflow(Cloud.CUSTOM, "claim_workflow", db, context)
+        SetCustomExecutorQueue(executor_queue.append)
+        Call("produce", "produce")
+        Call("consume", "consume")
+        return Done()
+
+    Trigger(Cloud.CUSTOM, db.interface, "claim_workflow", custom_queue_push=workflow_queue.append)
+    while workflow_queue:
+        messages.append(workflow_queue.pop(0))
+        workflow(messages[-1])
+        while executor_queue:
+            messages.append(executor_queue.pop(0))
+            switchboard_execute(Cloud.CUSTOM, db.interface, json.loads(messages[-1]), task_map, custom_invocation_queue=workflow_queue.append)
+
+    state = db.interface.read("claim_workflow", 1)
+    assert [step.success for step in state.steps] == [True, True]
+    assert state.cache["payload"] == payload and received == [payload]
+    assert max(len(message) for message in messages) < 1024 < len(json.dumps(payload))
+    assert stored_files(store) == 1
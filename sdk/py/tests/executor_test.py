@@ -0,0 +1,203 @@
+import pytest
+import asyncio
+import json
+import threading
+from unittest.mock import MagicMock
+from switchboard.enums import Cloud
+from switchboard.schemas import Context, Task
+from switchboard.db import DBInterface
+from switchboard.executor import switchboard_execute, switchboard_execute_async, switchboard_execute_batch, switchboard_execute_batch_async
+from switchboard.invocation import QueuePush, QueuePushAsync, QueuePushBatchAsync
+from switchboard.response import Response
+
+
+@pytest.fixture
+def mock_db():
+    """Fixture to create a mock DBInterface."""
+    db_mock = MagicMock(spec=DBInterface)
+    db_mock.get_endpoint.return_value = "invocation-queue"
+    return db_mock
+
+
+def record(message_id: str, task_key: str, step_id: int = 0) -> dict:
+    return {"messageId": message_id, "body": json.dumps({
+        "task_key": task_key,
+        "workflow": "test_workflow",
+        "ids": [1, step_id, -1],
+        "executed": False,
+        "completed": False,
+        "success": False,
+        "cache": {}
+    })}
+
+
+def test_execute_batch_runs_tasks_concurrently(mock_db):
+    """
+    Every task should be acknowledged in one batched push and run on the thread pool, failed tasks are reported per record.
+    """
+    started = threading.Barrier(3, timeout=5)
+    executed = []
+
+    def waiting_task(context: Context):
+        # only returns once all three tasks are running at the same time
+        started.wait()
+        executed.append(context.ids[1])
+        return 200
+
+    def failing_task(context: Context):
+        started.wait()
+        raise RuntimeError("boom")
+
+    task_map = {
+        "wait": Task("wait", waiting_task),
+        "fail": Task("fail", failing_task),
+    }
+    push = MagicMock()
+    push_batch = MagicMock(return_value={"Successful": [], "Failed": []})
+
+    response = switchboard_execute_batch(
+        Cloud.CUSTOM,
+        mock_db,
+        [record("a", "wait", 0), record("b", "fail", 1), record("c", "wait", 2), record("d", "missing"), {"messageId": "e", "body": "{}"}],
+        task_map,
+        custom_invocation_queue=push,
+        custom_invocation_queue_batch=push_batch
+    )
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "e"}, {"itemIdentifier": "b"}]}
+    assert sorted(executed) == [0, 2]
+    push.assert_not_called()
+    push_batch.assert_called_once()
+    acks = [json.loads(body) for body in push_batch.call_args.args[0]]
+    assert [ack["ids"][1] for ack in acks] == [0, 1, 2]
+    assert all(ack["executed"] and not ack["completed"] for ack in acks)
+
+
+def test_execute_batch_skips_tasks_whose_ack_failed(mock_db):
+    executed = []
+    task_map = {
+        "work": Task("work", lambda context: executed.append(context.ids[1])),
+        "quiet": Task("quiet", lambda context: executed.append(context.ids[1]), ack=False),
+    }
+    push_batch = MagicMock(return_value={"Successful": [{"Id": "0"}], "Failed": [{"Id": "1", "SenderFault": False}]})
+
+    response = switchboard_execute_batch(
+        Cloud.CUSTOM,
+        mock_db,
+        [record("a", "work", 0), record("b", "work", 1), record("c", "quiet", 2)],
+        task_map,
+        custom_invocation_queue_batch=push_batch
+    )
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "b"}]}
+    assert sorted(executed) == [0, 2]
+    assert len(push_batch.call_args.args[0]) == 2
+
+
+def test_execute_batch_async_runs_tasks_on_the_event_loop(mock_db):
+    """
+    async tasks should run concurrently up to the semaphore limit, tasks past their timeout are cancelled and reported as failures.
+    """
+    running = 0
+    peak = 0
+    finished = []
+
+    async def io_task(context: Context):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        finished.append(context.ids[1])
+        return 200
+
+    async def slow_task(context: Context):
+        await asyncio.sleep(5)
+
+    task_map = {
+        "io": Task("io", io_task),
+        "slow": Task("slow", slow_task, timeout=0.1),
+        "sync": Task("sync", lambda context: finished.append(context.ids[1])),
+    }
+    records = [record(str(i), "io", i) for i in range(8)] + [record("slow", "slow", 8), record("sync", "sync", 9)]
+    push_batch = MagicMock(return_value={"Successful": [], "Failed": []})
+
+    response = asyncio.run(switchboard_execute_batch_async(
+        Cloud.CUSTOM,
+        mock_db,
+        records,
+        task_map,
+        custom_invocation_queue_batch=push_batch,
+        max_concurrency=4
+    ))
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "slow"}]}
+    assert sorted(finished) == list(range(8)) + [9]
+    assert peak == 4
+    assert len(push_batch.call_args.args[0]) == 10
+
+
+def test_sync_executor_runs_async_tasks(mock_db):
+    async def async_task(context: Context):
+        await asyncio.sleep(0)
+        return 201
+
+    context = json.loads(record("a", "async")["body"])
+    assert switchboard_execute(Cloud.CUSTOM, mock_db, context, {"async": Task("async", async_task)}, custom_invocation_queue=MagicMock()) == 201
+
+    context = json.loads(record("a", "async")["body"])
+    status = asyncio.run(switchboard_execute_async(Cloud.CUSTOM, mock_db, context, {"async": Task("async", async_task)}, custom_invocation_queue=MagicMock()))
+    assert status == 201
+
+
+def test_async_queue_pushes(mock_db):
+    """
+    Custom queue push functions may be coroutine functions, for both the sync and async APIs.
+    """
+    async def push(body: str):
+        await asyncio.sleep(0)
+        return {"MessageId": body}
+
+    assert QueuePush(Cloud.CUSTOM, "q", "a", push) == {"MessageId": "a"}
+    assert asyncio.run(QueuePushAsync(Cloud.CUSTOM, "q", "b", push)) == {"MessageId": "b"}
+    response = asyncio.run(QueuePushBatchAsync(Cloud.CUSTOM, "q", ["c", "d"], push))
+    assert response == {"Successful": [{"MessageId": "c"}, {"MessageId": "d"}], "Failed": []}
+
+    context = Context.from_dict(json.loads(record("a", "task", 2)["body"]))
+    context.executed = True
+    bodies = []
+
+    async def invocation_push(body: str):
+        bodies.append(json.loads(body))
+
+    asyncio.run(Response(Cloud.CUSTOM, mock_db, "test_workflow", context, custom_queue_push=invocation_push).send_async())
+    assert [body["ids"] for body in bodies] == [[1, 2, -1]]
+    assert bodies[0]["executed"] and not bodies[0]["completed"]
+
+
+def test_task_response_without_write_task_invokes_the_workflow():
+    """
+    A database interface that doesn't implement write_task can't record a ParallelCall task's response, it's pushed without reading the state.
+    """
+    from .integration.db import DBMockInterface
+    db = DBMockInterface(None)
+    db.read_latest = MagicMock()
+    pushed = []
+
+    Response(Cloud.CUSTOM, db, "test_workflow", Context("test_workflow", [1, 0, 1], True, True, True, {}), custom_queue_push=pushed.append).send()
+    assert len(pushed) == 1
+    db.read_latest.assert_not_called()
+
+
+def test_sync_queue_push_inside_an_event_loop():
+    """
+    The sync API may be called from a coroutine, a coroutine function push is then run outside of the caller's event loop.
+    """
+    async def push(body: str):
+        await asyncio.sleep(0)
+        return {"MessageId": body}
+
+    async def handler():
+        return QueuePush(Cloud.CUSTOM, "q", "a", push)
+
+    assert asyncio.run(handler()) == {"MessageId": "a"}
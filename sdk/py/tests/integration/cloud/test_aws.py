@@ -1,11 +1,19 @@
+import asyncio
 import os
+import threading
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from moto import mock_aws
 import boto3
-from switchboard.cloud import AWS_db_connect, AWS_message_push
-from switchboard.db import AWS_DataInterface
+from unittest.mock import patch, MagicMock
+from switchboard.claim_check import ClaimNotFound, S3BlobStore
+from switchboard.cloud import AWS_db_connect, AWS_message_push, AWS_message_push_batch, AWS_sqs_client, CLIENT_STATS, reset_clients
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+from switchboard.db import AWS_DataInterface, ENDPOINT_CACHE, EndpointNotFound, RunIdBlocks, TASK_KEY_STRIDE, WriteConflict
 from switchboard.enums import Status, TableName, SwitchboardComponent, Cloud
-from switchboard.schemas import State
+from switchboard.invocation import QueuePushAsync
+from switchboard.schemas import LazySteps, State, Step, ParallelStep
 
 
 
@@ -60,7 +68,9 @@ def dynamodb_resource(init_resource):
 
 @pytest.fixture
 def aws_interface(dynamodb_resource):
-    return AWS_DataInterface(dynamodb_resource)
+    ENDPOINT_CACHE.clear()
+    yield AWS_DataInterface(dynamodb_resource)
+    ENDPOINT_CACHE.clear()
 
 
 def test_write_and_read(aws_interface):
@@ -73,6 +83,468 @@ def test_write_and_read(aws_interface):
     assert result.run_id == 1
     assert result.status == Status.InProcess
 
+def test_write_is_conditional_on_version(aws_interface):
+    state_obj = State(name="test_workflow", run_id=1, steps=[], cache={}, status=Status.InProcess)
+    aws_interface.write(state_obj)
+    assert state_obj.version == 1
+
+    first = aws_interface.read("test_workflow", 1)
+    second = aws_interface.read("test_workflow", 1)
+    assert first and second and first.version == second.version == 1
+
+    first.cache["winner"] = "first"
+    aws_interface.write(first)
+    second.cache["winner"] = "second"
+    with pytest.raises(WriteConflict):
+        aws_interface.write(second)
+
+    stored = aws_interface.read("test_workflow", 1)
+    assert stored and stored.version == 2
+    assert stored.cache == {"winner": "first"}
+
+def test_write_delta(aws_interface):
+    state_obj = State(
+        name="test_workflow", 
+        run_id=1, 
+        steps=[
+            Step(0, "step1", "task1", executed=True, completed=True, success=True),
+            ParallelStep(1, "step2", [Step(1, "step2", "task_a", task_id=0), Step(1, "step2", "task_b", task_id=1)]),
+        ], 
+        cache={"keep": 1, "change": 1, "drop": 1}, 
+        status=Status.InProcess
+    )
+    # a state that was never read has no baseline so the delta path falls back to a full write
+    aws_interface.write_delta(state_obj)
+
+    state = aws_interface.read("test_workflow", 1)
+    assert state
+    state.steps[1].tasks[1].completed = True
+    state.steps[1].tasks[1].executed = True
+    state.steps.append(Step(2, "step3", "task3"))
+    state.cache["change"] = 2
+    state.cache["new"] = {"nested": [1, 2]}
+    del state.cache["drop"]
+    state.status = Status.Completed
+
+    with patch("switchboard.db.AWS_DataInterface.write") as full_write:
+        aws_interface.write_delta(state)
+    full_write.assert_not_called()
+    assert state.version == 2
+    assert state.delta() == {"fields": [], "increments": [], "append": [], "cache": {}, "cache_removed": [], "status": None}
+
+    stored = aws_interface.read("test_workflow", 1)
+    assert stored
+    assert stored.to_dict() == state.to_dict()
+    assert stored.cache == {"keep": 1, "change": 2, "new": {"nested": [1, 2]}}
+    assert [t.completed for t in stored.steps[1].tasks] == [False, True]
+    assert stored.status == Status.Completed
+
+
+def test_write_delta_conflict(aws_interface):
+    aws_interface.write(State(name="test_workflow", run_id=1, steps=[Step(0, "step1", "task1")], cache={}, status=Status.InProcess))
+    first = aws_interface.read("test_workflow", 1)
+    second = aws_interface.read("test_workflow", 1)
+    assert first and second
+
+    first.steps[0].executed = True
+    aws_interface.write_delta(first)
+    second.steps[0].completed = True
+    with pytest.raises(WriteConflict):
+        aws_interface.write_delta(second)
+
+def test_write_task_counts_concurrent_responses(aws_interface):
+    tasks = [Step(1, "step2", f"task_{i}", task_id=i) for i in range(3)]
+    aws_interface.write(State(name="test_workflow", run_id=1, steps=[ParallelStep(1, "step2", tasks)], cache={}, status=Status.InProcess))
+    # every task response is applied to a copy of the state read before any of the others were recorded
+    reads = [aws_interface.read("test_workflow", 1) for _ in range(3)]
+
+    joined = []
+    for i, state in enumerate(reads):
+        assert state
+        step = state.steps[0]
+        assert step.update_task(step.tasks[i], True, True, True)
+        assert aws_interface.write_task(state, 0, i)
+        joined.append(step.completed)
+        assert state.delta()["increments"] == []
+    # only the last response observes the join
+    assert joined == [False, False, True]
+    assert reads[0].version == 2
+    assert reads[2].version == 1 # stale, its next conditional write merges first
+
+    stored = aws_interface.read("test_workflow", 1)
+    assert stored
+    step = stored.steps[0]
+    assert (step.executed_count, step.completed_count, step.succeeded_count) == (3, 3, 3)
+    assert step.completed and step.success
+    assert all(task.success for task in step.tasks)
+
+
+def test_write_task_counts_concurrent_duplicates_once(aws_interface):
+    """
+    Two deliveries of the same completion recorded concurrently, both read the state before either was written.
+    """
+    from switchboard.response import Response
+    from switchboard.schemas import Context
+
+    tasks = [Step(1, "fan_out", f"task_{i}", task_id=i) for i in range(2)]
+    aws_interface.write(State(
+        name="test_workflow", 
+        run_id=1, 
+        steps=[Step(0, "first", "task", True, True, True), ParallelStep(1, "fan_out", tasks)], 
+        cache={}, 
+        status=Status.InProcess
+    ))
+
+    # both deliveries read the state before either records the completion, the retry after the conflict reads alone
+    barrier = threading.Barrier(2)
+    reads = []
+    read_latest = aws_interface.read_latest
+    def read_together(*args):
+        state = read_latest(*args)
+        reads.append(state)
+        if len(reads) <= 2:
+            barrier.wait(timeout=5)
+        return state
+
+    # moto isn't thread safe, requests are serialized server side like the real service applies each one atomically
+    from moto.dynamodb.responses import DynamoHandler
+    lock = threading.Lock()
+    call_action = DynamoHandler.call_action
+    def atomic_call_action(*args, **kwargs):
+        with lock:
+            return call_action(*args, **kwargs)
+
+    pushed = []
+    def respond(_):
+        context = Context("test_workflow", [1, 1, 0], True, True, True, {})
+        Response(Cloud.CUSTOM, aws_interface, "test_workflow", context, custom_queue_push=pushed.append, endpoint="invocation-queue").send()
+
+    with patch.object(aws_interface, "read_latest", side_effect=read_together), patch.object(DynamoHandler, "call_action", atomic_call_action):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            list(pool.map(respond, range(2)))
+
+    stored = aws_interface.read("test_workflow", 1)
+    assert stored
+    step = stored.steps[1]
+    assert (step.executed_count, step.completed_count, step.succeeded_count) == (1, 1, 1)
+    assert not step.completed and pushed == [] and len(reads) == 3
+
+
+def test_fan_in_wakes_workflow_once(aws_interface):
+    import json
+    import switchboard.workflow as wf
+    from switchboard.db import DB
+    from switchboard.response import Response
+    from switchboard.schemas import Context
+
+    tasks = [Step(1, "fan_out", f"task_{i}", task_id=i) for i in range(3)]
+    aws_interface.write(State(
+        name="test_workflow", 
+        run_id=1, 
+        steps=[Step(0, "first", "task", True, True, True), ParallelStep(1, "fan_out", tasks)], 
+        cache={}, 
+        status=Status.InProcess
+    ))
+
+    pushed = []
+    def respond(task_id: int, completed: bool, cache: dict):
+        context = Context("test_workflow", [1, 1, task_id], True, completed, completed, cache)
+        Response(Cloud.CUSTOM, aws_interface, "test_workflow", context, custom_queue_push=pushed.append, endpoint="invocation-queue").send()
+
+    for i in range(3):
+        respond(i, False, {})
+    respond(2, True, {"task_2": 2})
+    respond(0, True, {"task_0": 0})
+    assert pushed == []
+    respond(1, True, {})
+    # a redelivered completion invokes the finished step's workflow again
+    respond(1, True, {})
+    assert len(pushed) == 2
+
+    stored = aws_interface.read("test_workflow", 1)
+    assert stored
+    assert stored.cache == {"task_2": 2, "task_0": 0}
+    assert stored.steps[1].completed and stored.steps[1].success
+
+    # the woken workflow moves on to the next step
+    aws_interface.get_table(TableName.SwitchboardResources).put_item(Item={
+        "component": SwitchboardComponent.ExecutorQueue.value,
+        "name": "test_workflow",
+        "url": "executor-queue",
+        "cloud": Cloud.CUSTOM.value,
+        "resource": "custom",
+        "resource_type": "Queue"
+    })
+    executed = []
+    wf.InitWorkflow(Cloud.CUSTOM, "test_workflow", DB(Cloud.CUSTOM, aws_interface), pushed[0])
+    wf.SetCustomExecutorQueue(executed.append)
+    wf.Call("first", "task")
+    wf.ParallelCall("fan_out", ("task_0", 0), ("task_1", 0), ("task_2", 0))
+    wf.Call("after", "next_task")
+    wf.Done()
+    assert [json.loads(body)["task_key"] for body in executed] == ["next_task"]
+    stored = aws_interface.read("test_workflow", 1)
+    assert stored and stored.steps[-1].step_name == "after"
+
+
+@pytest.fixture
+def sharded_interface(dynamodb_resource):
+    ENDPOINT_CACHE.clear()
+    yield AWS_DataInterface(dynamodb_resource, shard_threshold=5)
+    ENDPOINT_CACHE.clear()
+
+
+def test_sharded_parallel_step_round_trip(sharded_interface):
+    small = ParallelStep(1, "small", [Step(1, "small", f"task_{i}", task_id=i) for i in range(2)])
+    large = ParallelStep(2, "large", [Step(2, "large", f"task_{i}", task_id=i) for i in range(12)])
+    sharded_interface.write(State("test_workflow", 1, [Step(0, "first", "task", True, True, True), small, large], {}, Status.InProcess))
+    assert not small.sharded and large.sharded
+
+    tbl = sharded_interface.get_table()
+    item = tbl.get_item(Key={"name": "test_workflow", "run_id": 1})["Item"]
+    assert item["steps"][1]["task_keys"] == ["task_0", "task_1"]
+    assert "task_keys" not in item["steps"][2] and item["steps"][2]["task_count"] == 12
+    task_items = tbl.query(KeyConditionExpression=Key("name").eq("test_workflow#1"))["Items"]
+    assert [int(task["run_id"]) for task in task_items] == [2 * TASK_KEY_STRIDE + i for i in range(12)]
+
+    state = sharded_interface.read("test_workflow", 1)
+    assert state and state.steps[2].sharded
+    assert [task.task_key for task in state.steps[2].tasks] == [f"task_{i}" for i in range(12)]
+    assert state.find_task(2, 11) is state.steps[2].tasks[11]
+    assert state.delta() == {"fields": [], "increments": [], "append": [], "cache": {}, "cache_removed": [], "status": None}
+
+    # task changes go to their own item, the state item isn't written
+    state.steps[2].tasks[3].retries = 2
+    sharded_interface.write_delta(state)
+    assert state.version == 1
+    stored = sharded_interface.read("test_workflow", 1)
+    assert stored and stored.steps[2].tasks[3].retries == 2
+
+    # a sharded step appended by a delta write
+    stored.steps.append(ParallelStep(3, "appended", [Step(3, "appended", f"task_{i}", task_id=i) for i in range(6)]))
+    sharded_interface.write_delta(stored)
+    assert stored.version == 2
+    stored = sharded_interface.read("test_workflow", 1)
+    assert stored and stored.steps[3].sharded and len(stored.steps[3].tasks) == 6
+
+    # task items don't look like runs to the run_id counter migration
+    assert sharded_interface.seed_run_counters() == {"test_workflow": 1}
+
+
+def test_sharded_write_task_counts_each_response_once(sharded_interface):
+    tasks = [Step(1, "fan_out", f"task_{i}", task_id=i) for i in range(8)]
+    sharded_interface.write(State("test_workflow", 1, [ParallelStep(1, "fan_out", tasks)], {}, Status.InProcess))
+    reads = [sharded_interface.read("test_workflow", 1) for _ in range(8)]
+    # a redelivered response for task 0, applied to a state read before the first delivery was recorded
+    duplicate = sharded_interface.read("test_workflow", 1)
+
+    joined = []
+    for i, state in enumerate(reads):
+        assert state
+        step = state.steps[0]
+        assert step.update_task(step.tasks[i], True, True, True)
+        assert sharded_interface.write_task(state, 0, i)
+        joined.append(step.completed)
+        if i == 0:
+            assert duplicate
+            step = duplicate.steps[0]
+            assert step.update_task(step.tasks[0], True, True, True)
+            assert sharded_interface.write_task(duplicate, 0, 0)
+            assert step.completed_count == 0 and not step.completed
+    assert joined == [False] * 7 + [True]
+
+    stored = sharded_interface.read("test_workflow", 1)
+    assert stored
+    step = stored.steps[0]
+    assert (step.executed_count, step.completed_count, step.succeeded_count) == (8, 8, 8)
+    assert all(task.success for task in step.tasks)
+    # only the header is rewritten by a response, the state item stays the same size
+    item = sharded_interface.get_table().get_item(Key={"name": "test_workflow", "run_id": 1})["Item"]
+    assert "task_keys" not in item["steps"][0]
+
+
+def test_parallel_step_counters_from_old_items():
+    step = ParallelStep.from_dict({
+        "step_id": 1,
+        "step_name": "step2",
+        "tasks": [
+            {"step_id": 1, "step_name": "step2", "task_key": "a", "executed": True, "completed": True, "success": True, "task_id": 0},
+            {"step_id": 1, "step_name": "step2", "task_key": "b", "executed": True, "task_id": 1},
+        ],
+    })
+    assert (step.executed_count, step.completed_count, step.succeeded_count) == (2, 1, 1)
+    assert step.executed and not step.completed
+
+    # redelivered responses are not counted twice
+    assert step.update_task(step.tasks[1], True, True, False)
+    assert not step.update_task(step.tasks[1], True, True, False)
+    assert (step.executed_count, step.completed_count, step.succeeded_count) == (2, 2, 1)
+    assert step.completed and not step.success
+
+
+def test_parallel_step_packs_tasks():
+    tasks = [Step(1, "step2", key, task_id=i, retries=2) for i, key in enumerate(["a", "b", "a", "a"])]
+    tasks[1].executed = tasks[1].completed = True
+    step = ParallelStep(1, "step2", tasks)
+    encoded = step.to_dict()
+    # repeated keys are stored once
+    assert encoded["task_keys"] == ["a", "b"] and encoded["task_key_idx"] == [0, 1, 0, 0]
+    assert encoded["task_executed"] == encoded["task_completed"] == [0, 1, 0, 0] and encoded["task_retries"] == [2] * 4
+    assert "tasks" not in encoded
+
+    decoded = ParallelStep.from_dict(encoded)
+    assert decoded == step
+    # tasks are still Steps, and the same object every time they're accessed
+    task = decoded.tasks[3]
+    assert isinstance(task, Step) and task is decoded.tasks[-1]
+    assert (task.step_id, task.step_name, task.task_key, task.task_id, task.retries) == (1, "step2", "a", 3, 2)
+    assert task.to_dict() == tasks[3].to_dict()
+
+    decoded.mark_clean()
+    assert decoded.update_task(task, True, False, False)
+    decoded.tasks[0].retries -= 1
+    assert decoded.dirty_tasks() == [(0, ["retries"]), (3, ["executed"])]
+    assert task.dirty_fields() == ["executed"]
+    task.mark_clean()
+    assert decoded.dirty_tasks() == [(0, ["retries"])]
+
+    # merged flags are the union of both steps, retries the lowest
+    step.merge_tasks(decoded)
+    assert [t.executed for t in step.tasks] == [False, True, False, True]
+    assert [t.retries for t in step.tasks] == [1, 2, 2, 2]
+    assert step.executed_count == 2
+
+
+def test_write_task_keeps_concurrent_flags_of_one_task(aws_interface):
+    """
+    The executed acknowledgement and the completion of the same task can be recorded concurrently, neither may undo the other's flags.
+    """
+    aws_interface.write(State("test_workflow", 1, [ParallelStep(1, "step2", [Step(1, "step2", f"task_{i}", task_id=i) for i in range(2)])], {}, Status.InProcess))
+    ack, completion = aws_interface.read("test_workflow", 1), aws_interface.read("test_workflow", 1)
+    assert ack and completion
+
+    step = completion.steps[0]
+    assert step.update_task(step.tasks[0], True, True, True)
+    assert aws_interface.write_task(completion, 0, 0)
+    step = ack.steps[0]
+    assert step.update_task(step.tasks[0], True, False, False)
+    # the completion already set the executed flag, the stale acknowledgement can't count it again
+    with pytest.raises(WriteConflict):
+        aws_interface.write_task(ack, 0, 0)
+    ack = aws_interface.read("test_workflow", 1)
+    assert ack and not ack.steps[0].update_task(ack.steps[0].tasks[0], True, False, False)
+
+    item = aws_interface.get_table().get_item(Key={"name": "test_workflow", "run_id": 1})["Item"]
+    assert item["steps"][0]["task_completed"] == item["steps"][0]["task_success"] == [1, 0]
+    assert item["steps"][0]["executed_count"] == 1
+    stored = aws_interface.read("test_workflow", 1)
+    assert stored and stored.steps[0].tasks[0].success
+
+
+def test_read_latest_loads_older_steps_lazily(aws_interface):
+    steps = [Step(i, f"step{i}", "task", True, True, True) for i in range(3)]
+    steps.insert(1, ParallelStep(1, "fan_out", [Step(1, "fan_out", f"task_{i}", True, True, True, task_id=i) for i in range(3)]))
+    for i, step in enumerate(steps):
+        step.step_id = i
+    aws_interface.write(State("test_workflow", 1, steps, {"k": "v"}, Status.InProcess))
+
+    with patch.object(aws_interface, "_read_steps", wraps=aws_interface._read_steps) as read_steps:
+        state = aws_interface.read_latest("test_workflow", 1, 3)
+        assert state and state.steps.peek(0) is None and state.steps.peek(3).step_name == "step2"
+        assert state.find_step("step2") is state.steps[-1]
+        assert state.find_step("missing") is None and len(state.steps) == 4
+
+        # a workflow invocation updating the latest step and appending the next never loads the older steps
+        state.steps[3].retries = 1
+        state.add_step(Step(4, "step4", "task"))
+        aws_interface.write_delta(state)
+        read_steps.assert_not_called()
+
+        # the first access of an older step loads them all at once
+        assert state.find_task(1, 2) is state.steps[1].tasks[2]
+        assert read_steps.call_count == 1
+        assert state.steps[0].success and state.delta()["fields"] == []
+
+    stored = aws_interface.read_latest("test_workflow", 1, 4)
+    assert stored and stored.steps[4].step_name == "step4" and stored.steps[3].retries == 1
+    assert stored.to_dict() == aws_interface.read("test_workflow", 1).to_dict()
+
+    # a context for an earlier step and items written without step names are read in full
+    assert not isinstance(aws_interface.read_latest("test_workflow", 1, 2).steps, LazySteps)
+    aws_interface.get_table().update_item(Key={"name": "test_workflow", "run_id": 1}, UpdateExpression="REMOVE step_names")
+    assert not isinstance(aws_interface.read_latest("test_workflow", 1, 4).steps, LazySteps)
+
+
+def test_cache_values_are_separate_items(aws_interface):
+    aws_interface.write(State("test_workflow", 1, [Step(0, "step0", "task")], {"small": 1, "payload": "x" * 1000, "drop": True}, Status.InProcess))
+    table = aws_interface.get_table()
+    item = table.get_item(Key={"name": "test_workflow", "run_id": 1})["Item"]
+    assert item["cache_keys"] == {"small", "payload", "drop"} and "cache" not in item
+
+    with patch.object(aws_interface, "_read_cache", wraps=aws_interface._read_cache) as read_cache:
+        state = aws_interface.read_latest("test_workflow", 1, 0)
+        assert state and sorted(state.cache) == ["drop", "payload", "small"] and state.cache.loaded() == {}
+
+        # an invocation that doesn't read the cache never fetches or writes it
+        state.steps[0].executed = True
+        aws_interface.write_delta(state)
+        read_cache.assert_not_called()
+        assert state.cache["small"] == 1
+        read_cache.assert_called_once_with("test_workflow", 1, ["small"])
+
+        # a changed value only rewrites its item
+        state.cache["small"] = 2
+        with patch.object(aws_interface, "_update_state") as update_state:
+            aws_interface.write_delta(state)
+        update_state.assert_not_called()
+        assert state.changed_cache_keys() == []
+
+        # adding or removing a key updates the key set with the items in one transaction
+        state.cache["new"] = [1, 2]
+        del state.cache["drop"]
+        aws_interface.write_delta(state)
+        assert read_cache.call_count == 1 and state.version == 3
+
+    item = table.get_item(Key={"name": "test_workflow", "run_id": 1})["Item"]
+    assert item["cache_keys"] == {"small", "payload", "new"}
+    cached = table.query(KeyConditionExpression=Key("name").eq("test_workflow#1#cache"))["Items"]
+    assert {c["cache_key"]: c["value"] for c in cached} == {"small": 2, "payload": "x" * 1000, "new": [1, 2]}
+    assert aws_interface.read("test_workflow", 1).cache == {"small": 2, "payload": "x" * 1000, "new": [1, 2]}
+    assert aws_interface.seed_run_counters() == {"test_workflow": 1}
+
+
+def test_cache_map_is_moved_to_cache_items(aws_interface):
+    table = aws_interface.get_table()
+    table.put_item(Item={"name": "test_workflow", "run_id": 1, "steps": [Step(0, "step0", "task").to_dict()], "cache": {"k": "v"}, "status": Status.InProcess.value, "version": 1})
+
+    state = aws_interface.read("test_workflow", 1)
+    assert state and state.cache == {"k": "v"}
+    state.status = Status.Completed
+    aws_interface.write_delta(state)
+
+    item = table.get_item(Key={"name": "test_workflow", "run_id": 1})["Item"]
+    assert item["cache_keys"] == {"k"} and "cache" not in item
+    assert aws_interface.read_latest("test_workflow", 1, 0).cache == {"k": "v"}
+
+
+def test_write_task_adds_cache_keys(aws_interface):
+    tasks = [Step(0, "fan_out", f"task_{i}", task_id=i) for i in range(2)]
+    aws_interface.write(State("test_workflow", 1, [ParallelStep(0, "fan_out", tasks)], {"shared": 0}, Status.InProcess))
+    reads = [aws_interface.read("test_workflow", 1) for _ in range(2)]
+
+    for i, state in enumerate(reads):
+        assert state
+        step = state.steps[0]
+        assert step.update_task(step.tasks[i], True, True, True)
+        state.cache[f"result_{i}"] = i
+        state.cache["shared"] = i
+        assert aws_interface.write_task(state, 0, i)
+
+    item = aws_interface.get_table().get_item(Key={"name": "test_workflow", "run_id": 1})["Item"]
+    assert item["cache_keys"] == {"shared", "result_0", "result_1"}
+    assert aws_interface.read("test_workflow", 1).cache == {"shared": 1, "result_0": 0, "result_1": 1}
+
+
 def test_read_returns_none(aws_interface):
     result = aws_interface.read("test_new_workflow",-1)
     assert result is None
@@ -86,11 +558,61 @@ def test_increment_id_existing(aws_interface):
     # Manually insert one item
     table = aws_interface.get_table()
     table.put_item(Item={"name": "workflow_x", "run_id": 7})
+    aws_interface.seed_run_counters(["workflow_x"])
     
     new_id = aws_interface.increment_id("workflow_x")
     assert new_id == 8
 
 
+def test_increment_id_seeds_missing_counter(aws_interface):
+    # a table written before run_id counters existed, without running seed_run_counters()
+    table = aws_interface.get_table()
+    for run_id in (3, 7):
+        table.put_item(Item={"name": "workflow_x", "run_id": run_id})
+
+    assert aws_interface.increment_id("workflow_x") == 8
+    assert aws_interface.increment_id("workflow_x") == 9
+
+
+def test_seed_run_counters_scan(aws_interface):
+    table = aws_interface.get_table()
+    for name, run_id in [("workflow_x", 3), ("workflow_x", 9), ("workflow_y", 4)]:
+        table.put_item(Item={"name": name, "run_id": run_id})
+    # a counter that is already ahead must not move backwards
+    for _ in range(12):
+        aws_interface.increment_id("workflow_z")
+    table.put_item(Item={"name": "workflow_z", "run_id": 5})
+
+    assert aws_interface.seed_run_counters() == {"workflow_x": 9, "workflow_y": 4, "workflow_z": 5}
+    # seeding twice is harmless
+    aws_interface.seed_run_counters()
+
+    assert aws_interface.increment_id("workflow_x") == 10
+    assert aws_interface.increment_id("workflow_y") == 5
+    assert aws_interface.increment_id("workflow_z") == 13
+
+
+def test_increment_id_concurrent_triggers_are_unique(aws_interface):
+    # DynamoDB applies each UpdateItem atomically, moto doesn't, so requests are serialized server side like the real service.
+    # Triggers still race each other client side, which is what broke the old query-then-add allocation.
+    # The lock wraps the request handler so the returned attributes are serialized before the next update.
+    from moto.dynamodb.responses import DynamoHandler
+    lock = threading.Lock()
+    update_item = DynamoHandler.update_item
+
+    def atomic_update_item(*args, **kwargs):
+        with lock:
+            return update_item(*args, **kwargs)
+
+    triggers = 2000
+    with patch.object(DynamoHandler, "update_item", atomic_update_item):
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            ids = list(pool.map(lambda _: aws_interface.increment_id("workflow_burst"), range(triggers)))
+
+    assert len(set(ids)) == triggers
+    assert sorted(ids) == list(range(1, triggers + 1))
+
+
 def test_get_endpoint_success(aws_interface):
     tbl = aws_interface.get_table(TableName.SwitchboardResources)
     tbl.put_item(Item={
@@ -107,10 +629,56 @@ def test_get_endpoint_success(aws_interface):
 
 
 def test_get_endpoint_missing_item_raises(aws_interface):
-    with pytest.raises(Exception):
+    with pytest.raises(EndpointNotFound):
         aws_interface.get_endpoint("nonexistent", SwitchboardComponent.ExecutorQueue)
 
 
+def test_get_endpoint_is_cached(aws_interface):
+    tbl = aws_interface.get_table(TableName.SwitchboardResources)
+    tbl.put_item(Item={
+        "component": SwitchboardComponent.InvocationQueue.value,
+        "name": "test_workflow",
+        "url": "https://sqs/mock/url",
+        "cloud": Cloud.AWS.value,
+        "resource": "SQS",
+        "resource_type": "Queue"
+    })
+
+    for _ in range(5):
+        assert aws_interface.get_endpoint("test_workflow", SwitchboardComponent.InvocationQueue) == "https://sqs/mock/url"
+    # a new interface (e.g. a new DB() per task) shares the same cache
+    assert AWS_DataInterface(aws_interface.conn).get_endpoint("test_workflow", SwitchboardComponent.InvocationQueue) == "https://sqs/mock/url"
+    assert ENDPOINT_CACHE.stats()["misses"] == 1
+    assert ENDPOINT_CACHE.stats()["hits"] == 5
+
+    tbl.put_item(Item={
+        "component": SwitchboardComponent.InvocationQueue.value,
+        "name": "test_workflow",
+        "url": "https://sqs/mock/new-url",
+        "cloud": Cloud.AWS.value,
+        "resource": "SQS",
+        "resource_type": "Queue"
+    })
+    assert aws_interface.get_endpoint("test_workflow", SwitchboardComponent.InvocationQueue) == "https://sqs/mock/url"
+    ENDPOINT_CACHE.invalidate("test_workflow")
+    assert aws_interface.get_endpoint("test_workflow", SwitchboardComponent.InvocationQueue) == "https://sqs/mock/new-url"
+
+
+def test_get_endpoint_negative_cache(aws_interface):
+    for _ in range(3):
+        with pytest.raises(EndpointNotFound):
+            aws_interface.get_endpoint("nonexistent", SwitchboardComponent.ExecutorQueue)
+    assert ENDPOINT_CACHE.stats()["misses"] == 1
+    assert ENDPOINT_CACHE.stats()["negative_hits"] == 2
+
+
+def test_get_endpoint_cache_expires(aws_interface):
+    ENDPOINT_CACHE.put("expired", SwitchboardComponent.ExecutorQueue, "https://sqs/stale/url")
+    with patch("switchboard.db.time.monotonic", return_value=float("inf")):
+        with pytest.raises(EndpointNotFound):
+            aws_interface.get_endpoint("expired", SwitchboardComponent.ExecutorQueue)
+
+
 
 
 
@@ -149,3 +717,156 @@ def test_AWS_message_push(aws_credentials):
 
 
 
+
+
+@mock_aws
+def test_S3BlobStore(aws_credentials):
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="claims")
+        store = S3BlobStore("claims", client=s3)
+
+        assert not store.exists("abc")
+        store.put("abc", b'{"payload": 1}')
+        assert store.exists("abc") and store.get("abc") == b'{"payload": 1}'
+        assert s3.list_objects_v2(Bucket="claims")["Contents"][0]["Key"] == "switchboard/claims/abc"
+        with pytest.raises(ClaimNotFound):
+            store.get("missing")
+
+
+def test_AWS_sqs_client_is_cached(aws_credentials):
+    reset_clients()
+    client = AWS_sqs_client()
+    assert AWS_sqs_client() is client
+    assert AWS_sqs_client(region_name="us-west-2") is not client
+    assert CLIENT_STATS["sqs_clients_created"] == 2
+    # configs are compared by their options
+    pooled = AWS_sqs_client(config=Config(max_pool_connections=10, retries={"max_attempts": 2}))
+    assert AWS_sqs_client(config=Config(max_pool_connections=10, retries={"max_attempts": 2})) is pooled
+    assert AWS_sqs_client(config=Config(max_pool_connections=20, retries={"max_attempts": 2})) is not pooled
+    assert CLIENT_STATS["sqs_clients_created"] == 4
+    reset_clients()
+
+
+@mock_aws
+def test_AWS_message_push_batch(aws_credentials):
+    reset_clients()
+    sqs = boto3.client("sqs", region_name="us-east-1")
+    queue_url = sqs.create_queue(QueueName="test-batch-queue")["QueueUrl"]
+
+    msgs = [f"msg-{i}" for i in range(25)]
+    with patch.object(AWS_sqs_client(), "send_message_batch", wraps=AWS_sqs_client().send_message_batch) as send:
+        response = AWS_message_push_batch(endpoint=queue_url, msgs=msgs)
+
+    # 25 messages should only need 3 round trips
+    assert send.call_count == 3
+    assert len(response["Successful"]) == 25
+    assert response["Failed"] == []
+    assert sorted(int(e["Id"]) for e in response["Successful"]) == list(range(25))
+    reset_clients()
+
+
+@mock_aws
+def test_QueuePushAsync_overlaps_pushes(aws_credentials):
+    reset_clients()
+    sqs = boto3.client("sqs", region_name="us-east-1")
+    queue_url = sqs.create_queue(QueueName="test-async-queue")["QueueUrl"]
+
+    async def push_all() -> list[dict]:
+        return await asyncio.gather(*(QueuePushAsync(Cloud.AWS, queue_url, f"msg-{i}") for i in range(20)))
+
+    threads = set()
+    send = AWS_sqs_client().send_message
+    def record_thread(*args, **kwargs):
+        threads.add(threading.current_thread().name)
+        return send(*args, **kwargs)
+
+    with patch.object(AWS_sqs_client(), "send_message", side_effect=record_thread):
+        responses = asyncio.run(push_all())
+
+    assert all("MessageId" in response for response in responses)
+    # every push ran on the bounded push pool, not the event loop's thread
+    assert threads and all(name.startswith("switchboard-push") for name in threads)
+    attributes = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=["ApproximateNumberOfMessages"])["Attributes"]
+    assert attributes["ApproximateNumberOfMessages"] == "20"
+    reset_clients()
+
+
+def test_AWS_message_push_batch_retries_only_failed_entries():
+    client = MagicMock()
+    client.send_message_batch.side_effect = [
+        {"Successful": [{"Id": "0"}], "Failed": [{"Id": "1", "SenderFault": False, "Code": "InternalError"}, {"Id": "2", "SenderFault": True, "Code": "InvalidMessageContents"}]},
+        {"Successful": [{"Id": "1"}], "Failed": []},
+    ]
+    with patch("switchboard.cloud.AWS_sqs_client", return_value=client), patch("switchboard.cloud.time.sleep"):
+        response = AWS_message_push_batch(endpoint="https://sqs/mock/url", msgs=["a", "b", "c"])
+
+    assert client.send_message_batch.call_count == 2
+    retried = client.send_message_batch.call_args_list[1].kwargs["Entries"]
+    assert retried == [{"Id": "1", "MessageBody": "b"}]
+    assert [e["Id"] for e in response["Successful"]] == ["0", "1"]
+    assert [e["Id"] for e in response["Failed"]] == ["2"]
+
+
+def test_get_endpoints_single_batch_read(aws_interface):
+    tbl = aws_interface.get_table(TableName.SwitchboardResources)
+    for component in SwitchboardComponent:
+        tbl.put_item(Item={
+            "component": component.value,
+            "name": "test_workflow",
+            "url": f"https://sqs/mock/{component.value}",
+            "cloud": Cloud.AWS.value,
+            "resource": "SQS",
+            "resource_type": "Queue"
+        })
+
+    with patch.object(aws_interface.conn, "batch_get_item", wraps=aws_interface.conn.batch_get_item) as batch_get:
+        endpoints = aws_interface.get_endpoints("test_workflow")
+        assert endpoints == {c: f"https://sqs/mock/{c.value}" for c in SwitchboardComponent}
+        assert batch_get.call_count == 1
+
+        # prefetched endpoints are served from the cache afterwards
+        aws_interface.get_endpoints("test_workflow")
+        assert batch_get.call_count == 1
+    assert aws_interface.get_endpoint("test_workflow", SwitchboardComponent.ExecutorQueue) == "https://sqs/mock/ExecutorQueue"
+    assert ENDPOINT_CACHE.stats()["misses"] == 1
+
+
+def test_increment_id_reserves_blocks(aws_interface):
+    # two warm containers sharing the same counter item
+    container_a = AWS_DataInterface(aws_interface.conn, run_id_blocks=RunIdBlocks(min_block=10, max_block=10))
+    container_b = AWS_DataInterface(aws_interface.conn, run_id_blocks=RunIdBlocks(min_block=10, max_block=10))
+
+    ids = []
+    for _ in range(25):
+        ids.append(container_a.increment_id("workflow_blocks"))
+        ids.append(container_b.increment_id("workflow_blocks"))
+
+    assert len(set(ids)) == 50
+    # 50 run_ids from 6 counter writes of 10
+    counter = aws_interface.get_table().get_item(Key=aws_interface._run_counter_key("workflow_blocks"))["Item"]
+    assert counter["next_run_id"] == 60
+    assert container_a.run_id_blocks.stats() == {"reservations": 3, "allocated": 25}
+
+
+def test_run_id_block_size_adapts_to_trigger_rate():
+    blocks = RunIdBlocks(min_block=1, max_block=8, target_seconds=10)
+    counter = {"value": 0}
+    sizes = []
+
+    def reserve(size):
+        sizes.append(size)
+        counter["value"] += size
+        return counter["value"]
+
+    with patch("switchboard.db.time.monotonic", return_value=0):
+        # bursts use up every block immediately, so blocks keep doubling up to the max
+        ids = [blocks.next("wf", reserve) for _ in range(30)]
+    assert sizes == [1, 2, 4, 8, 8, 8]
+
+    with patch("switchboard.db.time.monotonic", return_value=1000):
+        # a quiet period shrinks the next block
+        for _ in range(2):
+            ids.append(blocks.next("wf", reserve))
+    assert sizes[-1] == 4
+    assert len(set(ids)) == len(ids)
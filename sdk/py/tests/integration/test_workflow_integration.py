@@ -3,9 +3,10 @@ import json
 
 from switchboard.enums import Cloud
 from switchboard.response import Trigger
-from switchboard.workflow import GetCache, InitWorkflow, Call, Done, ParallelCall, SetCustomExecutorQueue, Workflow
+from switchboard.workflow import GetCache, InitWorkflow, Call, Done, ParallelCall, SetCustomExecutorQueue, process_batch
 from switchboard.db import DB
 from switchboard.executor import switchboard_execute
+from switchboard.plan import compiled_workflow
 from .tasks import task_map, mock_invocation_queue
 from .db import DBMockInterface
 
@@ -16,8 +17,12 @@ from .db import DBMockInterface
 
 
 @pytest.mark.integration
-def test_endtoend_integration():
+@pytest.mark.parametrize("ack", [True, False])
+@pytest.mark.parametrize("batch", [False, True])
+@pytest.mark.parametrize("plan", [False, True])
+def test_endtoend_integration(ack, batch, plan):
     db = DB(Cloud.CUSTOM, DBMockInterface(None))
+    workflow_invocations = []
     
     # Simulate message queues
     workflow_queue = []
@@ -34,6 +39,7 @@ def test_endtoend_integration():
         executor_queue.append(body)
 
     def workflow_serverless_function(context):
+        workflow_invocations.append(json.loads(context))
         InitWorkflow(Cloud.CUSTOM, 'test_workflow', db, context)
         # The workflow service uses a custom push function to send messages to the executor
         SetCustomExecutorQueue(push_to_executor_queue)
@@ -58,7 +64,9 @@ def test_endtoend_integration():
         Call("endstep", "endstep")
 
         Done()
-        Workflow._reset_singleton()
+
+    if plan:
+        workflow_serverless_function = compiled_workflow(workflow_serverless_function)
         
     def executor_serverless_function(context):
         # The executor service gets its custom push function via the response object in tasks.py
@@ -66,7 +74,7 @@ def test_endtoend_integration():
         mock_invocation_queue.set_push_function(push_to_workflow_queue)
 
         cntxt = json.loads(context)
-        switchboard_execute(Cloud.CUSTOM, db.interface, cntxt, task_map, custom_invocation_queue=push_to_workflow_queue)
+        switchboard_execute(Cloud.CUSTOM, db.interface, cntxt, task_map, custom_invocation_queue=push_to_workflow_queue, ack=ack)
 
 
     # 1. Trigger the start of the workflow
@@ -77,18 +85,26 @@ def test_endtoend_integration():
 
     # 2. Process messages in a loop to simulate parallel execution
     while workflow_queue or executor_queue:
-        # Process one message from the workflow queue
-        if workflow_queue:
+        # Process one message from the workflow queue, or every queued message as one batch
+        if workflow_queue and batch:
+            records = [{"messageId": str(i), "body": body} for i, body in enumerate(workflow_queue)]
+            workflow_queue.clear()
+            assert process_batch(records, workflow_serverless_function) == {"batchItemFailures": []}
+        elif workflow_queue:
             workflow_payload = workflow_queue.pop(0)
             workflow_serverless_function(workflow_payload)
 
-        # Process one message from the executor queue
-        if executor_queue:
+        # Process one message from the executor queue, or all of them so the responses are batched together
+        while executor_queue:
             executor_payload = executor_queue.pop(0)
             executor_serverless_function(executor_payload)
+            if not batch:
+                break
 
 
     # 3. Assert the final state
+    if plan:
+        assert workflow_serverless_function.plan is not None
     final_state = db.interface.read('test_workflow', 1)
     assert final_state is not None
     assert len(final_state.steps) == 6, f"{final_state.steps}"
@@ -97,5 +113,13 @@ def test_endtoend_integration():
     assert [step.success for step in final_state.steps] == [True,True,True,True,True,True]
     assert final_state.cache == {"test_true": True, "test_false": False}
 
-
-
+    # without the executor's acknowledgement the workflow is only invoked by the trigger and each task's completion
+    acks = [c for c in workflow_invocations if c["executed"] and not c["completed"]]
+    if batch:
+        # the trigger and one invocation per step, each step's responses arrive in one batch
+        assert len(workflow_invocations) == 7
+    elif ack:
+        assert len(acks) == 9
+    else:
+        assert acks == []
+        assert len(workflow_invocations) == 10
@@ -0,0 +1,204 @@
+import pytest
+import json
+from unittest.mock import patch
+
+import switchboard.plan as plan
+import switchboard.workflow as wf
+from switchboard.db import DB
+from switchboard.enums import Cloud
+from switchboard.plan import PlanError, compiled_workflow
+from switchboard.response import Trigger
+from switchboard.workflow import Call, Done, GetCache, InitWorkflow, ParallelCall, SetCustomExecutorQueue
+from .integration.db import DBMockInterface
+
+
+
+
+def run_to_completion(workflow_fn, db: DB) -> list[dict]:
+    '''
+    Drive a run with an executor that completes every task successfully. Returns the contexts the workflow was invoked with.
+    '''
+    workflow_queue, executor_queue, invocations = [], [], []
+    Trigger(Cloud.CUSTOM, db.interface, "plan_workflow", custom_queue_push=workflow_queue.append)
+    while workflow_queue:
+        context = workflow_queue.pop(0)
+        invocations.append(json.loads(context))
+        workflow_fn(context, executor_queue.append)
+        while executor_queue:
+            body = json.loads(executor_queue.pop(0))
+            del body["task_key"]
+            workflow_queue.append(json.dumps(body | {"executed": True, "completed": True, "success": True}))
+    return invocations
+
+
+def make_workflow(db: DB):
+    def workflow(context: str, push):
+        '''Docstrings are skipped.'''
+        InitWorkflow(Cloud.CUSTOM, "plan_workflow", db, context)
+        SetCustomExecutorQueue(push)
+        cache = GetCache()
+
+        Call("step0", "task0")
+        Call("step1", "task1", retries=1)
+        if cache.get("skip"):
+            Call("skipped", "task")
+        else:
+            ParallelCall("fan_out", ("a", 0), ("b", 0))
+            pass
+        Call("step2", "task2")
+        return Done()
+    return workflow
+
+
+def test_compiled_workflow_matches_replay():
+    """
+    A compiled workflow should take the same steps as replaying it, jumping to the current step instead of passing over the completed ones.
+    """
+    stats = dict(plan.PLAN_STATS)
+    results = {}
+    for mode in ["replay", "plan"]:
+        db = DB(Cloud.CUSTOM, DBMockInterface(None))
+        workflow = make_workflow(db)
+        if mode == "plan":
+            workflow = compiled_workflow(workflow)
+        with patch.object(wf.WorkflowRun, "_next", autospec=True, side_effect=wf.WorkflowRun._next) as next_step:
+            invocations = run_to_completion(workflow, db)
+        state = db.interface.read("plan_workflow", 1)
+        results[mode] = ([step.step_name for step in state.steps], [step.success for step in state.steps], len(invocations), next_step.call_count)
+
+    assert results["replay"][:3] == results["plan"][:3]
+    assert results["plan"][0] == ["step0", "step1", "fan_out", "step2"]
+    assert all(results["plan"][1])
+    # each invocation passes over at most the step it was woken up for
+    assert results["plan"][3] <= results["plan"][2] < results["replay"][3]
+    assert plan.PLAN_STATS["compiled"] == stats["compiled"] + 1
+    assert plan.PLAN_STATS["walks"] == stats["walks"] + 1 # only the trigger
+    assert plan.PLAN_STATS["jumps"] == stats["jumps"] + results["plan"][2] - 1
+
+
+def test_compiled_workflow_follows_conditional_edges():
+    db = DB(Cloud.CUSTOM, DBMockInterface(None))
+    workflow = compiled_workflow(make_workflow(db))
+    original = db.interface.read
+
+    def read(name, run_id):
+        state = original(name, run_id)
+        if state:
+            state.cache["skip"] = True
+        return state
+
+    with patch.object(db.interface, "read", side_effect=read):
+        run_to_completion(workflow, db)
+
+    assert workflow.plan is not None
+    assert [step.step_name for step in db.interface.read("plan_workflow", 1).steps] == ["step0", "step1", "skipped", "step2"]
+    assert wf.CURRENT_RUN.get() is None
+
+
+def test_unplannable_workflow_is_replayed():
+    db = DB(Cloud.CUSTOM, DBMockInterface(None))
+    fallbacks = plan.PLAN_STATS["fallbacks"]
+
+    @compiled_workflow
+    def workflow(context: str, push):
+        InitWorkflow(Cloud.CUSTOM, "plan_workflow", db, context)
+        SetCustomExecutorQueue(push)
+        for i in range(3):
+            Call(f"step{i}", "task")
+        Done()
+
+    run_to_completion(workflow, db)
+
+    assert workflow.plan is None
+    assert plan.PLAN_STATS["fallbacks"] == fallbacks + 1
+    assert [step.step_name for step in db.interface.read("plan_workflow", 1).steps] == ["step0", "step1", "step2"]
+
+
+def test_comprehension_reading_a_local_is_replayed():
+    """
+    A generator expression in a condition can't see the variables assigned before the first step when evaluated from a plan, the workflow is replayed.
+    """
+    db = DB(Cloud.CUSTOM, DBMockInterface(None))
+
+    @compiled_workflow
+    def workflow(context: str, push):
+        InitWorkflow(Cloud.CUSTOM, "plan_workflow", db, context)
+        SetCustomExecutorQueue(push)
+        limit = 1
+        Call("step0", "task")
+        if any(v > limit for v in [2, 3]):
+            Call("step1", "task")
+        Call("step2", "task")
+        Done()
+
+    run_to_completion(workflow, db)
+
+    assert workflow.plan is None
+    assert [step.step_name for step in db.interface.read("plan_workflow", 1).steps] == ["step0", "step1", "step2"]
+
+
+def uses_loop(context):
+    InitWorkflow(Cloud.CUSTOM, "plan_workflow", None, context)
+    while True:
+        Call("step", "task")
+    Done()
+
+def reused_step(context):
+    InitWorkflow(Cloud.CUSTOM, "plan_workflow", None, context)
+    Call("step", "task")
+    Call("step", "task")
+    Done()
+
+def dynamic_step_name(context, name):
+    InitWorkflow(Cloud.CUSTOM, "plan_workflow", None, context)
+    Call(name, "task")
+    Done()
+
+def early_return(context):
+    InitWorkflow(Cloud.CUSTOM, "plan_workflow", None, context)
+    if not context:
+        return
+    Call("step", "task")
+    Done()
+
+def no_done(context):
+    InitWorkflow(Cloud.CUSTOM, "plan_workflow", None, context)
+    Call("step", "task")
+
+def assignment_between_steps(context):
+    InitWorkflow(Cloud.CUSTOM, "plan_workflow", None, context)
+    Call("step", "task")
+    flag = GetCache().get("flag")
+    if flag:
+        Call("other", "task")
+    Done()
+
+def walrus_between_steps(context):
+    InitWorkflow(Cloud.CUSTOM, "plan_workflow", None, context)
+    Call("step", "task")
+    print(flag := GetCache().get("flag"))
+    if flag:
+        Call("other", "task")
+    Done()
+
+def comprehension_reads_local(context):
+    InitWorkflow(Cloud.CUSTOM, "plan_workflow", None, context)
+    limit = 1
+    Call("step0", "task")
+    if any(v > limit for v in [2, 3]):
+        Call("step1", "task")
+    Done()
+
+@pytest.mark.parametrize("workflow_fn, reason", [
+    (uses_loop, "can't be planned statically"),
+    (reused_step, "called more than once"),
+    (dynamic_step_name, "string literals"),
+    (early_return, "can end before its first step"),
+    (no_done, "has to end with"),
+    (assignment_between_steps, "can't be planned statically"),
+    (walrus_between_steps, "can't be planned statically"),
+    (comprehension_reads_local, "comprehension or lambda"),
+])
+def test_compile_rejects_dynamic_workflows(workflow_fn, reason):
+    with pytest.raises(PlanError, match=reason):
+        plan._compile(workflow_fn)
@@ -1,9 +1,13 @@
 import pytest
+import asyncio
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, MagicMock
-from switchboard.enums import Cloud, Status
+from switchboard.enums import Cloud, Status, SwitchboardComponent
 from switchboard.schemas import State, Step, ParallelStep
-from switchboard.db import DB, DBInterface
+from switchboard.db import DB, DBInterface, WriteConflict
+from switchboard.invocation import EnqueueFailed
 import switchboard.workflow as wf
 
 
@@ -22,15 +26,17 @@ NEW_WORKFLOW_CONTEXT = json.dumps({
 def mock_db():
     """Fixture to create a mock DBInterface."""
     db_mock = MagicMock(spec=DBInterface)
+    db_mock.get_endpoints.return_value = {}
+    db_mock.write_task.return_value = False
+    db_mock.read_latest.side_effect = lambda name, id, step_idx: db_mock.read(name, id)
     return DB(Cloud.CUSTOM, db_mock), db_mock
 
 
 @pytest.fixture(autouse=True, scope="function")
-def clear_singleton():
+def clear_current_run():
     yield
-    # After the test runs, reset the singleton state
-    wf.Workflow._reset_singleton()
-    wf.WORKFLOW = None
+    # After the test runs, clear the current run
+    wf.CURRENT_RUN.set(None)
 
 
 
@@ -45,9 +51,9 @@ def test_InitWorkflow_for_new_run(mock_db):
 
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
     
-    assert wf.WORKFLOW is not None
-    assert wf.WORKFLOW.state.name == "test_workflow"
-    assert wf.WORKFLOW.state.run_id == 123
+    assert wf.CURRENT_RUN.get() is not None
+    assert wf.CURRENT_RUN.get().state.name == "test_workflow"
+    assert wf.CURRENT_RUN.get().state.run_id == 123
     db_mock.read.assert_not_called()
     db_mock.increment_id.assert_called_once_with("test_workflow")
 
@@ -79,14 +85,46 @@ def test_InitWorkflow_for_existing_run(mock_db):
 
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=context_json)
     
-    assert wf.WORKFLOW is not None
+    assert wf.CURRENT_RUN.get() is not None
     db_mock.read.assert_called_once_with("test_workflow", 456)
-    assert wf.WORKFLOW.state.steps[0].executed is True, f"{wf.WORKFLOW}"
-    assert wf.WORKFLOW.state.steps[0].completed is False
-    assert wf.WORKFLOW.state.cache == {"initial_data": "value", "new_data": "added"}
+    assert wf.CURRENT_RUN.get().state.steps[0].executed is True, f"{wf.CURRENT_RUN.get()}"
+    assert wf.CURRENT_RUN.get().state.steps[0].completed is False
+    assert wf.CURRENT_RUN.get().state.cache == {"initial_data": "value", "new_data": "added"}
 
 
-@patch("switchboard.workflow.Workflow._enqueue_execution")
+@patch("switchboard.workflow.WorkflowRun._enqueue_execution")
+def test_completion_without_executed_ack(mock_enqueue, mock_db):
+    """
+    A completion response should be accepted for a step that never received the executor's executed acknowledgement.
+    """
+    db, db_mock = mock_db
+    db_mock.read.return_value = State(
+        name="test_workflow",
+        run_id=456,
+        steps=[Step(step_id=0, step_name="step1", task_key="task1")],
+        cache={},
+        status=Status.InProcess
+    )
+    context_json = json.dumps({
+        "workflow": "test_workflow",
+        "ids": [456, 0, -1],
+        "executed": False,
+        "completed": True,
+        "success": True,
+        "cache": {}
+    })
+
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=context_json)
+    step = wf.CURRENT_RUN.get().state.steps[0]
+    assert step.executed and step.completed and step.success
+
+    wf.Call("step1", "task1")
+    wf.Call("step2", "task2")
+    mock_enqueue.assert_called_once()
+    assert wf.CURRENT_RUN.get().state.steps[-1].step_name == "step2"
+
+
+@patch("switchboard.workflow.WorkflowRun._enqueue_execution")
 def test_Call_enqueues_task_for_new_step(mock_enqueue, mock_db):
     """
     Call should call _enqueue_execution when a step is called for the first time.
@@ -99,13 +137,13 @@ def test_Call_enqueues_task_for_new_step(mock_enqueue, mock_db):
     
     wf.Call("first_step", "do_some_work")
     
-    assert isinstance(wf.WORKFLOW, wf.WaitStatus)
-    assert len(wf.WORKFLOW.state.steps) == 1
-    assert wf.WORKFLOW.state.steps[0].step_name == "first_step"
+    assert isinstance(wf.CURRENT_RUN.get(), wf.WaitStatus)
+    assert len(wf.CURRENT_RUN.get().state.steps) == 1
+    assert wf.CURRENT_RUN.get().state.steps[0].step_name == "first_step"
     mock_enqueue.assert_called_once()
 
 
-@patch("switchboard.workflow.Workflow._enqueue_execution")
+@patch("switchboard.workflow.WorkflowRun._enqueue_execution")
 def test_Call_is_noop_if_step_already_completed(mock_enqueue, mock_db):
     """
     Call should not call _enqueue_execution when step was already completed.
@@ -116,17 +154,17 @@ def test_Call_is_noop_if_step_already_completed(mock_enqueue, mock_db):
 
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
     
-    assert(isinstance(wf.WORKFLOW,wf.Workflow))
-    wf.WORKFLOW.state.steps.append(Step(step_id=0, step_name="first_step", executed=True, completed=True, success=True, task_key="do_work", retries=0))
-    wf.WORKFLOW.step_cnt = 1
+    assert(isinstance(wf.CURRENT_RUN.get(),wf.WorkflowRun))
+    wf.CURRENT_RUN.get().state.steps.append(Step(step_id=0, step_name="first_step", executed=True, completed=True, success=True, task_key="do_work", retries=0))
+    wf.CURRENT_RUN.get().step_cnt = 1
 
     wf.Call("first_step", "do_work")
     
-    assert isinstance(wf.WORKFLOW, wf.WaitStatus) 
+    assert isinstance(wf.CURRENT_RUN.get(), wf.WaitStatus) 
     mock_enqueue.assert_not_called()
 
 
-@patch("switchboard.workflow.Workflow._enqueue_execution")
+@patch("switchboard.workflow.WorkflowRun._enqueue_execution")
 def test_Call_respects_WaitStatus(mock_enqueue, mock_db):
     """
     Call should not enqueue a task if the workflow is already in a WaitStatus.
@@ -137,17 +175,17 @@ def test_Call_respects_WaitStatus(mock_enqueue, mock_db):
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
     
     # Manually set the workflow to a waiting state
-    wf.WORKFLOW = wf.WaitStatus(status=wf.Status.InProcess, state=wf.WORKFLOW.state)
+    wf.CURRENT_RUN.set(wf.WaitStatus(status=wf.Status.InProcess, state=wf.CURRENT_RUN.get().state))
 
     wf.Call("second_step", "do_another_thing")
 
     mock_enqueue.assert_not_called()
 
 
-@patch("switchboard.workflow.Workflow._enqueue_execution")
+@patch("switchboard.workflow.WorkflowRun._enqueue_batch_execution")
 def test_ParallelCall_enqueues_multiple_tasks(mock_enqueue, mock_db):
     """
-    ParallelCall should call _enqueue_execution for each task passed to it.
+    ParallelCall should enqueue every task passed to it in a single batch.
     """
 
     db, db_mock = mock_db
@@ -157,12 +195,77 @@ def test_ParallelCall_enqueues_multiple_tasks(mock_enqueue, mock_db):
     
     wf.ParallelCall("parallel_step", ("task_a",0), ("task_b",0))
     
-    assert isinstance(wf.WORKFLOW, wf.WaitStatus)
-    assert isinstance(wf.WORKFLOW.state.steps[0], ParallelStep)
-    assert mock_enqueue.call_count == 2
+    assert isinstance(wf.CURRENT_RUN.get(), wf.WaitStatus)
+    assert isinstance(wf.CURRENT_RUN.get().state.steps[0], ParallelStep)
+    mock_enqueue.assert_called_once()
+    assert mock_enqueue.call_args.args[3] == [("task_a", 0), ("task_b", 1)]
+
+
+def test_ParallelCall_uses_custom_batch_queue(mock_db):
+    """
+    ParallelCall should push all task messages through the custom batch function with a single endpoint lookup.
+    """
+    db, db_mock = mock_db
+    db_mock.read.return_value = None
+    db_mock.increment_id.return_value = 1
+    db_mock.get_endpoints.return_value = {SwitchboardComponent.ExecutorQueue: "mocked/executor"}
+    single_push = MagicMock()
+    batch_push = MagicMock(return_value={"Successful": [], "Failed": []})
+
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
+    wf.SetCustomExecutorQueue(single_push, batch_push)
+    wf.ParallelCall("parallel_step", ("task_a",0), ("task_b",0), ("task_c",0))
+
+    single_push.assert_not_called()
+    batch_push.assert_called_once()
+    bodies = [json.loads(b) for b in batch_push.call_args.args[0]]
+    assert [b["task_key"] for b in bodies] == ["task_a", "task_b", "task_c"]
+    assert [b["ids"][2] for b in bodies] == [0, 1, 2]
+    # the executor endpoint was prefetched by InitWorkflow
+    db_mock.get_endpoints.assert_called_once_with("test_workflow")
+    db_mock.get_endpoint.assert_not_called()
+
+
+def test_endpoint_prefetch_failure_falls_back_to_lookups(mock_db):
+    """
+    A DBInterface whose get_endpoints() fails should not break InitWorkflow, every dispatch looks up its own endpoint instead.
+    """
+    db, db_mock = mock_db
+    db_mock.read.return_value = None
+    db_mock.increment_id.return_value = 1
+    db_mock.get_endpoints.side_effect = RuntimeError("get_endpoints is not supported")
+    db_mock.get_endpoint.return_value = "mocked/executor"
+    single_push = MagicMock()
+
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
+    wf.SetCustomExecutorQueue(single_push)
+    wf.Call("step", "task_a")
+
+    single_push.assert_called_once()
+    db_mock.get_endpoint.assert_called_once_with("test_workflow", SwitchboardComponent.ExecutorQueue)
+
 
+def test_ParallelCall_raises_on_failed_batch_entries(mock_db):
+    """
+    ParallelCall should fail the invocation when some of the batch entries could not be enqueued, so the message is retried before any state is written.
+    """
+    db, db_mock = mock_db
+    db_mock.read.return_value = None
+    db_mock.increment_id.return_value = 1
+    db_mock.get_endpoints.return_value = {SwitchboardComponent.ExecutorQueue: "mocked/executor"}
+    batch_push = MagicMock(return_value={"Successful": [{"Id": "0"}, {"Id": "2"}], "Failed": [{"Id": "1", "Code": "InternalError"}]})
+
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
+    wf.SetCustomExecutorQueue(MagicMock(), batch_push)
+    with pytest.raises(EnqueueFailed) as err:
+        wf.ParallelCall("parallel_step", ("task_a",0), ("task_b",0), ("task_c",0))
 
-@patch("switchboard.workflow.Workflow._enqueue_execution")
+    assert err.value.failed == [{"Id": "1", "Code": "InternalError"}]
+    db_mock.write.assert_not_called()
+    db_mock.write_delta.assert_not_called()
+
+
+@patch("switchboard.workflow.WorkflowRun._enqueue_batch_execution")
 def test_ParallelCall_respects_WaitStatus(mock_enqueue, mock_db):
     """
     ParallelCall should not enqueue tasks if the workflow is already in a WaitStatus.
@@ -173,14 +276,14 @@ def test_ParallelCall_respects_WaitStatus(mock_enqueue, mock_db):
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
     
     # Manually set the workflow to a waiting state
-    wf.WORKFLOW = wf.WaitStatus(status=wf.Status.InProcess, state=wf.WORKFLOW.state)
+    wf.CURRENT_RUN.set(wf.WaitStatus(status=wf.Status.InProcess, state=wf.CURRENT_RUN.get().state))
 
     wf.ParallelCall("parallel_step", ("task_a",0), ("task_b",0))
 
     mock_enqueue.assert_not_called()
 
 
-@patch("switchboard.workflow.Workflow._enqueue_execution")
+@patch("switchboard.workflow.WorkflowRun._enqueue_execution")
 def test_conditional_logic_in_workflow(mock_enqueue, mock_db):
     """
     Workflow should correctly execute conditional steps based on cache values.
@@ -190,7 +293,7 @@ def test_conditional_logic_in_workflow(mock_enqueue, mock_db):
 
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
     
-    wf.WORKFLOW.state.cache["should_run"] = True
+    wf.CURRENT_RUN.get().state.cache["should_run"] = True
 
     if wf.GetCache().get("should_run"):
         wf.Call("conditional_step", "do_something_conditionally")
@@ -198,14 +301,13 @@ def test_conditional_logic_in_workflow(mock_enqueue, mock_db):
     mock_enqueue.assert_called_once()
 
     # Reset and test the negative case
-    wf.Workflow._reset_singleton()
-    wf.WORKFLOW = None
+    wf.CURRENT_RUN.set(None)
     mock_enqueue.reset_mock()
 
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
     
-    assert isinstance(wf.WORKFLOW, wf.Workflow)
-    wf.WORKFLOW.state.cache["should_run"] = False
+    assert isinstance(wf.CURRENT_RUN.get(), wf.WorkflowRun)
+    wf.CURRENT_RUN.get().state.cache["should_run"] = False
 
     if wf.GetCache().get("should_run"):
         wf.Call("conditional_step", "do_something_conditionally")
@@ -221,15 +323,17 @@ def test_workflow_with_no_steps(mock_db):
     db_mock.read.return_value = None
 
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
+    run = wf.CURRENT_RUN.get()
     
     result = wf.Done()
 
     # Workflow with no steps should return a 204 (no content) message
     assert result == 204
-    assert wf.WORKFLOW.state.status == wf.Status.Completed
+    assert run.state.status == wf.Status.Completed
+    assert wf.CURRENT_RUN.get() is None
 
 
-@patch("switchboard.workflow.Workflow._enqueue_execution")
+@patch("switchboard.workflow.WorkflowRun._enqueue_execution")
 def test_SetCustomExecutorQueue_is_called(mock_enqueue, mock_db):
     """
     The custom executor queue function should be called when provided.
@@ -242,15 +346,15 @@ def test_SetCustomExecutorQueue_is_called(mock_enqueue, mock_db):
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
     wf.SetCustomExecutorQueue(custom_queue_func)
     
-    assert isinstance(wf.WORKFLOW, wf.Workflow)
-    assert wf.WORKFLOW.custom_execution_queue == custom_queue_func
+    assert isinstance(wf.CURRENT_RUN.get(), wf.WorkflowRun)
+    assert wf.CURRENT_RUN.get().custom_execution_queue == custom_queue_func
 
     wf.Call("a_step", "a_task")
 
     mock_enqueue.assert_called_once()
 
 
-@patch("switchboard.workflow.Workflow._enqueue_execution")
+@patch("switchboard.workflow.WorkflowRun._enqueue_execution")
 def test_unsuccessful_step_and_retry_logic(mock_enqueue, mock_db):
     """
     A step that fails but has retries left should be re-enqueued and retries field decremented.
@@ -280,19 +384,19 @@ def test_unsuccessful_step_and_retry_logic(mock_enqueue, mock_db):
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_wf", db=db, context=context_json)
 
     # The workflow should not be waiting, as the step has completed (though unsuccessfully)
-    assert isinstance(wf.WORKFLOW, wf.Workflow)
-    assert not wf.WORKFLOW._is_waiting()
+    assert isinstance(wf.CURRENT_RUN.get(), wf.WorkflowRun)
+    assert not wf.CURRENT_RUN.get()._is_waiting()
 
     # Calling the same step again should trigger a retry
     wf.Call("failing_step", "failing_task")
 
     # Assert that the task was enqueued again for a retry
     mock_enqueue.assert_called_once()
-    assert isinstance(wf.WORKFLOW.state.steps[0], Step) # retries in ParallelSteps are handled for each individual task so this field only exists in a Step object
-    assert wf.WORKFLOW.state.steps[0].retries == 0
+    assert isinstance(wf.CURRENT_RUN.get().state.steps[0], Step) # retries in ParallelSteps are handled for each individual task so this field only exists in a Step object
+    assert wf.CURRENT_RUN.get().state.steps[0].retries == 0
 
 
-@patch("switchboard.workflow.Workflow._enqueue_execution")
+@patch("switchboard.workflow.WorkflowRun._enqueue_execution")
 def test_out_of_retries(mock_enqueue, mock_db):
     """
     A step that is out of retries should not be re-enqueued.
@@ -322,8 +426,8 @@ def test_out_of_retries(mock_enqueue, mock_db):
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_wf", db=db, context=context_json)
 
     # The workflow should not be waiting
-    assert isinstance(wf.WORKFLOW, wf.Workflow)
-    assert not wf.WORKFLOW._is_waiting()
+    assert isinstance(wf.CURRENT_RUN.get(), wf.WorkflowRun)
+    assert not wf.CURRENT_RUN.get()._is_waiting()
 
     # Calling the same step again should not trigger a retry
     wf.Call("failing_step", "failing_task")
@@ -338,8 +442,8 @@ def test_GetCache_returns_current_state_cache(mock_db):
     db_mock.read.return_value = None
     
     wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
-    assert(isinstance(wf.WORKFLOW, wf.Workflow))
-    wf.WORKFLOW.state.cache = {"test_key": "test_value"}
+    assert(isinstance(wf.CURRENT_RUN.get(), wf.WorkflowRun))
+    wf.CURRENT_RUN.get().state.cache = {"test_key": "test_value"}
     
     assert wf.GetCache() == {"test_key": "test_value"}
 
@@ -373,3 +477,363 @@ def test_Done_returns_200(mock_db):
 
 
 
+
+
+
+def test_write_conflict_merges_parallel_task_responses(mock_db):
+    """
+    When two task responses of a ParallelCall write concurrently, the loser should merge its task into the stored state.
+    If that completes the step the workflow should be re-invoked instead of hanging.
+    """
+    db, db_mock = mock_db
+
+    def parallel_state(task0_done: bool, version: int, cache: dict) -> State:
+        return State(
+            name="test_wf",
+            run_id=5,
+            steps=[ParallelStep(step_id=0, step_name="p", tasks=[
+                Step(0, "p", "task_a", executed=True, completed=task0_done, success=task0_done, task_id=0),
+                Step(0, "p", "task_b", executed=True, task_id=1),
+            ], executed=True)],
+            cache=cache,
+            status=Status.InProcess,
+            version=version
+        )
+
+    # this invocation read version 1, before the response for task_a was written
+    db_mock.read.side_effect = [
+        parallel_state(False, 1, {"a": 1}),
+        parallel_state(True, 2, {"a": 1, "from_task_a": True}),
+    ]
+    db_mock.write_delta.side_effect = [WriteConflict("test_wf", 5, 1), None]
+
+    context_json = json.dumps({
+        "workflow": "test_wf",
+        "ids": [5, 0, 1],
+        "executed": True,
+        "completed": True,
+        "success": True,
+        "cache": {"from_task_b": True}
+    })
+    reinvoke = MagicMock()
+
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_wf", db=db, context=context_json)
+    wf.SetCustomInvocationQueue(reinvoke)
+    wf.ParallelCall("p", ("task_a", 0), ("task_b", 0))
+    wf.Done()
+
+    assert db_mock.write_delta.call_count == 2
+    merged = db_mock.write_delta.call_args.args[0]
+    assert merged.version == 2
+    assert merged.steps[0].completed and merged.steps[0].success
+    assert merged.cache == {"a": 1, "from_task_a": True, "from_task_b": True}
+    reinvoke.assert_called_once_with(context_json)
+    assert wf.WRITE_STATS["conflicts"] >= 1
+
+
+def test_write_conflict_reinvokes_with_completed_step_context(mock_db):
+    """
+    If the completion was written while this invocation handled the executed acknowledgement, the re-invocation must carry the completed step,
+    the acknowledgement itself would be ignored once the step completed.
+    """
+    db, db_mock = mock_db
+    db_mock.read.side_effect = [
+        State("test_wf", 5, [Step(0, "s", "t")], {}, Status.InProcess, 1),
+        State("test_wf", 5, [Step(0, "s", "t", executed=True, completed=True, success=True)], {}, Status.InProcess, 2),
+    ]
+    db_mock.write_delta.side_effect = [WriteConflict("test_wf", 5, 1), None]
+    context = {"workflow": "test_wf", "ids": [5, 0, -1], "executed": True, "completed": False, "success": False, "cache": {}}
+    reinvoke = MagicMock()
+
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_wf", db=db, context=json.dumps(context))
+    wf.SetCustomInvocationQueue(reinvoke)
+    wf.Call("s", "t")
+    wf.Done()
+
+    reinvoke.assert_called_once_with(json.dumps(context | {"completed": True, "success": True}))
+
+
+@patch('switchboard.workflow.WorkflowRun._enqueue_execution')
+def test_ParallelCall_joins_on_recorded_task_counters(mock_enqueue, mock_db):
+    """
+    A task response is recorded through write_task, and the counters it returns decide whether the ParallelStep completed.
+    """
+    db, db_mock = mock_db
+    db_mock.read.return_value = State(
+        name="test_wf",
+        run_id=5,
+        steps=[ParallelStep(step_id=0, step_name="p", tasks=[
+            Step(0, "p", "task_a", executed=True, task_id=0),
+            Step(0, "p", "task_b", executed=True, task_id=1),
+        ], executed=True)],
+        cache={},
+        status=Status.InProcess,
+        version=1
+    )
+
+    def write_task(state, step_idx, task_idx):
+        # task_a's response was recorded by a concurrent invocation
+        step = state.steps[step_idx]
+        assert (step.completed_count, task_idx) == (1, 1)
+        step.completed_count = step.succeeded_count = 2
+        step.refresh_flags()
+        return True
+    db_mock.write_task.side_effect = write_task
+
+    context_json = json.dumps({
+        "workflow": "test_wf",
+        "ids": [5, 0, 1],
+        "executed": True,
+        "completed": True,
+        "success": True,
+        "cache": {}
+    })
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_wf", db=db, context=context_json)
+    wf.ParallelCall("p", ("task_a", 0), ("task_b", 0))
+    wf.Call("next", "task_c")
+
+    db_mock.write_task.assert_called_once()
+    mock_enqueue.assert_called_once()
+    assert wf.CURRENT_RUN.get().state.steps[-1].step_name == "next"
+
+
+@patch('switchboard.workflow.WorkflowRun._enqueue_execution')
+def test_ParallelCall_rereads_step_when_task_write_conflicts(mock_enqueue, mock_db):
+    """
+    A duplicate response that recorded the task first makes write_task conflict, the step is read again and the response isn't counted twice.
+    """
+    db, db_mock = mock_db
+
+    def state(recorded: bool) -> State:
+        tasks = [Step(0, "p", "task_a", executed=True, task_id=0), Step(0, "p", "task_b", executed=True, task_id=1)]
+        step = ParallelStep(step_id=0, step_name="p", tasks=tasks, executed=True)
+        if recorded:
+            step.update_task(step.task(1), True, True, True)
+        return State("test_wf", 5, [step], {"seen": 1}, Status.InProcess, 1)
+    db_mock.read_latest.side_effect = [state(False), state(True)]
+    db_mock.write_task.side_effect = WriteConflict("test_wf", 5, 1)
+
+    context_json = json.dumps({
+        "workflow": "test_wf",
+        "ids": [5, 0, 1],
+        "executed": True,
+        "completed": True,
+        "success": True,
+        "cache": {"result": 2}
+    })
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_wf", db=db, context=context_json)
+    db_mock.write_task.assert_called_once()
+    assert db_mock.read_latest.call_count == 2
+    run = wf.CURRENT_RUN.get()
+    step = run.state.steps[0]
+    assert (step.completed_count, step.completed) == (1, False)
+    assert run.state.cache["result"] == 2
+
+    # the step waits on task_a
+    wf.ParallelCall("p", ("task_a", 0), ("task_b", 0))
+    mock_enqueue.assert_not_called()
+
+
+def test_write_conflict_gives_up_after_max_attempts(mock_db):
+    db, db_mock = mock_db
+    db_mock.read.side_effect = lambda *_: State("test_wf", 5, [Step(0, "s", "t")], {}, Status.InProcess, 1)
+    db_mock.write_delta.side_effect = WriteConflict("test_wf", 5, 1)
+
+    context_json = json.dumps({
+        "workflow": "test_wf",
+        "ids": [5, 0, -1],
+        "executed": True,
+        "completed": False,
+        "success": False,
+        "cache": {}
+    })
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_wf", db=db, context=context_json)
+    wf.Call("s", "t")
+    with pytest.raises(WriteConflict):
+        wf.Done()
+    assert db_mock.write_delta.call_count == wf.MAX_WRITE_ATTEMPTS
+
+
+
+def test_writes_are_coalesced_into_one_flush(mock_db):
+    """
+    The completed steps replayed before the next step are written with it in one flush, before Call() returns.
+    """
+    db, db_mock = mock_db
+    db_mock.read.return_value = State("test_wf", 5, [Step(0, "first", "t", executed=True)], {}, Status.InProcess, 1)
+
+    context_json = json.dumps({
+        "workflow": "test_wf",
+        "ids": [5, 0, -1],
+        "executed": True,
+        "completed": True,
+        "success": True,
+        "cache": {}
+    })
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_wf", db=db, context=context_json)
+    wf.SetCustomExecutorQueue(MagicMock())
+    wf.Call("first", "t")
+    db_mock.write_delta.assert_not_called()
+
+    wf.Call("second", "u")
+    # the enqueued step is saved even if the workflow function raises before Done()
+    db_mock.write_delta.assert_called_once()
+    written = db_mock.write_delta.call_args.args[0]
+    assert written.steps[0].success and written.steps[1].step_name == "second"
+
+    wf.Done()
+    db_mock.write_delta.assert_called_once()
+
+
+def test_unchanged_state_write_is_skipped(mock_db):
+    """
+    A redelivered context that changes nothing should not write the state again.
+    """
+    db, db_mock = mock_db
+    state = State("test_wf", 5, [Step(0, "s", "t", executed=True)], {"k": "v"}, Status.InProcess, 1)
+    db_mock.read.return_value = state
+
+    context_json = json.dumps({
+        "workflow": "test_wf",
+        "ids": [5, 0, -1],
+        "executed": True,
+        "completed": False,
+        "success": False,
+        "cache": {"k": "v"}
+    })
+    skipped = wf.WRITE_STATS["skipped"]
+    wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_wf", db=db, context=context_json)
+    wf.Call("s", "t")
+    wf.Done()
+
+    db_mock.write_delta.assert_not_called()
+    assert wf.WRITE_STATS["skipped"] == skipped + 1
+
+
+def test_process_batch_runs_workflow_once_per_run(mock_db):
+    """
+    Records of the same run should be applied to one state with one workflow run and one write,
+    and the records of a run that raises should be reported as batch item failures.
+    """
+    db, db_mock = mock_db
+    db_mock.read.side_effect = lambda name, run_id: State(name, run_id, [Step(0, "step1", "task1")], {}, Status.InProcess, 1)
+    db_mock.increment_id.return_value = 9
+
+    def record(message_id: str, run_id: int, executed: bool, completed: bool, cache: dict | None = None) -> dict:
+        return {"messageId": message_id, "body": json.dumps({
+            "workflow": "test_workflow",
+            "ids": [run_id, 0 if run_id >= 0 else -1, -1],
+            "executed": executed,
+            "completed": completed,
+            "success": completed,
+            "cache": cache or {}
+        })}
+
+    runs = []
+    def workflow_fn(context: str):
+        wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=context)
+        wf.SetCustomExecutorQueue(MagicMock())
+        runs.append(wf.CURRENT_RUN.get())
+        if wf.CURRENT_RUN.get().state.run_id == 3:
+            raise RuntimeError("boom")
+        wf.Call("step1", "task1")
+        wf.Call("step2", "task2")
+        return wf.Done()
+
+    response = wf.process_batch([
+        record("a", 1, True, False),
+        record("b", 3, True, False),
+        record("c", 1, True, True, {"from_c": 1}),
+        {"messageId": "d", "body": "not json"},
+        record("e", -1, True, True),
+    ], workflow_fn)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "d"}, {"itemIdentifier": "b"}]}
+    assert len(runs) == 3
+    run_1 = runs[0]
+    assert run_1.state.steps[0].completed and run_1.state.steps[-1].step_name == "step2"
+    assert run_1.state.cache == {"from_c": 1}
+    assert db_mock.read.call_count == 2
+    # run 1 and the new run triggered by record e
+    assert db_mock.write_delta.call_count == 2
+    assert wf.CURRENT_RUN.get() is None and wf._batched_contexts.get() == ()
+
+
+def test_async_workflow_dispatches_executor_pushes_concurrently(mock_db):
+    """
+    With InitWorkflowAsync the executor pushes are collected and awaited together by DoneAsync, before the state is written.
+    """
+    db, db_mock = mock_db
+    db_mock.read.return_value = None
+    db_mock.increment_id.return_value = 1
+    db_mock.get_endpoints.return_value = {SwitchboardComponent.ExecutorQueue: "mocked/executor"}
+    pushed = []
+    in_flight = 0
+    peak = 0
+
+    async def push(body: str):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        pushed.append(json.loads(body)["task_key"])
+        return {"MessageId": str(len(pushed))}
+
+    async def run() -> int:
+        await wf.InitWorkflowAsync(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
+        wf.SetCustomExecutorQueue(push)
+        wf.ParallelCall("parallel_step", ("task_a",0), ("task_b",0), ("task_c",0))
+        # nothing is sent until DoneAsync()
+        assert pushed == []
+        return await wf.DoneAsync()
+
+    assert asyncio.run(run()) == 200
+    assert sorted(pushed) == ["task_a", "task_b", "task_c"]
+    assert peak == 3
+    db_mock.write_delta.assert_called_once()
+    db_mock.get_endpoint.assert_not_called()
+
+
+def test_runs_are_independent_across_threads_and_tasks(mock_db):
+    """
+    Each thread and asyncio task drives its own WorkflowRun through the public interface.
+    """
+    db, db_mock = mock_db
+    db_mock.read.return_value = None
+    db_mock.increment_id.side_effect = iter(range(1, 100))
+    barrier = threading.Barrier(4, timeout=5)
+    pushed = []
+
+    def run_workflow(step_name: str) -> int:
+        wf.InitWorkflow(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
+        wf.SetCustomExecutorQueue(lambda body: pushed.append(json.loads(body)))
+        # every run has been started before any of them calls a task
+        barrier.wait()
+        wf.Call(step_name, "task")
+        return wf.Done()
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert list(pool.map(run_workflow, ["a", "b", "c", "d"])) == [200] * 4
+
+    written = [call.args[0] for call in db_mock.write_delta.call_args_list]
+    assert sorted(state.steps[0].step_name for state in written) == ["a", "b", "c", "d"]
+    assert len({state.run_id for state in written}) == 4
+    assert len(pushed) == 4
+
+    async def run_async(step_name: str) -> str:
+        await wf.InitWorkflowAsync(cloud=Cloud.CUSTOM, name="test_workflow", db=db, context=NEW_WORKFLOW_CONTEXT)
+        wf.SetCustomExecutorQueue(lambda body: pushed.append(json.loads(body)))
+        await asyncio.sleep(0)
+        wf.Call(step_name, "task")
+        assert isinstance(wf.CURRENT_RUN.get(), wf.WaitStatus)
+        await wf.DoneAsync()
+        return step_name
+
+    async def run_all() -> list[str]:
+        return await asyncio.gather(*(run_async(name) for name in ["e", "f", "g"]))
+
+    assert asyncio.run(run_all()) == ["e", "f", "g"]
+    assert sorted(body["ids"][0] for body in pushed[4:]) == [5, 6, 7]
+    # the caller's own context never had a run
+    assert wf.CURRENT_RUN.get() is None